@@ -0,0 +1,202 @@
+"""
+Benchmark suite for NMRQuant. Times data ingestion (csv and xlsx), each compute stage, the export and each
+visualizer class on synthetic datasets of increasing size, and stores the results as json so that runs can be
+compared.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run_benchmarks --scales 100 1000 10000 50000 -o bench.json
+    python -m benchmarks.run_benchmarks --compare old.json new.json
+"""
+import argparse
+import io
+import json
+import platform
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+
+import nmrquant  # noqa: E402
+from nmrquant.engine.calculator import Quantifier  # noqa: E402
+from nmrquant.engine.profiler import StageProfiler  # noqa: E402
+from nmrquant.engine.utilities import read_data  # noqa: E402
+from nmrquant.engine.visualizer import IndHistA, IndHistB, MultHistB, NoRepIndLine, IndLine, MeanLine  # noqa: E402
+
+from benchmarks.synthetic import make_dataset, write_dataset  # noqa: E402
+
+DEFAULT_SCALES = [100, 1000, 10000, 50000]
+
+
+def parse_args():
+    """
+    Get user arguments for the benchmark runner
+
+    :return: class: 'Argument Parser'
+    """
+    parser = argparse.ArgumentParser(description="NMRQuant benchmark suite")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES,
+                        help="Numbers of spectra of the synthetic datasets")
+    parser.add_argument("--metabolites", type=int, default=50,
+                        help="Number of metabolites in the synthetic datasets")
+    parser.add_argument("--replicates", type=int, default=3, help="Number of replicates")
+    parser.add_argument("--conditions", type=int, default=4, help="Number of conditions")
+    parser.add_argument("--max-xlsx", type=int, default=10000,
+                        help="Largest scale for which xlsx reading is benchmarked")
+    parser.add_argument("--max-plot", type=int, default=10000,
+                        help="Largest scale for which the visualizer classes are benchmarked")
+    parser.add_argument("--plot-count", type=int, default=5,
+                        help="Number of metabolites plotted per visualizer class")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data generator")
+    parser.add_argument("-o", "--output", type=str, default="benchmark_results.json",
+                        help="Path of the json file where results are stored")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BASELINE", "CANDIDATE"),
+                        help="Compare two result files instead of running the suite")
+    return parser
+
+
+def _savefig(figures, fmt="svg"):
+    """Render figures to memory so that the full savefig path is timed without touching the disk"""
+
+    if not isinstance(figures, list):
+        figures = [(None, figures)]
+    for _, fig in figures:
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=fmt)
+        plt.close(fig)
+    return len(figures)
+
+
+def _render_direct(plot, fmt="svg"):
+    """Render the scenes of a plot to memory with the direct renderer"""
+
+    scenes = plot.scenes()
+    for _, scene in scenes:
+        scene.to_svg() if fmt == "svg" else scene.to_png()
+    return len(scenes)
+
+
+def bench_ingest(profiler, paths, fmt):
+    """Time read_data on the data, database and template files"""
+
+    for key in ["data", "database", "template"]:
+        with profiler.stage(f"read_{key}_{fmt}") as record:
+            record.set_shape(read_data(str(paths[key])))
+
+
+def bench_compute(data, database, template, destination):
+    """Run the full computation and export with the Quantifier profiler and return its report"""
+
+    quantifier = Quantifier(profile=True)
+    quantifier.get_data(data.copy())
+    quantifier.get_db(database.copy())
+    quantifier.import_md(template.copy())
+    quantifier.compute_data(strd_conc=1, mean=True)
+    quantifier.export_data(destination, file_name="bench", export_mean=True)
+    report = quantifier.profile_report
+    quantifier.profiler.reset()
+    return quantifier, report
+
+
+def bench_plots(profiler, quantifier, count):
+    """Time each visualizer class (object construction, plot building and rendering) on a few metabolites"""
+
+    conc = quantifier.conc_data
+    metabolites = quantifier.metabolites[:count]
+    first_time = conc.index.get_level_values("Time_Points")[0]
+    first_rep = conc.index.get_level_values("Replicates")[0]
+    one_time = conc.xs(first_time, level="Time_Points", drop_level=False)
+    one_time_one_rep = one_time.xs(first_rep, level="Replicates", drop_level=False)
+    one_rep = conc.xs(first_rep, level="Replicates", drop_level=False)
+    mean_one_time = quantifier.mean_data.xs(first_time, level="Time_Points", drop_level=False)
+    std_one_time = quantifier.std_data.xs(first_time, level="Time_Points", drop_level=False)
+    cases = {
+        "IndHistA": lambda met: IndHistA(one_time_one_rep, met, False),
+        "IndHistB": lambda met: IndHistB(one_time, met, False),
+        "MultHistB": lambda met: MultHistB(mean_one_time, std_one_time, met, False),
+        "NoRepIndLine": lambda met: NoRepIndLine(one_rep, met, False),
+        "IndLine": lambda met: IndLine(conc, met, False),
+        "MeanLine": lambda met: MeanLine(conc, met, False),
+    }
+    for name, factory in cases.items():
+        with profiler.stage(f"plot_{name}") as record:
+            figures = sum(_savefig(factory(met)()) for met in metabolites)
+            record.add("figures", figures)
+        with profiler.stage(f"plot_{name}_direct") as record:
+            figures = sum(_render_direct(factory(met)) for met in metabolites)
+            record.add("figures", figures)
+
+
+def run(args):
+    """Run the suite for every requested scale and write the results file"""
+
+    results = []
+    for scale in args.scales:
+        print(f"Benchmarking {scale} spectra...")
+        data, database, template = make_dataset(n_spectra=scale, n_metabolites=args.metabolites,
+                                                n_conditions=args.conditions, n_replicates=args.replicates,
+                                                seed=args.seed)
+        profiler = StageProfiler(enabled=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            bench_ingest(profiler, write_dataset(data, database, template, tmp / "csv", "csv"), "csv")
+            if scale <= args.max_xlsx:
+                bench_ingest(profiler, write_dataset(data, database, template, tmp / "xlsx", "xlsx"), "xlsx")
+            quantifier, compute_report = bench_compute(data, database, template, tmp)
+            if scale <= args.max_plot:
+                bench_plots(profiler, quantifier, args.plot_count)
+        for record in profiler.report + compute_report:
+            record.update(scale=scale, metabolites=args.metabolites)
+            results.append(record)
+        profiler.reset()
+    output = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "nmrquant_version": nmrquant.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "arguments": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as json_file:
+        json.dump(output, json_file, indent=4)
+    print(f"Results written to {args.output}")
+    return output
+
+
+def compare(baseline_path, candidate_path):
+    """
+    Print the wall time ratio (candidate / baseline) of every benchmark present in both files
+
+    :return: dictionary mapping (scale, stage) to the ratio
+    """
+
+    def load(path):
+        with open(path) as json_file:
+            return {(r["scale"], r["stage"]): r for r in json.load(json_file)["results"]}
+
+    baseline, candidate = load(baseline_path), load(candidate_path)
+    ratios = {}
+    print(f"{'scale':>8} {'stage':<28} {'baseline (s)':>13} {'candidate (s)':>14} {'ratio':>7}")
+    for key in sorted(set(baseline) & set(candidate)):
+        base, cand = baseline[key]["wall_time_s"], candidate[key]["wall_time_s"]
+        ratios[key] = cand / base if base else float("nan")
+        print(f"{key[0]:>8} {key[1]:<28} {base:>13.4f} {cand:>14.4f} {ratios[key]:>7.2f}")
+    return ratios
+
+
+def main():
+    args = parse_args().parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
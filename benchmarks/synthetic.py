@@ -0,0 +1,99 @@
+"""Module containing the synthetic dataset generator used by the benchmark suite"""
+import math
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def make_dataset(n_spectra=100, n_metabolites=20, n_conditions=4, n_replicates=3, n_times=None,
+                 split_fraction=0.2, n_sums=2, seed=0):
+    """
+    Generate a synthetic experiment (integrated areas, proton database and template)
+
+    :param n_spectra: number of spectra in the experiment
+    :param n_metabolites: number of metabolites (before splitting in _1/_2 columns)
+    :param n_conditions: number of conditions
+    :param n_replicates: number of replicates per condition and time point
+    :param n_times: number of time points. If None, it is deduced from the other dimensions so that all
+                    spectra are used
+    :param split_fraction: fraction of metabolites integrated on two separate signals (_1 and _2 columns)
+    :param n_sums: number of summed columns (ex: 'Met001+Met002') to add to the data
+    :param seed: seed of the random generator
+    :return: tuple of DataFrames (data, database, template)
+    """
+
+    rng = np.random.default_rng(seed)
+    if n_times is None:
+        n_times = max(1, math.ceil(n_spectra / (n_conditions * n_replicates)))
+    # Template: spectra are ordered condition > time point > replicate as in a typical run
+    conditions = [f"Cond{i + 1}" for i in range(n_conditions)]
+    times = np.arange(n_times) * 6
+    grid = pd.MultiIndex.from_product([conditions, times, range(1, n_replicates + 1)],
+                                      names=["Conditions", "Time_Points", "Replicates"])
+    template = grid[:n_spectra].to_frame(index=False)
+    template["# Spectrum#"] = np.arange(1, len(template) + 1)
+    n_spectra = len(template)
+
+    metabolites = [f"Met{i + 1:03d}" for i in range(n_metabolites)]
+    protons = rng.choice([1, 2, 3, 6, 9], size=n_metabolites).astype(float)
+    split = set(rng.choice(metabolites, size=int(n_metabolites * split_fraction), replace=False))
+
+    # Concentrations follow a condition effect, a first order kinetic along time and replicate noise
+    base = rng.uniform(0.5, 50, size=n_metabolites)
+    cond_effect = rng.uniform(0.5, 1.5, size=(n_conditions, n_metabolites))
+    rates = rng.uniform(-0.05, 0.05, size=n_metabolites)
+    cond_idx = pd.Categorical(template["Conditions"], categories=conditions).codes
+    time_values = template["Time_Points"].to_numpy(dtype=float)
+    conc = base * cond_effect[cond_idx] * np.exp(np.outer(time_values, rates))
+    conc *= rng.normal(1, 0.05, size=conc.shape)
+    areas = np.clip(conc * protons, 0, None)
+
+    columns = {"# Spectrum#": template["# Spectrum#"].to_numpy()}
+    db_rows = []
+    for ind, met in enumerate(metabolites):
+        if met in split:
+            weights = rng.dirichlet([5, 5])
+            for part, weight in enumerate(weights, start=1):
+                columns[f"{met}_{part}"] = areas[:, ind] * weight
+                db_rows.append((f"{met}_{part}", protons[ind] * weight))
+        else:
+            columns[met] = areas[:, ind]
+            db_rows.append((met, protons[ind]))
+    for ind in range(min(n_sums, n_metabolites // 2)):
+        first, second = 2 * ind, 2 * ind + 1
+        name = f"{metabolites[first]}+{metabolites[second]}"
+        columns[name] = areas[:, first] + areas[:, second]
+        db_rows.append((name, protons[first] + protons[second]))
+    columns["Strd"] = np.ones(n_spectra)
+    data = pd.DataFrame(columns)
+
+    database = pd.DataFrame(db_rows, columns=["Metabolite", "Heq"])
+    database.insert(1, "ppm", rng.uniform(0.5, 8.5, size=len(database)).round(4))
+    return data, database, template
+
+
+def write_dataset(data, database, template, directory, fmt="csv"):
+    """
+    Write a synthetic dataset to disk in the layout expected by NMRQuant
+
+    :param directory: folder in which the files are written
+    :param fmt: 'csv' or 'xlsx' (the database is always written as csv)
+    :return: dictionary of paths for the 'data', 'database' and 'template' keys
+    """
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = {"database": directory / "proton_db.csv"}
+    database.to_csv(paths["database"], sep=";", index=False)
+    if fmt == "csv":
+        paths["data"], paths["template"] = directory / "data.csv", directory / "template.csv"
+        data.to_csv(paths["data"], sep=";", index=False)
+        template.to_csv(paths["template"], sep=";", index=False)
+    elif fmt == "xlsx":
+        paths["data"], paths["template"] = directory / "data.xlsx", directory / "template.xlsx"
+        data.to_excel(paths["data"], index=False)
+        template.to_excel(paths["template"], index=False)
+    else:
+        raise ValueError(f"Unsupported format: {fmt}. Supported formats: 'csv' and 'xlsx'")
+    return paths
@@ -0,0 +1,324 @@
+"""Module containing the sharded and resumable reprocessing of archives of experiments"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from nmrquant.engine.checkpoints import fingerprint
+from nmrquant.engine.loader import load_quantifier
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.archive")
+
+DATA_SUFFIXES = (".xlsx", ".csv", ".tsv")
+
+# Locks older than this (in seconds) are considered abandoned by a crashed worker and can be taken over
+STALE_AFTER = 6 * 3600
+
+
+def find_experiments(source, template_pattern="*emplate*"):
+    """
+    List the experiments of an archive. An experiment is a folder containing a template file (matching
+    template_pattern) and one data file. A table with "Data" and "Template" columns (paths relative to the table)
+    can be given instead of a folder.
+
+    :param source: root folder of the archive, or path to a table of experiments
+    :param template_pattern: glob pattern of the template file names
+    :return: DataFrame indexed by experiment id with "Data" and "Template" columns (absolute paths)
+    """
+
+    source = Path(source).absolute()
+    if source.is_file():
+        from nmrquant.engine.utilities import read_data
+        table = read_data(source)
+        pairs = [((source.parent / data).absolute(), (source.parent / template).absolute())
+                 for data, template in zip(table["Data"], table["Template"])]
+    else:
+        pairs = []
+        for template in sorted(source.rglob(template_pattern)):
+            if template.suffix not in DATA_SUFFIXES or template.name.startswith("~$"):
+                continue
+            data = [path for path in sorted(template.parent.iterdir()) if path.suffix in DATA_SUFFIXES
+                    and path != template and not path.match(template_pattern) and not path.name.startswith("~$")]
+            if len(data) != 1:
+                mod_logger.warning("Skipped %s: %s data files found next to the template", template.parent, len(data))
+                continue
+            pairs.append((data[0], template))
+    # Ids depend on the paths relative to the archive, so that they are the same on all the machines
+    root = source.parent if source.is_file() else source
+    ids = [hashlib.sha1(Path(os.path.relpath(data, root)).as_posix().encode()).hexdigest()[:16] for data, _ in pairs]
+    experiments = pd.DataFrame({"Data": [str(data) for data, _ in pairs],
+                                "Template": [str(template) for _, template in pairs]},
+                               index=pd.Index(ids, name="Experiment"))
+    duplicated = experiments.index.duplicated()
+    if duplicated.any():
+        raise ValueError(f"Experiments listed several times: {list(experiments.Data[duplicated])}")
+    return experiments
+
+
+def shard_of(experiment_id, shards):
+    """Shard of an experiment (stable across machines and runs)"""
+
+    return int(experiment_id, 16) % shards
+
+
+class WorkQueue:
+    """
+    Work queue shared by the workers through a folder (on a local or a shared filesystem). An experiment is claimed
+    by creating its lock file atomically (O_CREAT | O_EXCL), and finished when its record is written in done/.
+    Records are tagged with a fingerprint of the database, so that a revised database triggers new processing.
+    Failed experiments are tried once per run: they are tried again by the next run.
+    """
+
+    def __init__(self, folder, revision, run=None, stale_after=STALE_AFTER):
+        """
+        :param folder: folder of the queue (created if needed)
+        :param revision: fingerprint of the database and options of the reprocessing
+        :param run: id of the current run
+        :param stale_after: age in seconds after which a lock is considered abandoned
+        """
+
+        self.folder = Path(folder)
+        self.revision = revision
+        self.run = run
+        self.stale_after = stale_after
+        self.locks = self.folder / "locks"
+        self.done = self.folder / "done"
+        self.locks.mkdir(parents=True, exist_ok=True)
+        self.done.mkdir(parents=True, exist_ok=True)
+
+    def is_done(self, experiment_id):
+        """Check if an experiment was processed with the current revision (and, if it failed, during this run)"""
+
+        record = self.record(experiment_id)
+        if record is None or record.get("revision") != self.revision:
+            return False
+        return record.get("status") == "done" or record.get("run") == self.run
+
+    def record(self, experiment_id):
+        """Completion record of an experiment (None if not processed)"""
+
+        try:
+            return json.loads((self.done / f"{experiment_id}.json").read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def claim(self, experiment_id):
+        """
+        Try to take an experiment
+
+        :return: True if the experiment is now owned by this worker
+        """
+
+        if self.is_done(experiment_id):
+            return False
+        lock = self.locks / f"{experiment_id}.lock"
+        try:
+            handle = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                seen = lock.stat()
+            except FileNotFoundError:
+                return self.claim(experiment_id)
+            age = time.time() - seen.st_mtime
+            if age < self.stale_after:
+                return False
+            mod_logger.warning("Lock of experiment %s abandoned %.0f s ago, taking it over", experiment_id, age)
+            # Renaming is atomic, but another worker may have taken over the stale lock and created a fresh one in the
+            # meantime: the renamed file must be the stale lock that was checked
+            stale = lock.with_suffix(f".stale-{os.getpid()}")
+            try:
+                os.replace(lock, stale)
+            except FileNotFoundError:
+                return False
+            try:
+                moved = stale.stat()
+                if (moved.st_ino, moved.st_mtime_ns) != (seen.st_ino, seen.st_mtime_ns):
+                    # The fresh lock of the other worker is put back (unless a third worker already took the place)
+                    try:
+                        os.link(stale, lock)
+                    except FileExistsError:
+                        pass
+                    return False
+            finally:
+                stale.unlink(missing_ok=True)
+            return self.claim(experiment_id)
+        with os.fdopen(handle, "w") as file:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid(),
+                       "time": datetime.now().isoformat(timespec="seconds")}, file)
+        # Another worker may have finished the experiment between the check and the lock
+        if self.is_done(experiment_id):
+            self.release(experiment_id)
+            return False
+        return True
+
+    def complete(self, experiment_id, record):
+        """Write the completion record of an experiment and release its lock"""
+
+        record = {**record, "revision": self.revision, "run": self.run, "host": socket.gethostname(),
+                  "pid": os.getpid(), "finished": datetime.now().isoformat(timespec="seconds")}
+        tmp = self.done / f"{experiment_id}.json.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(record, indent=4, default=str))
+        os.replace(tmp, self.done / f"{experiment_id}.json")
+        self.release(experiment_id)
+
+    def release(self, experiment_id):
+        (self.locks / f"{experiment_id}.lock").unlink(missing_ok=True)
+
+
+def process_experiment(data, template, database, destination, strd_conc=1, mean=True, dilution_factor=None):
+    """
+    Quantify one experiment with a Quantifier, from the files to the exported results
+
+    :param data: path to the data file
+    :param template: path to the template file
+    :param database: path to the proton database (or list of databases, see Quantifier.get_db)
+    :param destination: folder of the results
+    :param strd_conc: concentration of the standard (used when the data has external calibration)
+    :param mean: compute and export the means
+    :param dilution_factor: dilution factor (Quantifier default if None)
+    :return: dict describing the results
+    """
+
+    destination = Path(destination)
+    destination.mkdir(parents=True, exist_ok=True)
+    quantifier = load_quantifier(data, database, template)
+    if dilution_factor is not None:
+        quantifier.dilution_factor = dilution_factor
+    quantifier.compute_data(strd_conc if quantifier.use_strd else 1, mean=mean)
+    results = quantifier.export_data(destination=destination, file_name="Results", export_mean=mean)
+    unresolved = [] if quantifier.name_report is None else \
+        list(quantifier.name_report.index[quantifier.name_report["Match"] == "unresolved"])
+    return {"results": str(results),
+            "spectra": int(len(quantifier.conc_data)), "metabolites": len(quantifier.metabolites),
+            "unresolved": unresolved}
+
+
+def run_worker(work_dir, experiments, database, worker=0, workers=1, options=None, run=None,
+               stale_after=STALE_AFTER):
+    """
+    Process experiments of the queue until none is left. The worker starts with its own part of the experiments and
+    then helps with the others, so that workers (and machines) finishing early take over the remaining work.
+
+    :param work_dir: folder of the reprocessing (queue and results)
+    :param experiments: DataFrame of experiments (see find_experiments)
+    :param database: path to the proton database
+    :param worker: index of this worker
+    :param workers: number of local workers
+    :param options: dict of keyword arguments of process_experiment (strd_conc, mean, dilution_factor)
+    :param run: id of the current run
+    :param stale_after: age in seconds after which a lock is considered abandoned
+    :return: number of experiments processed by this worker
+    """
+
+    options = options or {}
+    work_dir = Path(work_dir)
+    queue = WorkQueue(work_dir / "queue", revision(database, options), run, stale_after)
+    ids = list(experiments.index)
+    order = [ind for ind in ids if shard_of(ind, workers) == worker] + \
+            [ind for ind in ids if shard_of(ind, workers) != worker]
+    processed = 0
+    for experiment_id in order:
+        if not queue.claim(experiment_id):
+            continue
+        data, template = experiments.loc[experiment_id, ["Data", "Template"]]
+        start = time.perf_counter()
+        try:
+            result = process_experiment(data, template, database, work_dir / "results" / experiment_id, **options)
+            record = {"status": "done", **result}
+        except Exception as err:
+            mod_logger.exception("Experiment %s (%s) failed", experiment_id, data)
+            record = {"status": "failed", "error": f"{type(err).__name__}: {err}"}
+        record.update({"data": data, "template": template, "seconds": round(time.perf_counter() - start, 3)})
+        queue.complete(experiment_id, record)
+        processed += 1
+    return processed
+
+
+def revision(database, options=None):
+    """Fingerprint of the database files (on their content, which is the same on all the machines) and options"""
+
+    databases = database.values() if isinstance(database, dict) else \
+        database if isinstance(database, (list, tuple)) else [database]
+    return fingerprint([hashlib.sha256(Path(db).read_bytes()).hexdigest() for db in databases], options or {})[:16]
+
+
+def _worker_main(args):
+    # Entry point of the worker processes
+    return run_worker(*args)
+
+
+def write_manifest(work_dir, experiments, database, options=None):
+    """
+    Consolidate the completion records in a manifest of all the experiments (manifest.json and manifest.csv)
+
+    :return: DataFrame of the manifest indexed by experiment id
+    """
+
+    work_dir = Path(work_dir)
+    queue = WorkQueue(work_dir / "queue", revision(database, options))
+    rows = []
+    for experiment_id, (data, template) in experiments[["Data", "Template"]].iterrows():
+        record = queue.record(experiment_id)
+        if record is None or record.get("revision") != queue.revision:
+            record = {"status": "pending", "data": data, "template": template}
+        rows.append({"Experiment": experiment_id, **record})
+    manifest = pd.DataFrame(rows).set_index("Experiment")
+    summary = manifest["status"].value_counts().to_dict()
+    content = {"revision": queue.revision, "created": datetime.now().isoformat(timespec="seconds"),
+               "summary": summary, "experiments": json.loads(manifest.to_json(orient="index"))}
+    for name, text in [("manifest.json", json.dumps(content, indent=4)),
+                       ("manifest.csv", manifest.to_csv(sep=";"))]:
+        tmp = work_dir / f"{name}.{os.getpid()}.tmp"
+        tmp.write_text(text)
+        os.replace(tmp, work_dir / name)
+    mod_logger.info("Manifest written: %s", summary)
+    return manifest
+
+
+def reprocess(source, database, work_dir, workers=None, shard=None, options=None, stale_after=STALE_AFTER):
+    """
+    Quantify again all the experiments of an archive, in parallel and resumably. Finished experiments (with the same
+    database and options) are never processed again, so an interrupted run can simply be started again. Several
+    machines sharing the work folder can run it at the same time, on all the experiments or each on its shard.
+
+    :param source: root folder of the archive, or table of experiments (see find_experiments)
+    :param database: path to the proton database
+    :param work_dir: folder of the queue, the results and the manifest
+    :param workers: number of local worker processes (number of CPUs by default)
+    :param shard: tuple (index, count) to only process one shard of the experiments
+    :param options: dict of keyword arguments of process_experiment (strd_conc, mean, dilution_factor)
+    :param stale_after: age in seconds after which a lock is considered abandoned
+    :return: DataFrame of the manifest
+    """
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    everything = find_experiments(source)
+    experiments = everything
+    if shard is not None:
+        index, count = shard
+        experiments = experiments[[shard_of(ind, count) == index for ind in experiments.index]]
+    run = f"{socket.gethostname()}-{os.getpid()}-{time.time_ns()}"
+    queue = WorkQueue(work_dir / "queue", revision(database, options), run, stale_after)
+    pending = experiments[[not queue.is_done(ind) for ind in experiments.index]]
+    mod_logger.info("%s experiments of %s already processed", len(experiments) - len(pending), len(experiments))
+    processed = []
+    if len(pending):
+        workers = max(1, min(workers or os.cpu_count() or 1, len(pending)))
+        mod_logger.info("Reprocessing %s experiments with %s workers", len(pending), workers)
+        jobs = [(work_dir, pending, database, worker, workers, options, run, stale_after) for worker in range(workers)]
+        if workers == 1:
+            processed = [_worker_main(jobs[0])]
+        else:
+            # Workers are spawned (not forked) so that they do not inherit the state of the caller
+            with multiprocessing.get_context("spawn").Pool(workers) as pool:
+                processed = pool.map(_worker_main, jobs)
+    mod_logger.info("%s experiments processed in this run", sum(processed))
+    return write_manifest(work_dir, everything, database, options)
@@ -2,42 +2,80 @@
 import logging
 from datetime import datetime
 import sys
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
 import nmrquant.logger
+from nmrquant.logger import summarize
 
-from nmrquant.engine.utilities import read_data, is_empty, append_value
+from nmrquant.engine.calibration import fit_calibration, apply_calibration
+from nmrquant.engine.cube import LabeledCube
+from nmrquant.engine.expressions import CompiledExpressions, parse_expression, read_definitions
+from nmrquant.engine.kinetics import fit_kinetics
+from nmrquant.engine.names import NameResolver, merge_databases, read_aliases
+from nmrquant.engine.outliers import detect_outliers
+from nmrquant.engine.profiler import StageProfiler, profiled
+from nmrquant.engine.qc import CV_LIMIT, DRIFT_LIMIT, STANDARD_NAMES, find_standard, normalize_to_standard, \
+    standard_qc
+from nmrquant.engine.results import ResultsCube
+from nmrquant.engine.spectra import integrate_spectra, regions_from_db, DEFAULT_WIDTH
+from nmrquant.engine.statistics import compare_conditions
+from nmrquant.engine.uncertainty import confidence_intervals
+from nmrquant.engine.utilities import read_data, is_empty, append_value, natural_categorical
 
 mod_logger = logging.getLogger("RMNQ_logger.engine.calculator")
 
+# Optional template columns giving per-spectrum dilution factors, standard concentrations and normalization factors
+SPECTRUM_FACTORS = ("Dilution", "Strd_Concentration", "Normalization")
+
 
 # noinspection PyBroadException
+def _signature(value):
+    """
+    Layout of an attribute, compared before and after a stage to find the attributes it modified in place.
+    Containers are copied (they are small and updated in place), DataFrames are compared on their shape and labels.
+    """
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        columns = tuple(value.columns) if isinstance(value, pd.DataFrame) else value.name
+        return value.shape, columns, tuple(value.index.names), tuple(map(str, np.atleast_1d(value.dtypes)))
+    if isinstance(value, ResultsCube):
+        # Columns added to the DataFrame view of the cube are only in the cube once synchronized
+        value.sync()
+        return id(value.values), value.shape, tuple(value.columns)
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, (list, set)):
+        return type(value)(value)
+    return None
+
+
+def _changed(before, after):
+    try:
+        return bool(before != after)
+    except (TypeError, ValueError):
+        # Containers of arrays or DataFrames cannot be compared
+        return True
+
+
 class Quantifier:
     """
     RMNQ main class to quantify and visualize data
     """
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, profile=False):
 
         self.verbose = verbose
+        # Per-stage timing and memory instrumentation (no-op when profile is False)
+        self.profiler = StageProfiler(enabled=profile)
         # When True, Strd concentration will be used to calculate concentration
         self.use_strd = False
-        # Initialize child logger for class instances
-        self.logger = logging.getLogger(f"RMNQ_logger.engine.calculator.Quantifier")
-        # fh = logging.FileHandler(f"{self.run_name}.log")
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
-        handler.setFormatter(formatter)
-        # For debugging purposes
-        if verbose:
-            handler.setLevel(logging.DEBUG)
-        else:
-            handler.setLevel(logging.INFO)
-        if not self.logger.hasHandlers():
-            self.logger.addHandler(handler)
+        # Initialize child logger for class instances. The console handler lives on the base logger and is only
+        # created once, whatever the number of instances
+        self.logger = logging.getLogger("RMNQ_logger.engine.calculator.Quantifier")
+        nmrquant.logger.setup_handler(verbose)
         # Data attributes (future DataFrames)
         self.data = None
         self.mdata = None
@@ -45,9 +83,11 @@ class Quantifier:
         self.metadata = None
         self.cor_data = None
         self.calc_data = None
-        self.conc_data = None
+        # Concentrations are stored in a compact results cube, conc_data is a DataFrame view on it
+        self.results = None
         self.mean_data = None
         self.std_data = None
+        self.uncertainty_data = None
         self.plot_data = None
         self.ind_plot_data = None
         self.mean_plot_data = None
@@ -55,6 +95,7 @@ class Quantifier:
         self.metabolites = []
         self.conditions = []
         self.time_points = []
+        self.replicates = []
         # Dictionary that will contain H+ count for each metabolite
         self.proton_dict = {}
         # List for missing metabolites in db
@@ -63,6 +104,143 @@ class Quantifier:
         self.spectrum_count = 0
         # Should be over 1
         self.dilution_factor = 1.11
+        # Per-spectrum factors from the optional template columns (see SPECTRUM_FACTORS). Empty cells use the run
+        # values (dilution_factor, standard concentration and no normalization)
+        self.spectrum_factors = None
+        # Summed columns (ex: Isoleucine+Leucine) kept apart from the metabolites, and definitions of the derived
+        # columns computed from them (target name: expression)
+        self.sum_data = None
+        self.expressions = {}
+        # Aliases of database names (alias: database name) and report of the matching of data columns to the database
+        self.aliases = {}
+        self.name_report = None
+        # On-disk checkpoints of the stages (nmrquant.engine.checkpoints.CheckpointStore), None to disable them
+        self.checkpoints = None
+        # Multi-point external calibration: known concentrations of the calibration spectra (from the "Calibration"
+        # column of the template and/or a per-metabolite calibration table) and fitted curves
+        self.calibration_levels = None
+        self.calibration_table = None
+        self.calibration_report = None
+        self.calibration_model = "linear"
+        self.calibration_weighting = None
+        # Replicate outlier screening, run before means when a method is set
+        self.outlier_method = None
+        self.outlier_threshold = 3.5
+        self.outlier_alpha = 0.05
+        self.mask_outliers = False
+        self.outlier_mask = None
+        self.outlier_report = None
+        self.statistics_data = None
+        # Kinetic fits of each replicate and of each condition (replicates pooled)
+        self.kinetics_data = None
+        self.condition_kinetics = None
+        # Area column of the standard in the data (None to look for TSP, DSS..., see qc.find_standard), area of the
+        # standard of each spectrum (indexed by spectrum), quality control of the run on the standard, and optional
+        # normalization of the areas of each spectrum to its standard. The Strd column of the data only flags the
+        # calibration (1 internal, 9 external)
+        self.standard_column = None
+        self.strd_data = None
+        self.qc_data = None
+        self.qc_summary = None
+        self.qc_cv_limit = CV_LIMIT
+        self.qc_drift_limit = DRIFT_LIMIT
+        self.normalize_strd = False
+
+    @property
+    def conc_data(self):
+        """
+        Concentrations as a DataFrame. The DataFrame is a view on the compact results cube (self.results): cell
+        writes reach the cube, other changes (added or replaced columns...) are taken back by the cube when it is
+        pickled (see ResultsCube.sync).
+        """
+
+        return None if self.results is None else self.results.to_frame()
+
+    @conc_data.setter
+    def conc_data(self, frame):
+        self.results = None if frame is None else ResultsCube.from_frame(frame)
+
+    def __getstate__(self):
+        return self._pack(self.__dict__)
+
+    @staticmethod
+    def _pack(attributes):
+        # Numeric DataFrames are pickled as compact cubes (raw arrays and integer codes)
+        state = dict(attributes)
+        packed = []
+        for name, value in state.items():
+            if isinstance(value, pd.DataFrame) and len(value.columns) \
+                    and all(pd.api.types.is_numeric_dtype(dtype) for dtype in value.dtypes):
+                state[name] = ResultsCube.from_frame(value)
+                packed.append(name)
+        state["_packed"] = packed
+        return state
+
+    def __setstate__(self, state):
+        for name in state.pop("_packed", []):
+            state[name] = state[name].to_frame().copy()
+        self.__dict__.update(state)
+
+    _SETTINGS = ("dilution_factor", "outlier_method", "outlier_threshold", "outlier_alpha", "mask_outliers",
+                 "calibration_model", "calibration_weighting", "normalize_strd", "standard_column", "qc_cv_limit",
+                 "qc_drift_limit")
+
+    # Attributes never written to the checkpoints
+    _TRANSIENT = ("logger", "profiler", "checkpoints")
+
+    def run_stage(self, name, stage, *params, files=None, chain=True):
+        """
+        Run a pipeline stage and write its checkpoint. If checkpoints are enabled and the stage has a valid
+        checkpoint, the stage is skipped (its state is restored when a later stage needs it, see restore_checkpoint).
+        The checkpoint only holds the attributes set by the stage (attributes replaced, added, reshaped or
+        relabelled, see _signature), and the checkpoints of branch stages (chain=False) only record their files.
+
+        :param name: name of the stage
+        :param stage: callable running the stage
+        :param params: inputs and parameters of the stage (part of the checkpoint key)
+        :param files: callable returning the files produced by the stage, given the result of the stage
+        :param chain: if False, the following stages do not depend on this stage
+        :return: result of the stage (None if skipped)
+        """
+
+        if self.checkpoints is None:
+            return stage()
+        key = self.checkpoints.key(name, *params, chain=chain)
+        if self.checkpoints.is_valid(name, key):
+            if chain:
+                self.checkpoints.pending.append((name, key))
+            self.logger.info("Stage '%s' is up to date, skipped", name)
+            return None
+        self.restore_checkpoint()
+        before = {attribute: (value, _signature(value)) for attribute, value in self.__dict__.items()}
+        result = stage()
+        state = None
+        if chain:
+            changed = {attribute: value for attribute, value in self.__dict__.items()
+                       if attribute not in self._TRANSIENT and (attribute not in before
+                                                                or before[attribute][0] is not value
+                                                                or _changed(before[attribute][1], _signature(value)))}
+            state = self._pack(changed)
+        del before
+        self.checkpoints.save(name, key, state, files(result) if files is not None else ())
+        return result
+
+    def restore_checkpoint(self):
+        """Load the attributes set by the skipped stages, if any"""
+
+        if self.checkpoints is None or not self.checkpoints.pending:
+            return
+        for name, key in self.checkpoints.pending:
+            state = self.checkpoints.load(name, key)
+            if state is None:
+                raise RuntimeError(f"The checkpoint of stage '{name}' could not be read. Run again without resuming")
+            # Settings are given by the caller (they are part of the checkpoint keys), they are not restored
+            for attribute in self._SETTINGS:
+                state.pop(attribute, None)
+            self.__setstate__(state)
+        self.logger.info("State restored from the checkpoints of stages %s", [name for name, _ in
+                                                                              self.checkpoints.pending])
+        self.checkpoints.pending = []
 
     def __len__(self):
         """ Length of object is equal to number of
@@ -74,8 +252,15 @@ class Quantifier:
         return "Quantifier object to calculate concentrations from 1D " \
                "NMR data and visualize results"
 
+    @profiled("read_data", output="data")
     def get_data(self, data, excel_sheet=0):
-        """Get data from path or excel file"""
+        """
+        Get data from path or excel file. To process each sheet of a workbook as a separate experiment, read them all
+        in one pass with nmrquant.engine.workbook.read_workbook and give each DataFrame to its own Quantifier.
+
+        :param data: path to the data file, or DataFrame
+        :param excel_sheet: name or position of the sheet to read from an excel file
+        """
 
         if isinstance(data, str):
             try:
@@ -95,16 +280,44 @@ class Quantifier:
         self.spectrum_count = self.data["# Spectrum#"].max()
         self.logger.info("Data has been loaded")
 
+    @profiled("integrate", output="data")
+    def integrate_spectra(self, source, ppm=None, width=DEFAULT_WIDTH, procno=1, strd=1):
+        """
+        Get data by integrating processed spectra on the ppm regions of the database (which must be loaded first)
+
+        :param source: Bruker dataset folder (one experiment folder per spectrum), processing folder or .npy file
+        :param ppm: chemical shift axis of .npy spectra (array or path to a .npy file)
+        :param width: width in ppm of the regions defined by a single ppm position in the database
+        :param procno: processing number of Bruker spectra
+        :param strd: value of the Strd column of the data (1 for internal calibration, 9 for external)
+        """
+
+        if self.database is None:
+            raise ValueError("The database must be loaded before integrating spectra")
+        regions = regions_from_db(self.database, width)
+        self.logger.info("Integrating %s regions...", len(regions))
+        data = integrate_spectra(source, regions, ppm=ppm, procno=procno)
+        data["Strd"] = strd
+        self.get_data(data)
+
+    @profiled("read_database", output="database")
     def get_db(self, database):
         """
         Get database from file or path
 
-        :param database: Can be a file directly or a str containing the path to the file
+        :param database: Can be a file directly or a str containing the path to the file. Several databases (list
+                         in increasing precedence, such as [site, project, user], or dict of level to database) are
+                         merged, entries of higher precedence replacing the others
         """
 
         # TODO: fix Edern's error
 
-        if isinstance(database, str):
+        if isinstance(database, (list, tuple, dict)):
+            databases = database.items() if isinstance(database, dict) else enumerate(database)
+            databases = {key: read_data(db) if isinstance(db, str) else db for key, db in databases}
+            self.database = merge_databases(databases if isinstance(database, dict) else list(databases.values()))
+            self.logger.info("%s databases merged: %s entries", len(databases), len(self.database))
+        elif isinstance(database, str):
             self.database = read_data(database)
             if "Metabolite" not in self.database.columns or "Heq" not in self.database.columns:
                 self.logger.error("'Metabolite' and/or 'Heq' columns not found in file. Please check your database "
@@ -114,16 +327,15 @@ class Quantifier:
         try:
             self.database.sort_values(by="Metabolite", inplace=True)
             if self.database["Heq"].dtypes == object:
-                try:
-                    self.database["Heq"] = self.database["Heq"].apply(
-                        lambda x: x.replace(',', '.'))
-                except AttributeError:
-                    pass
-                except Exception:
-                    raise
+                # Merged databases can mix numbers and strings with decimal commas
+                self.database["Heq"] = self.database["Heq"].apply(
+                    lambda x: x.replace(',', '.') if isinstance(x, str) else x)
                 self.database["Heq"] = pd.to_numeric(self.database["Heq"])
             for _, met, H in self.database[["Metabolite", "Heq"]].itertuples():
                 self.proton_dict.update({met: H})
+            self.expressions.update(read_definitions(self.database))
+            if "Aliases" in self.database.columns:
+                self.aliases.update(read_aliases(self.database))
         except KeyError:
             self.logger.exception('DataFrame error, are you sure you imported the right file?')
         except Exception:
@@ -143,6 +355,7 @@ class Quantifier:
         md.to_excel(rf'{path}/template.xlsx', index=False)
         self.logger.info("Template generated")
 
+    @profiled("read_template", output="metadata")
     def import_md(self, md):
         """Import metadata file after modification from path or file
 
@@ -167,60 +380,149 @@ class Quantifier:
             self.metadata = md
         self.logger.info("Metadata has been loaded")
 
+    def set_aliases(self, aliases):
+        """
+        Add aliases of database names, used to match data columns named differently from the database (ex:
+        'Isoleucine+Leucine' for 'ILE+LEU'). Aliases can also be given in an "Aliases" column of the database.
+
+        :param aliases: dict of alias to database name, or path to a file with "Alias" and "Metabolite" columns
+        """
+
+        self.aliases.update(read_aliases(aliases))
+
+    def set_expressions(self, definitions):
+        """
+        Add definitions of derived columns, computed from the concentrations of the other columns (and of the summed
+        columns such as 'Isoleucine+Leucine'). Examples: 'Leucine = Isoleucine+Leucine - Isoleucine',
+        'Lactate to Pyruvate = Lactate / Pyruvate'. Definitions can also be given in an "Expression" column of the
+        database.
+
+        :param definitions: dict of target to expression, list of 'target = expression' strings or path to a text
+                            file with one definition per line
+        """
+
+        definitions = read_definitions(definitions)
+        self.expressions.update(definitions)
+        self.logger.info("%s expressions have been loaded", len(definitions))
+
+    def import_calibration(self, table):
+        """
+        Import the known concentrations of the calibration spectra, per metabolite, from path or file. The table
+        must contain a "# Spectrum#" column and one column per calibrated metabolite. It takes precedence over the
+        "Calibration" column of the template.
+
+        :param table: Can be a file directly or a str containing the path to the file
+        """
+
+        if isinstance(table, str):
+            table = read_data(table)
+        if "# Spectrum#" not in table.columns:
+            raise KeyError("The calibration table must contain a '# Spectrum#' column")
+        self.calibration_table = table.set_index("# Spectrum#").apply(pd.to_numeric, errors="coerce")
+        self.logger.info("Calibration table has been loaded (%s spectra)", len(self.calibration_table))
+
+    @profiled("merge", output="mdata")
     def _merge_md_data(self):
         """Merge user-defined metadata with dataset"""
 
         self.logger.info("Merging...")
         self.mdata = self.metadata.merge(self.data, on="# Spectrum#")
+        # Text labels are encoded once in natural order, grouping and sorting then run on the integer codes
+        for level in ["Conditions", "Time_Points", "Replicates"]:
+            self.mdata[level] = natural_categorical(self.mdata[level])
         self.mdata.set_index(["Conditions", "Time_Points",
                               "Replicates", "# Spectrum#"], inplace=True)
+        self._cache_levels(self.mdata.index)
+        # Known concentrations of calibration spectra are metadata, not areas
+        if "Calibration" in self.mdata.columns:
+            self.calibration_levels = pd.to_numeric(self.mdata.pop("Calibration"), errors="coerce")
+        # And so are the per-spectrum dilutions, standard concentrations and normalization factors (ex: OD, biomass)
+        factors = [col for col in SPECTRUM_FACTORS if col in self.mdata.columns]
+        self.spectrum_factors = self.mdata[factors].apply(pd.to_numeric, errors="coerce") if factors else None
+        if factors:
+            self.mdata.drop(columns=factors, inplace=True)
+            self.logger.info("Per-spectrum factors found in the template: %s", factors)
         to_del = []
         # self.mdata.replace(0, np.nan, inplace=True)
         for col in self.mdata.columns:
             if "Unnamed" in col:
                 to_del.append(col)
         if to_del:
-            self.logger.info(f"Detected Unnamed columns: {to_del}. Deletion in progress.")
+            self.logger.info("Detected Unnamed columns: %s. Deletion in progress.", to_del)
             self.mdata.drop(axis=1, labels=to_del, inplace=True)
         self.logger.info("Merge done!")
 
+    @profiled("qc", output="qc_data")
+    def check_standard(self):
+        """
+        Quality control of the run on the standard areas of the merged spectra: coefficient of variation, drift
+        against spectrum order and outlying spectra (see nmrquant.engine.qc). The areas of the standard are read from
+        the standard_column of the data, or from the first column named after a usual standard (see
+        qc.find_standard). If normalize_strd is True, the areas of each spectrum are then divided by the area of its
+        standard.
+        """
+
+        column = find_standard(self.mdata.columns, self.standard_column)
+        if column is None:
+            self.strd_data = self.qc_data = self.qc_summary = None
+            wanted = f"'{self.standard_column}'" if self.standard_column else f"any of {list(STANDARD_NAMES)}"
+            return self.logger.warning("No area column of the standard (%s) in the data, quality control%s skipped",
+                                       wanted, " and normalization" if self.normalize_strd else "")
+        spectra = self.mdata.index.get_level_values("# Spectrum#")
+        self.strd_data = pd.Series(self.mdata[column].to_numpy(), name=column, index=spectra)
+        self.qc_data, self.qc_summary = standard_qc(self.strd_data, self.qc_cv_limit, self.qc_drift_limit)
+        summary = self.qc_summary
+        if summary["Status"] == "pass":
+            self.logger.info("Standard QC passed (CV = %.2f %%, drift = %.2f %%)", summary["CV (%)"],
+                             summary["Drift (%)"])
+        else:
+            self.logger.warning("Standard QC %s (CV = %.2f %%, drift = %.2f %%, outlying spectra: %s)",
+                                summary["Status"], summary["CV (%)"], summary["Drift (%)"],
+                                summary["Outlying spectra"] or "none")
+        if self.normalize_strd:
+            self.mdata = normalize_to_standard(self.mdata, self.strd_data)
+            self.logger.info("Areas have been normalized to the standard")
+
+    @profiled("clean", output="cor_data")
     def _clean_cols(self):
         """Sum up double metabolite columns"""
 
         self.logger.info("Cleaning up columns...")
         tmp_dict = {}
-        # Get rid of columns containing + sign because only
-        # useful to calculate other cols (ex: LEU+ILE)
+        # Columns containing + sign are kept apart because they are only
+        # useful to calculate other cols (ex: LEU+ILE, see expressions)
         cols = [c for c in self.mdata.columns if "+" not in c]
-        self.logger.debug(f"Columns: {cols}")
+        self.sum_data = self.mdata[[c for c in self.mdata.columns if "+" in c]]
+        self.logger.debug("Columns: %s", summarize(cols))
         self.mdata = self.mdata[cols]
         del cols  # cleanup
         # Sort index so that numbered metabolites are together
         # which helps with the n_counting
         self.cor_data = self.mdata
         self.cor_data.sort_index(axis=1, inplace=True)
-        self.logger.debug(f"Beginning cor_data = {self.cor_data}")
+        self.logger.debug("Beginning cor_data = %s", summarize(self.cor_data))
         # Get indices where metabolites are double
         for ind, col in enumerate(self.cor_data.columns):
             split = col.split("_")
             if len(split) > 1:  # Else there is no double metabolite
                 append_value(tmp_dict, split[0], ind)
-        self.logger.debug(f"Temp dict = {tmp_dict}")
+        self.logger.debug("Temp dict = %s", summarize(tmp_dict))
         ncount = 0  # Counter for substracting from indices
         if is_empty(tmp_dict):
             return self.logger.info("No double metabolites in data set. Columns are clean")
         else:
             for key, val in tmp_dict.items():
                 dropval = [x - ncount for x in val]  # Real indices after drops
-                self.logger.debug(f"Dropvals = {dropval}")
+                self.logger.debug("Dropvals = %s", dropval)
                 self.cor_data[key] = self.cor_data.iloc[:, dropval[0]] + self.cor_data.iloc[:, dropval[1]]
                 self.cor_data.drop(self.cor_data.columns[dropval],
                                    axis=1, inplace=True)
                 ncount += 2  # Not 1 because the new cols are added at the end of df
-            self.logger.debug(f"End cor_data = {self.cor_data}")
+            self.logger.debug("End cor_data = %s", summarize(self.cor_data))
         self.metabolites = list(self.cor_data.columns)
         return self.logger.info("Data columns have been cleaned")
 
+    @profiled("prepare_db")
     def _prepare_db(self):
         """Prepare database for concentration calculations"""
 
@@ -230,7 +532,7 @@ class Quantifier:
         # spaces there are numbers after (as for clean_cols).
         for key, val in self.proton_dict.items():
             split = key.split("_")
-            self.logger.debug(f"Split = {split}")
+            self.logger.debug("Split = %s", split)
             # Here we check the len of the split. If it is
             # over 1, we get the name of the metabolite
             # and put it in the tmp_dict. The Key is then
@@ -238,18 +540,17 @@ class Quantifier:
             if len(split) > 1:
                 append_value(tmp_dict, split[0], val)
                 removed_values.append(key)
-        self.logger.debug(f"Temp dict = {tmp_dict}")
-        self.logger.debug(f"Removed values = {removed_values}")
+        self.logger.debug("Temp dict = %s", summarize(tmp_dict))
+        self.logger.debug("Removed values = %s", summarize(removed_values))
         if is_empty(tmp_dict):
             return self.logger.info(
                 "No double metabolites in data set. Database entries are clean")
         else:
-            self.logger.debug(tmp_dict)
             # We sum up the values for keys in the tmp dict because they
             # are the total protons for the concerned metabolite.
             tmp_dict = {key: sum(vals) for key, vals in tmp_dict.items()}
-            self.logger.debug(f"Summed temp dict = {tmp_dict}")
-            self.logger.debug(f"Proton dict before del = {self.proton_dict}")
+            self.logger.debug("Summed temp dict = %s", summarize(tmp_dict))
+            self.logger.debug("Proton dict before del = %s", summarize(self.proton_dict))
             # We remove the keys with numbers in the original proton dict
             for key in removed_values:
                 del self.proton_dict[key]
@@ -263,13 +564,40 @@ class Quantifier:
                 self.logger.warning("Python version inferior to 3.9. Please consider "
                                     "upgrading for compatibility reasons in the future")
                 self.proton_dict = {**self.proton_dict, **tmp_dict}
-            self.logger.debug(f"Proton dict after del = {self.proton_dict}")
+            self.logger.debug("Proton dict after del = %s", summarize(self.proton_dict))
         return self.logger.info("Database ready!")
 
+    @profiled("resolve_names", output="name_report")
+    def _resolve_names(self):
+        """
+        Match the data columns to the database names (exact names, aliases, then case and whitespace insensitive
+        names) and report the columns that cannot be matched before computing concentrations
+        """
+
+        resolver = NameResolver(self.proton_dict, self.aliases)
+        columns = list(self.cor_data.columns)
+        if self.sum_data is not None:
+            columns += list(self.sum_data.columns)
+        self.name_report = resolver.report(columns)
+        matched = self.name_report[self.name_report["Match"].isin(["alias", "normalized"])]
+        for name, target in matched["Database name"].items():
+            self.proton_dict[name] = self.proton_dict[target]
+        if not matched.empty:
+            self.logger.info("Columns matched to database names: %s",
+                             {name: target for name, target in matched["Database name"].items()})
+        unresolved = self.name_report[self.name_report["Match"] == "unresolved"]
+        if not unresolved.empty:
+            self.logger.warning("The following columns have no correspondence in the database and will be kept as "
+                                "areas (unless calibrated): %s",
+                                "; ".join(f"{name} (did you mean: {sug}?)" if sug else name
+                                          for name, sug in unresolved["Suggestions"].items()))
+
+    @profiled("concentrations", output="conc_data")
     def calculate_concentrations(self, strd_conc=1):
         """
         Calculate concentrations using number of
-        protons and dilution factor
+        protons and dilution factor. Dilution factors, standard concentrations and normalization factors given per
+        spectrum in the template replace the run values for their spectra.
 
         :param strd_conc: Standard concentration for external calibration. If calibration is internal, concentration
                          is equal to one.
@@ -279,86 +607,414 @@ class Quantifier:
         self.logger.info("Calculating concentrations...")
         # Check for NA and prepare dataframe
         # self.cor_data.fillna(0, inplace=True)
-        self.conc_data = pd.DataFrame(columns=self.cor_data.columns)
         # Multiply areas by dilution factor and standard concentration (equal to 1 if internal calibration)
-        self.logger.debug(f"Dilution factor: {self.dilution_factor}")
-        self.logger.debug(f"Standard Concentration: {strd_conc}")
-        self.logger.debug(f"Dataframe before multiplications: \n {self.cor_data}")
-        self.conc_data = self.cor_data.apply(lambda x: (x * self.dilution_factor * strd_conc))
-        self.logger.debug(f"Dataframe after multiplications: \n {self.conc_data}")
-        self.logger.debug(f"Proton dict before del = {self.proton_dict}")
-        # Divide for each metabolite the values by proton number to get concentrations
-        for col in self.conc_data.columns:
-            missing_from_db = False  # To check if value is missing. If true then add a star in front of met name
-            if col not in self.proton_dict.keys():
-                self.missing_metabolites.append(col)
-                proton_val = 1
-                missing_from_db = True
-                self.logger.debug(f"Renamed column: {col}")
-                self.conc_data.rename(columns={col: col + "_Area"}, inplace=True)
-            else:
-                for key, val in self.proton_dict.items():
-                    if key == col:
-                        proton_val = val
-                        break
-            if missing_from_db:
-                self.conc_data[col + "_Area"] = self.conc_data[col + "_Area"].apply(lambda x: x / proton_val)
-                self.metabolites = list(self.conc_data.columns)
-            else:
-                self.logger.debug(f"Proton value for {col}: {proton_val}")
-                self.logger.debug(f"{col} before division by proton_number: {self.conc_data[col]}")
-                self.conc_data[col] = self.conc_data[col].apply(lambda x: x / proton_val)
-                self.logger.debug(f"{col} after division by proton_number: {self.conc_data[col]}")
-                self.metabolites = list(self.conc_data.columns)
+        self.logger.debug("Dilution factor: %s", self.dilution_factor)
+        self.logger.debug("Standard Concentration: %s", strd_conc)
+        self.logger.debug("Dataframe before multiplications: %s", summarize(self.cor_data))
+        calibrated, calibration_spectra = [], None
+        self.calibration_report = None
+        if self.calibration_levels is not None or self.calibration_table is not None:
+            calibrated, calibration_spectra = self._fit_calibration()
+        # One factor per spectrum, broadcast over all the metabolites at once
+        scale, calibrated_scale = self._spectrum_scales(strd_conc)
+        conc_data = self.cor_data.mul(scale, axis=0)
+        if calibrated:
+            # Calibration curves give concentrations directly from areas, without proton counts or standard
+            conc_data[calibrated] = apply_calibration(self.cor_data[calibrated],
+                                                      self.calibration_report).mul(calibrated_scale, axis=0)
+        self.logger.debug("Dataframe after multiplications: %s", summarize(conc_data))
+        self.logger.debug("Proton dict = %s", summarize(self.proton_dict))
+        # Divide for each metabolite the values by proton number to get concentrations. Metabolites missing from the
+        # database keep their areas and are renamed with an "_Area" suffix
+        to_divide = [col for col in conc_data.columns if col not in calibrated]
+        missing = [col for col in to_divide if col not in self.proton_dict]
+        self.missing_metabolites.extend(missing)
+        protons = pd.Series([self.proton_dict.get(col, 1) for col in to_divide], index=to_divide, dtype=float)
+        self.logger.debug("Proton values: %s", summarize(protons))
+        conc_data[to_divide] = conc_data[to_divide] / protons
+        conc_data = conc_data.rename(columns={col: col + "_Area" for col in missing})
+        if self.expressions:
+            conc_data = self._apply_expressions(conc_data, scale)
+        if calibration_spectra is not None and calibration_spectra.any():
+            # Calibration spectra are not samples
+            conc_data = conc_data[~calibration_spectra]
+        self.conc_data = conc_data
+        self.metabolites = list(conc_data.columns)
+        self._cache_levels(conc_data.index)
         if self.missing_metabolites:
-            self.logger.warning(f"The following metabolites have no correspondence in the database: "
-                                f"\n{self.missing_metabolites}")
+            self.logger.warning("The following metabolites have no correspondence in the database: \n%s",
+                                self.missing_metabolites)
         self.logger.info("Concentrations have been calculated")
 
+    def _spectrum_scales(self, strd_conc):
+        """
+        Factors applied to the areas of each spectrum: dilution factor x standard concentration / normalization
+        factor, taken from the template columns when given and from the run values otherwise
+
+        :param strd_conc: Concentration of standard molecule used for the spectra without their own
+        :return: tuple (factors of the concentrations computed from proton counts, factors of the concentrations
+                 computed from calibration curves, which do not depend on the standard)
+        """
+
+        index = self.cor_data.index
+        factors = pd.DataFrame(index=index) if self.spectrum_factors is None else \
+            self.spectrum_factors.reindex(index)
+
+        def column(name, default):
+            if name not in factors.columns:
+                return np.full(len(index), float(default))
+            return factors[name].fillna(default).to_numpy(dtype=float)
+
+        dilution = column("Dilution", self.dilution_factor)
+        standard = column("Strd_Concentration", strd_conc)
+        normalization = column("Normalization", 1)
+        if (normalization == 0).any():
+            raise ValueError(f"Null normalization factors for spectra "
+                             f"{list(index.get_level_values('# Spectrum#')[normalization == 0])}")
+        self.logger.debug("Per-spectrum factors: dilution %s, standard %s, normalization %s", summarize(dilution),
+                          summarize(standard), summarize(normalization))
+        return pd.Series(dilution * standard / normalization, index=index), \
+            pd.Series(dilution / normalization, index=index)
+
+    def _apply_expressions(self, conc_data, scale):
+        """
+        Compute the derived columns from the concentrations in one vectorized evaluation. Summed columns overlap
+        several metabolites and have no proton count of their own: expressions using them are evaluated on proton
+        weighted concentrations (see _weight_by_protons).
+
+        :param conc_data: DataFrame of concentrations
+        :param scale: factor of each spectrum (dilution factor x standard concentration / normalization factor)
+        :return: conc_data with the derived columns
+        """
+
+        available, summed = conc_data, []
+        if self.sum_data is not None and not self.sum_data.empty:
+            summed = list(self.sum_data.columns)
+            sums = self.sum_data.loc[conc_data.index]
+            available = pd.concat([conc_data, sums.mul(scale.loc[conc_data.index], axis=0)], axis=1)
+        valid = {}
+        for target, expression in self.expressions.items():
+            try:
+                valid[target] = self._weight_by_protons(target, parse_expression(expression, available.columns),
+                                                        summed)
+            except (KeyError, ValueError) as err:
+                self.logger.error("Expression for %s could not be compiled: %s", target, err)
+        if not valid:
+            return conc_data
+        compiled = CompiledExpressions(valid, available.columns)
+        self.logger.debug("Compiled expressions: %s", compiled)
+        results = compiled.evaluate(available)
+        replaced = [target for target in results.columns if target in conc_data.columns]
+        if replaced:
+            self.logger.warning("Columns replaced by their expression: %s", replaced)
+        for target in results.columns:
+            conc_data[target] = results[target]
+        self.logger.info("%s derived columns have been computed", len(results.columns))
+        return conc_data
+
+    def _weight_by_protons(self, target, parsed, summed):
+        """
+        Convert an expression using summed columns to concentrations. A summed area is the sum of the areas of the
+        overlapping metabolites, each proportional to its concentration times its proton count, so the other columns
+        are multiplied by their proton count and the result is divided by the proton count of the target
+        ('Leucine = Isoleucine+Leucine - Isoleucine' gives ([Ile] x H_Ile + [Leu] x H_Leu - [Ile] x H_Ile) / H_Leu).
+
+        :param target: name of the derived column
+        :param parsed: parsed expression (see parse_expression)
+        :param summed: names of the summed columns, given as proton weighted concentrations
+        :return: parsed expression on the columns as given
+        """
+
+        numerator, denominator = parsed
+        if not any(name in summed for part in parsed for name in part):
+            return parsed
+        if set(denominator) != {None}:
+            raise ValueError(f"summed columns ({summed}) cannot be used in ratios")
+        target_protons = self.proton_dict.get(target, np.nan)
+        if pd.isna(target_protons) or target_protons == 0:
+            raise ValueError(f"no proton count in the database for {target}, needed to convert the summed columns")
+        weighted = {}
+        for name, coef in numerator.items():
+            # Columns missing from the database are kept as areas (one proton)
+            protons = 1 if name is None or name in summed else self.proton_dict.get(name, 1)
+            weighted[name] = coef * protons / target_protons
+        return weighted, denominator
+
+    def _fit_calibration(self):
+        """
+        Fit calibration curves of every metabolite on the calibration spectra
+
+        :return: tuple (list of metabolites with a valid curve, boolean mask of the calibration spectra)
+        """
+
+        levels = pd.DataFrame(np.nan, index=self.cor_data.index, columns=self.cor_data.columns)
+        if self.calibration_levels is not None:
+            template_levels = self.calibration_levels.reindex(self.cor_data.index).to_numpy()
+            levels[:] = np.broadcast_to(template_levels[:, None], levels.shape)
+        if self.calibration_table is not None:
+            spectra = self.cor_data.index.get_level_values("# Spectrum#")
+            table = self.calibration_table.reindex(index=spectra, columns=self.cor_data.columns).to_numpy()
+            levels = levels.where(np.isnan(table), table)
+        calibration_spectra = levels.notna().any(axis=1).to_numpy()
+        if not calibration_spectra.any():
+            self.logger.warning("No calibration spectra found. Concentrations are calculated from proton counts")
+            return [], calibration_spectra
+        self.logger.info("Fitting %s calibration curves on %s spectra...", self.cor_data.shape[1],
+                         calibration_spectra.sum())
+        self.calibration_report = fit_calibration(self.cor_data[calibration_spectra], levels[calibration_spectra],
+                                                  self.calibration_model, self.calibration_weighting)
+        valid = self.calibration_report["slope"].notna()
+        if not valid.all():
+            self.logger.warning("No calibration curve could be fitted for: %s. Their concentrations are calculated "
+                                "from proton counts", list(self.calibration_report.index[~valid]))
+        self.logger.debug("Calibration report: %s", summarize(self.calibration_report))
+        return list(self.calibration_report.index[valid]), calibration_spectra
+
+    def _cache_levels(self, index):
+        """
+        Cache the labels of the conditions, time points and replicates present in the data (in natural order)
+
+        :param index: MultiIndex of the data
+        """
+
+        index = index.remove_unused_levels()
+        for level, attribute in [("Conditions", "conditions"), ("Time_Points", "time_points"),
+                                 ("Replicates", "replicates")]:
+            if level in index.names:
+                setattr(self, attribute, list(index.levels[index.names.index(level)]))
+
+    @profiled("mean", output="mean_data")
     def _get_mean(self):
         """Make dataframe meaned on replicates"""
 
         self.mean_data = self.conc_data.droplevel("# Spectrum#")
         self.mean_data = self.conc_data.groupby(
-            ["Conditions", "Time_Points"]).mean()
+            ["Conditions", "Time_Points"], observed=True).mean()
         self.std_data = self.conc_data.groupby(
-            ["Conditions", "Time_Points"]).std()
+            ["Conditions", "Time_Points"], observed=True).std()
         return self.logger.info("Means and standard deviations have been calculated")
 
+    @profiled("outliers", output="outlier_report")
+    def screen_outliers(self, method="mad", threshold=3.5, alpha=0.05, mask=False):
+        """
+        Screen the replicates of every condition, time point and metabolite for outliers
+
+        :param method: 'mad' (robust z-scores), 'grubbs' (iterated Grubbs test) or 'dixon' (Dixon Q test)
+        :param threshold: robust z-score above which a value is an outlier (mad method)
+        :param alpha: significance level of the Grubbs and Dixon tests
+        :param mask: if True, outliers are replaced by NaN in the concentrations so that they are left out of the
+                     means and statistics computed afterwards
+        :return: self.outlier_report: outliers ranked from the most to the least extreme
+        """
+
+        if self.conc_data is None:
+            raise ValueError("Concentrations must be calculated before screening for outliers")
+        self.logger.info("Screening replicates for outliers (%s)...", method)
+        self.outlier_mask, self.outlier_report = detect_outliers(self.conc_data, method, threshold, alpha)
+        if self.outlier_report.empty:
+            self.logger.info("No outliers detected")
+        else:
+            self.logger.warning("%s outliers detected. Most extreme: %s", len(self.outlier_report),
+                                summarize(self.outlier_report.head()))
+        if mask:
+            self.conc_data = self.conc_data.mask(self.outlier_mask)
+            self.logger.info("Outliers have been masked in the concentrations")
+        return self.outlier_report
+
+    @profiled("uncertainty", output="uncertainty_data")
+    def compute_uncertainty(self, n_resamples=2000, confidence=0.95, method="bootstrap", dilution_rsd=0.0,
+                            strd_rsd=0.0, seed=None):
+        """
+        Compute confidence intervals of the replicate means for every condition, time point and metabolite
+
+        :param n_resamples: number of bootstrap/Monte Carlo resamples
+        :param confidence: confidence level of the intervals
+        :param method: 'bootstrap' to resample replicates, 'montecarlo' to only propagate the dilution factor and
+                       standard concentration uncertainties
+        :param dilution_rsd: relative standard deviation of the dilution factor (ex: 0.02 for 2%)
+        :param strd_rsd: relative standard deviation of the standard concentration
+        :param seed: seed for reproducible results
+        :return: self.uncertainty_data: tidy DataFrame with means, standard errors and interval bounds
+        """
+
+        if self.conc_data is None:
+            raise ValueError("Concentrations must be calculated before estimating their uncertainty")
+        self.logger.info("Estimating uncertainty (%s, %s resamples)...", method, n_resamples)
+        self.uncertainty_data = confidence_intervals(self.conc_data, n_resamples, confidence, method,
+                                                     dilution_rsd, strd_rsd, seed)
+        self.logger.info("Confidence intervals have been calculated")
+        return self.uncertainty_data
+
+    @profiled("statistics", output="statistics_data")
+    def compare_conditions(self, test="welch", control=None, pairs=None):
+        """
+        Test the differences of concentrations between conditions for every metabolite and time point
+
+        :param test: 'welch' (Welch t-test) or 'mannwhitney' (Mann-Whitney U test)
+        :param control: reference condition. If given, every condition is compared to it, else all pairs of
+                        conditions are compared
+        :param pairs: explicit list of (reference, condition) pairs to compare
+        :return: self.statistics_data: tidy DataFrame with effect sizes and Benjamini-Hochberg adjusted p-values
+        """
+
+        if self.conc_data is None:
+            raise ValueError("Concentrations must be calculated before comparing conditions")
+        self.logger.info("Comparing conditions (%s test)...", test)
+        self.statistics_data = compare_conditions(self.conc_data, test, control, pairs)
+        self.logger.info("%s tests run, %s significant at 5%% FDR", len(self.statistics_data),
+                         int((self.statistics_data["p_adjusted"] < 0.05).sum()))
+        return self.statistics_data
+
+    @profiled("kinetics", output="kinetics_data")
+    def compute_kinetics(self, initial_points=3):
+        """
+        Fit slopes, initial rates and exponential models on the time course of every metabolite, for each replicate
+        and for each condition (replicates pooled)
+
+        :param initial_points: number of time points used to estimate initial rates
+        :return: self.kinetics_data: rates and their standard errors for each condition, replicate and metabolite
+        """
+
+        if self.conc_data is None:
+            raise ValueError("Concentrations must be calculated before estimating kinetic rates")
+        self.logger.info("Fitting kinetic models...")
+        self.kinetics_data = fit_kinetics(self.conc_data, ("Conditions", "Replicates"), initial_points)
+        self.condition_kinetics = fit_kinetics(self.conc_data, ("Conditions",), initial_points)
+        self.logger.info("Kinetic rates have been estimated")
+        return self.kinetics_data
+
+    @profiled("export", output="conc_data")
     def export_data(self, destination, file_name='', fmt="excel", export_mean=False):
-        """Export final data in desired format"""
+        """
+        Export final data in desired format
+
+        :return: path of the exported file (None if nothing was exported)
+        """
 
         # Get current date & time
         date_time = datetime.now().strftime("%d%m%Y %Hh%Mmn")
         name = file_name + '_' + date_time
+        path = None
         # Output to multi-page excel file
         if fmt == "excel":
-            with pd.ExcelWriter(r"{}/{}.xlsx".format(str(destination), name)) as writer:
+            path = Path(destination) / f"{name}.xlsx"
+            with pd.ExcelWriter(path) as writer:
                 self.mdata.to_excel(writer, sheet_name='Raw Data')
                 self.conc_data.to_excel(writer, sheet_name='Concentrations Data')
                 if export_mean:
                     self.mean_data.to_excel(writer, sheet_name='Meaned Data')
                     self.std_data.to_excel(writer, sheet_name='Stds')
-        return self.logger.info("Data Exported")
+                if self.uncertainty_data is not None:
+                    self.uncertainty_data.to_excel(writer, sheet_name='Uncertainty')
+                if self.calibration_report is not None:
+                    self.calibration_report.to_excel(writer, sheet_name='Calibration')
+                if self.statistics_data is not None:
+                    self.statistics_data.to_excel(writer, sheet_name='Statistics')
+                if self.kinetics_data is not None:
+                    self.kinetics_data.to_excel(writer, sheet_name='Kinetics')
+                    self.condition_kinetics.to_excel(writer, sheet_name='Kinetics Conditions')
+                if self.outlier_report is not None:
+                    self.outlier_report.to_excel(writer, sheet_name='Outliers')
+                    self.outlier_mask.to_excel(writer, sheet_name='Outlier Mask')
+                if self.name_report is not None and (self.name_report["Match"] != "exact").any():
+                    self.name_report.to_excel(writer, sheet_name='Names')
+                if self.qc_summary is not None:
+                    self.qc_summary.to_frame().to_excel(writer, sheet_name='QC')
+                    self.qc_data.to_excel(writer, sheet_name='QC Spectra')
+        self.logger.info("Data Exported")
+        return path
+
+    def to_cube(self):
+        """
+        Concentrations as a labeled 4-D array (conditions x time points x replicates x metabolites), with NaN for
+        missing replicates
+
+        :return: LabeledCube
+        """
+
+        if self.conc_data is None:
+            raise RuntimeError("Concentrations must be calculated before building the cube")
+        return LabeledCube.from_frame(self.conc_data)
+
+    @profiled("export_cube")
+    def export_cube(self, destination, file_name='', chunks=None):
+        """
+        Export the concentration cube to a chunked and compressed Zarr store, from which single slices can be read
+        (see nmrquant.engine.cube.read_zarr)
+
+        :param destination: folder of the store
+        :param file_name: name of the store (the date and time are appended as for export_data)
+        :param chunks: chunk shape (default: one chunk per condition and block of metabolites)
+        :return: path of the store
+        """
+
+        date_time = datetime.now().strftime("%d%m%Y %Hh%Mmn")
+        path = self.to_cube().to_zarr(Path(destination) / f"{file_name}_{date_time}.zarr", chunks)
+        self.logger.info("Concentration cube exported to %s", path)
+        return path
 
-    def compute_data(self, strd_conc=None, mean=False):
+    @property
+    def profile_report(self):
+        """Per-stage timing and memory report (empty if profiling is disabled)"""
+
+        return self.profiler.report
+
+    def export_profile(self, destination, file_name=''):
+        """
+        Write the profiling report as json in the destination folder
+
+        :param destination: folder in which to write the report
+        :param file_name: prefix for the report file name
+        """
+
+        if not self.profiler.enabled:
+            return self.logger.warning("Profiling is not enabled, no report to export")
+        name = f"{file_name}_profile.json" if file_name else "profile.json"
+        self.profiler.dump(rf"{str(destination)}/{name}")
+        return self.logger.info("Profiling report exported to %s", name)
+
+    def compute_data(self, strd_conc=None, mean=False, progress=None):
         """
         Run data preparation and computation of concentrations (if strd_conc is not None, else just prepare data)
 
         :param strd_conc: Concentration of standard molecule used (1 if concentration is not needed). Set to None if
         concentrations must not be calculated
         :param mean: should means be computed
+        :param progress: optional callable called before each stage with the stage name, the stage index and the
+                         number of stages. An exception raised by the callable interrupts the computation.
         """
+        self.restore_checkpoint()
         for data in [self.database, self.data, self.metadata]:
             if not isinstance(data, pd.DataFrame):
                 raise ValueError(f"Data is missing for computation. Missing data: {data}")
-        self._merge_md_data()
-        self._clean_cols()
-        self._prepare_db()
+        stages = [("merge", self._merge_md_data),
+                  ("qc", self.check_standard),
+                  ("clean", self._clean_cols),
+                  ("prepare_db", self._prepare_db),
+                  ("resolve_names", self._resolve_names)]
         if strd_conc:
-            self.calculate_concentrations(strd_conc)
+            stages.append(("concentrations", lambda: self.calculate_concentrations(strd_conc)))
+        if strd_conc and self.outlier_method:
+            stages.append(("outliers", lambda: self.screen_outliers(self.outlier_method, self.outlier_threshold,
+                                                                    self.outlier_alpha, self.mask_outliers)))
         if mean:
-            self._get_mean()
+            stages.append(("mean", self._get_mean))
+        # Parameters of each stage (for the checkpoint keys). Without a previous stage, the inputs are hashed too
+        inputs = () if self.checkpoints is None or self.checkpoints.stages else \
+            (self.data, self.metadata, self.database, self.aliases, self.expressions,
+             self.calibration_table)
+        params = {"merge": inputs,
+                  "qc": (self.normalize_strd, self.standard_column, self.qc_cv_limit, self.qc_drift_limit),
+                  "resolve_names": (self.aliases,),
+                  "concentrations": (strd_conc, self.dilution_factor, self.expressions, self.calibration_model,
+                                     self.calibration_weighting),
+                  "outliers": (self.outlier_method, self.outlier_threshold, self.outlier_alpha, self.mask_outliers)}
+        for ind, (name, stage) in enumerate(stages):
+            if progress is not None:
+                progress(name, ind, len(stages))
+            self.run_stage(name, stage, *params.get(name, ()))
+        self.restore_checkpoint()
+
 
 if __name__ == "__main__":
     test = Quantifier(True)
@@ -0,0 +1,95 @@
+"""Module containing the multi-point external calibration of metabolite areas"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.calibration")
+
+MODELS = ("linear", "proportional")
+WEIGHTINGS = (None, "1/x", "1/x2")
+
+
+def fit_calibration(areas, levels, model="linear", weighting=None):
+    """
+    Fit calibration curves (concentration = slope * area + intercept) for all metabolites in one vectorized weighted
+    least-squares solve. Missing values (NaN areas or levels) are left out of the fit of the concerned metabolite.
+
+    :param areas: DataFrame of areas of the calibration spectra (one row per spectrum, one column per metabolite)
+    :param levels: known concentrations of the calibration spectra. Either a Series (same concentration for all the
+                   metabolites of a spectrum) aligned on the rows of areas, or a DataFrame with the same shape as areas
+    :param model: 'linear' (slope and intercept) or 'proportional' (curve through the origin)
+    :param weighting: None, '1/x' or '1/x2' (x being the known concentration)
+    :return: DataFrame indexed by metabolite with the slope, intercept, standard error of the slope, coefficient of
+             determination, residual standard error and number of calibration points
+    """
+
+    if model not in MODELS:
+        raise ValueError(f"Unknown calibration model: {model}. Choose from {MODELS}")
+    if weighting not in WEIGHTINGS:
+        raise ValueError(f"Unknown calibration weighting: {weighting}. Choose from {WEIGHTINGS}")
+    x = areas.to_numpy(dtype=float)
+    if isinstance(levels, pd.DataFrame):
+        y = levels.reindex(index=areas.index, columns=areas.columns).to_numpy(dtype=float)
+    else:
+        y = np.broadcast_to(np.asarray(levels, dtype=float)[:, None], x.shape)
+    used = ~np.isnan(x) & ~np.isnan(y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if weighting == "1/x":
+            w = 1 / np.abs(y)
+        elif weighting == "1/x2":
+            w = 1 / y ** 2
+        else:
+            w = np.ones_like(x)
+    w = np.where(used & np.isfinite(w), w, 0.0)
+    x, y = np.where(used, x, 0.0), np.where(used, y, 0.0)
+    n = (w > 0).sum(axis=0)
+
+    # Weighted sums for all metabolites at once
+    sw, sx, sy = w.sum(0), (w * x).sum(0), (w * y).sum(0)
+    sxx, sxy = (w * x * x).sum(0), (w * x * y).sum(0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if model == "linear":
+            denominator = sw * sxx - sx ** 2
+            slope = (sw * sxy - sx * sy) / denominator
+            intercept = (sy - slope * sx) / sw
+            dof = n - 2
+        else:
+            denominator = sxx
+            slope = sxy / sxx
+            intercept = np.zeros_like(slope)
+            dof = n - 1
+        residuals = np.where(w > 0, y - (slope * x + intercept), 0.0)
+        ss_res = (w * residuals ** 2).sum(0)
+        if model == "linear":
+            ss_tot = (w * (y - sy / sw) ** 2).sum(0)
+        else:
+            ss_tot = (w * y ** 2).sum(0)
+        r2 = 1 - ss_res / ss_tot
+        rse = np.sqrt(ss_res / dof)
+        slope_se = rse * np.sqrt((sw if model == "linear" else 1) / denominator)
+    enough = dof > 0
+    report = pd.DataFrame({
+        "slope": slope,
+        "intercept": intercept,
+        "slope_se": np.where(enough, slope_se, np.nan),
+        "r2": r2,
+        "rse": np.where(enough, rse, np.nan),
+        "n_points": n,
+    }, index=pd.Index(areas.columns, name="Metabolite"))
+    # Curves that cannot be fitted (not enough points or constant areas) are flagged with NaN slopes
+    report.loc[(n < 2) | ~np.isfinite(report["slope"]), ["slope", "intercept"]] = np.nan
+    return report
+
+
+def apply_calibration(areas, fits):
+    """
+    Convert areas to concentrations with fitted calibration curves, for all spectra and metabolites at once
+
+    :param areas: DataFrame of areas (one column per metabolite)
+    :param fits: calibration report from fit_calibration
+    :return: DataFrame of concentrations. Metabolites without a valid curve are NaN.
+    """
+
+    fits = fits.reindex(areas.columns)
+    return areas * fits["slope"].to_numpy() + fits["intercept"].to_numpy()
@@ -0,0 +1,183 @@
+"""Module containing the on-disk checkpoints of the pipeline stages, used to resume interrupted or modified runs"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.checkpoints")
+
+# Number of checkpoints kept per stage (runs with different parameters can be resumed alternately)
+KEEP = 3
+
+# Stages of a command line run, in order
+STAGES = ["ingest", "merge", "qc", "clean", "prepare_db", "resolve_names", "concentrations", "outliers", "mean",
+          "uncertainty", "statistics", "kinetics", "export", "export_cube", "plot_qc", "plot_individual_histograms",
+          "plot_meaned_histograms", "plot_individual_lineplots", "plot_meaned_lineplots", "plot_heatmaps"]
+
+
+def _update(digest, value):
+    """Feed a value to a hash object (DataFrames are hashed on their content, files on their size and date)"""
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+        digest.update(repr((value.shape, labels, list(value.index.names))).encode())
+        try:
+            digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        except TypeError:
+            # Unhashable cells (lists...)
+            digest.update(value.to_csv().encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.shape, value.dtype.str)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b"{")
+        for key in sorted(value, key=repr):
+            _update(digest, key)
+            _update(digest, value[key])
+        digest.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"[")
+        for item in value:
+            _update(digest, item)
+        digest.update(b"]")
+    elif isinstance(value, Path):
+        stat = value.stat() if value.exists() else None
+        digest.update(repr((str(value.absolute()), stat and stat.st_size, stat and stat.st_mtime_ns)).encode())
+    else:
+        digest.update(repr(value).encode())
+
+
+def fingerprint(*values):
+    """
+    Hash of the inputs and parameters of a stage
+
+    :param values: DataFrames, arrays, paths (hashed on their path, size and modification date), containers or any
+                   value with a stable repr
+    :return: hexadecimal digest
+    """
+
+    digest = hashlib.sha256()
+    for value in values:
+        _update(digest, value)
+    return digest.hexdigest()
+
+
+class CheckpointStore:
+    """
+    Checkpoints of the pipeline stages, stored in a folder as one pickle per stage (holding the attributes set by the
+    stage) and a manifest. The key of a stage is a hash of its parameters and of the key of the previous stage, so that
+    a change of inputs invalidates all the following stages. On resume, a stage whose checkpoint is valid is skipped
+    and the states of the skipped stages are only loaded, in order, when a later stage must be executed.
+    """
+
+    def __init__(self, folder, resume=False, from_stage=None):
+        """
+        :param folder: folder of the checkpoints (created if needed)
+        :param resume: reuse the valid checkpoints of a previous run
+        :param from_stage: recompute this stage and the following ones (implies resume)
+        """
+
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.resume = resume or from_stage is not None
+        self.from_stage = from_stage
+        self._forced = False
+        self._key = ""
+        # Skipped stages whose state has not been loaded yet
+        self.pending = []
+        self.stages = []
+        manifest = self.folder / "manifest.json"
+        try:
+            self.manifest = json.loads(manifest.read_text()) if manifest.is_file() else {}
+        except ValueError:
+            mod_logger.warning("Unreadable checkpoint manifest in %s, checkpoints are ignored", self.folder)
+            self.manifest = {}
+
+    def __repr__(self):
+        return f"CheckpointStore({self.folder}, resume={self.resume}, from_stage={self.from_stage})"
+
+    def key(self, name, *params, chain=True):
+        """
+        Key of the next stage, chained to the previous stage
+
+        :param name: name of the stage
+        :param params: inputs and parameters of the stage
+        :param chain: if False, the stage is a branch: the following stages do not depend on it
+        :return: key of the stage
+        """
+
+        key = fingerprint(self._key, name, params)
+        if chain:
+            self._key = key
+        self.stages.append(name)
+        if name == self.from_stage:
+            self._forced = True
+        return key
+
+    def _path(self, name, key):
+        return self.folder / f"{name}-{key[:16]}.pkl"
+
+    def is_valid(self, name, key):
+        """
+        Check if a stage can be skipped: resume is on, the stage is not forced, and its checkpoint exists with the
+        same key and with all the files it produced
+        """
+
+        if not self.resume or self._forced:
+            return False
+        entry = self.manifest.get(name, {}).get(key)
+        if entry is None or (entry.get("file") is not None and not self._path(name, key).is_file()):
+            return False
+        return all(Path(file).exists() for file in entry.get("files", []))
+
+    def save(self, name, key, state, files=()):
+        """
+        Write the checkpoint of a stage
+
+        :param name: name of the stage
+        :param key: key of the stage
+        :param state: picklable state set by the stage (None for stages whose state is not needed afterwards)
+        :param files: files produced by the stage (the checkpoint is invalid if one of them is removed)
+        """
+
+        path = self._path(name, key)
+        if state is not None:
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "wb") as handle:
+                pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        entries = self.manifest.setdefault(name, {})
+        entries.pop(key, None)
+        entries[key] = {"file": None if state is None else path.name, "files": [str(file) for file in files],
+                        "time": datetime.now().isoformat(timespec="seconds")}
+        # Oldest checkpoints of the stage are removed
+        for old in list(entries)[:-KEEP]:
+            self._path(name, old).unlink(missing_ok=True)
+            del entries[old]
+        self._write_manifest()
+        mod_logger.debug("Checkpoint written for stage '%s' (%s)", name, path.name)
+
+    def load(self, name, key):
+        """
+        Read the checkpoint of a stage
+
+        :return: state set by the stage, or None if it cannot be read
+        """
+
+        try:
+            with open(self._path(name, key), "rb") as handle:
+                return pickle.load(handle)
+        except Exception as err:
+            mod_logger.warning("Checkpoint of stage '%s' could not be read (%s)", name, err)
+            return None
+
+    def _write_manifest(self):
+        tmp = self.folder / "manifest.json.tmp"
+        tmp.write_text(json.dumps(self.manifest, indent=4))
+        os.replace(tmp, self.folder / "manifest.json")
@@ -0,0 +1,262 @@
+"""Module containing the labeled 4-D concentration cube and its chunked on-disk storage (Zarr v2 layout)"""
+import json
+import logging
+import zlib
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from nmrquant.engine.utilities import natural_categorical
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.cube")
+
+DIMS = ("Conditions", "Time_Points", "Replicates", "Metabolite")
+
+# Metabolites per chunk in the default chunk shape (one chunk per condition and metabolite block)
+METABOLITE_CHUNK = 16
+
+ZLIB_LEVEL = 5
+
+
+class LabeledCube:
+    """
+    Concentrations as a labeled array over conditions, time points, replicates and metabolites. Missing replicates
+    are NaN. Labels of each dimension are kept in coords (dimension name to pd.Index).
+    """
+
+    def __init__(self, values, coords, dims=DIMS):
+        """
+        :param values: array with one axis per dimension
+        :param coords: dict of dimension name to labels
+        :param dims: names of the dimensions
+        """
+
+        self.values = np.asarray(values, dtype=float)
+        self.dims = tuple(dims)
+        self.coords = {dim: pd.Index(coords[dim], name=dim) for dim in self.dims}
+        expected = tuple(len(self.coords[dim]) for dim in self.dims)
+        if self.values.shape != expected:
+            raise ValueError(f"Values of shape {self.values.shape} do not match the coordinates {expected}")
+
+    @classmethod
+    def from_frame(cls, data):
+        """
+        Build the cube from concentrations indexed by conditions, time points and replicates (Quantifier.conc_data)
+
+        :param data: DataFrame with one column per metabolite
+        :return: LabeledCube
+        """
+
+        levels = list(DIMS[:-1])
+        missing = [lvl for lvl in levels if lvl not in data.index.names]
+        if missing:
+            raise KeyError(f"{missing} missing from the index of the data")
+        coords, positions = {}, []
+        for level in levels:
+            # Labels are sorted in natural order
+            labels = natural_categorical(pd.Series(data.index.get_level_values(level)))
+            codes, labels = pd.factorize(labels, sort=True)
+            coords[level] = labels
+            positions.append(codes)
+        duplicated = pd.MultiIndex.from_arrays(positions).duplicated()
+        if duplicated.any():
+            raise ValueError(f"Several spectra share the same condition, time point and replicate: "
+                             f"{list(data.index[duplicated])}")
+        coords["Metabolite"] = data.columns
+        values = np.full(tuple(len(labels) for labels in coords.values()), np.nan)
+        values[tuple(positions)] = data.to_numpy(dtype=float)
+        return cls(values, coords)
+
+    def __repr__(self):
+        sizes = ", ".join(f"{dim}: {len(self.coords[dim])}" for dim in self.dims)
+        return f"LabeledCube({sizes})"
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def sel(self, **labels):
+        """
+        Select labels along dimensions. A single label drops its dimension, a list of labels keeps it.
+
+        :param labels: dimension name to label or list of labels
+        :return: LabeledCube, or the value if all the dimensions are dropped
+        """
+
+        unknown = set(labels) - set(self.dims)
+        if unknown:
+            raise KeyError(f"Unknown dimensions: {sorted(unknown)}. Dimensions are {self.dims}")
+        keys, dims, coords = [], [], {}
+        for dim in self.dims:
+            index = self.coords[dim]
+            if dim not in labels:
+                keys.append(slice(None))
+            elif np.ndim(labels[dim]) == 0:
+                keys.append(index.get_loc(labels[dim]))
+                continue
+            else:
+                positions = index.get_indexer(labels[dim])
+                if (positions < 0).any():
+                    raise KeyError(f"Labels not found in {dim}: {list(np.asarray(labels[dim])[positions < 0])}")
+                keys.append(positions)
+            dims.append(dim)
+            coords[dim] = index[keys[-1]]
+        # Integer arrays are applied one axis at a time so that they select along their own axis only
+        values = self.values
+        for axis, key in reversed(list(enumerate(keys))):
+            values = values[(slice(None),) * axis + (key,)]
+        if not dims:
+            return float(values)
+        return LabeledCube(values, coords, dims)
+
+    def to_frame(self):
+        """
+        Flatten the cube back to a table with one column per metabolite (rows of missing replicates are dropped)
+
+        :return: DataFrame indexed by the other dimensions
+        """
+
+        if self.dims[-1] != "Metabolite":
+            raise ValueError("Only cubes with a Metabolite dimension can be flattened")
+        index = pd.MultiIndex.from_product([self.coords[dim] for dim in self.dims[:-1]], names=self.dims[:-1])
+        frame = pd.DataFrame(self.values.reshape(-1, self.values.shape[-1]), index=index,
+                             columns=self.coords["Metabolite"].rename(None))
+        return frame.dropna(how="all")
+
+    def to_zarr(self, path, chunks=None):
+        """
+        Write the cube to a Zarr v2 directory store: one zlib-compressed file per chunk and one 1-D array per
+        coordinate. The store can be opened with zarr or xarray, or read back slice by slice with read_zarr.
+
+        :param path: directory of the store (created if needed)
+        :param chunks: chunk shape (default: one chunk per condition and block of metabolites)
+        :return: path of the store
+        """
+
+        path = Path(path)
+        if chunks is None:
+            chunks = (1,) + self.shape[1:-1] + (min(METABOLITE_CHUNK, self.shape[-1]),)
+        chunks = tuple(max(1, int(min(size, chunk))) for size, chunk in zip(self.shape, chunks))
+        path.mkdir(parents=True, exist_ok=True)
+        _write_json(path / ".zgroup", {"zarr_format": 2})
+        _write_json(path / ".zattrs", {"description": "NMRQuant concentrations"})
+        _write_array(path / "concentrations", self.values, chunks, self.dims)
+        for dim in self.dims:
+            _write_array(path / dim, _coordinate_values(self.coords[dim]), None, (dim,))
+        mod_logger.debug("Cube of shape %s written to %s with chunks %s", self.shape, path, chunks)
+        return path
+
+
+def _write_json(path, content):
+    path.write_text(json.dumps(content, indent=4))
+
+
+def _coordinate_values(index):
+    values = np.asarray(index)
+    if values.dtype.kind in "biuf":
+        return values
+    return values.astype(str)
+
+
+def _zarr_dtype(dtype):
+    if dtype.kind == "U":
+        return f"<U{dtype.itemsize // 4}"
+    return ("|" if dtype.itemsize == 1 else "<") + dtype.kind + str(dtype.itemsize)
+
+
+def _write_array(path, values, chunks, dims):
+    values = np.asarray(values)
+    values = values.astype(values.dtype.newbyteorder("<"), copy=False)
+    chunks = tuple(chunks) if chunks is not None else values.shape
+    path.mkdir(exist_ok=True)
+    floating = values.dtype.kind == "f"
+    _write_json(path / ".zarray", {"zarr_format": 2, "shape": list(values.shape), "chunks": list(chunks),
+                                   "dtype": _zarr_dtype(values.dtype), "compressor": {"id": "zlib",
+                                                                                      "level": ZLIB_LEVEL},
+                                   "fill_value": "NaN" if floating else None, "order": "C", "filters": None,
+                                   "dimension_separator": "."})
+    _write_json(path / ".zattrs", {"_ARRAY_DIMENSIONS": list(dims)})
+    counts = [-(-size // chunk) for size, chunk in zip(values.shape, chunks)]
+    for chunk_id in product(*[range(count) for count in counts]):
+        block = values[tuple(slice(i * c, (i + 1) * c) for i, c in zip(chunk_id, chunks))]
+        # Chunks entirely made of missing values are not written (readers use the fill value)
+        if floating and np.isnan(block).all():
+            continue
+        if block.shape != chunks:
+            # Edge chunks are stored with the full chunk shape
+            padded = np.full(chunks, np.nan if floating else 0, dtype=values.dtype)
+            padded[tuple(slice(0, size) for size in block.shape)] = block
+            block = padded
+        (path / ".".join(map(str, chunk_id))).write_bytes(zlib.compress(np.ascontiguousarray(block).tobytes(),
+                                                                        ZLIB_LEVEL))
+
+
+def _read_meta(path):
+    meta = json.loads((path / ".zarray").read_text())
+    compressor = meta.get("compressor")
+    if compressor is not None and compressor.get("id") != "zlib":
+        raise ValueError(f"Unsupported compressor in {path}: {compressor.get('id')} (only zlib is supported)")
+    if meta.get("order", "C") != "C" or meta.get("filters"):
+        raise ValueError(f"Unsupported array layout in {path} (only C order without filters is supported)")
+    return meta
+
+
+def _read_array(path, keys=None):
+    """Read the selected positions (one integer array per axis) of an array, loading only the chunks needed"""
+
+    meta = _read_meta(path)
+    shape, chunks, dtype = meta["shape"], meta["chunks"], np.dtype(meta["dtype"])
+    separator = meta.get("dimension_separator", ".")
+    fill = np.nan if meta["fill_value"] in ("NaN", None) and dtype.kind == "f" else (meta["fill_value"] or 0)
+    keys = [np.arange(size) for size in shape] if keys is None else [np.asarray(key) for key in keys]
+    result = np.full(tuple(len(key) for key in keys), fill, dtype=dtype)
+    # Positions grouped by chunk along each axis
+    by_axis = []
+    for key, chunk in zip(keys, chunks):
+        chunk_ids = key // chunk
+        by_axis.append([(cid, np.flatnonzero(chunk_ids == cid), key[chunk_ids == cid] - cid * chunk)
+                        for cid in np.unique(chunk_ids)])
+    loaded = 0
+    for parts in product(*by_axis):
+        chunk_file = path / separator.join(str(cid) for cid, _, _ in parts)
+        if not chunk_file.is_file():
+            continue
+        block = np.frombuffer(zlib.decompress(chunk_file.read_bytes()), dtype=dtype).reshape(chunks)
+        result[np.ix_(*[out for _, out, _ in parts])] = block[np.ix_(*[inner for _, _, inner in parts])]
+        loaded += 1
+    mod_logger.debug("%s chunks read from %s", loaded, path)
+    return result
+
+
+def read_zarr(path, **labels):
+    """
+    Read a cube written by LabeledCube.to_zarr. Only the chunks holding the selected labels are read and
+    decompressed.
+
+    :param path: directory of the store
+    :param labels: dimension name to label or list of labels to select (see LabeledCube.sel)
+    :return: LabeledCube
+    """
+
+    path = Path(path)
+    dims = json.loads((path / "concentrations" / ".zattrs").read_text())["_ARRAY_DIMENSIONS"]
+    unknown = set(labels) - set(dims)
+    if unknown:
+        raise KeyError(f"Unknown dimensions: {sorted(unknown)}. Dimensions are {dims}")
+    coords = {dim: pd.Index(_read_array(path / dim), name=dim) for dim in dims}
+    keys, selected = [], {}
+    for dim in dims:
+        index = coords[dim]
+        wanted = labels.get(dim, index)
+        positions = index.get_indexer(np.atleast_1d(wanted))
+        if (positions < 0).any():
+            raise KeyError(f"Labels not found in {dim}: {list(np.atleast_1d(wanted)[positions < 0])}")
+        keys.append(positions)
+        selected[dim] = list(index[positions]) if np.ndim(wanted) else index[positions][0]
+    cube = LabeledCube(_read_array(path / "concentrations", keys), {dim: np.atleast_1d(selected[dim]) for dim in dims},
+                       dims)
+    # Single labels drop their dimension, as with LabeledCube.sel
+    scalars = {dim: label for dim, label in selected.items() if dim in labels and np.ndim(labels[dim]) == 0}
+    return cube.sel(**scalars) if scalars else cube
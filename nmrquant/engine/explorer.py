@@ -0,0 +1,243 @@
+"""Module containing the on-demand rendering of the plots of a Quantifier, with a memory bounded figure cache"""
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from nmrquant.engine.render import render_plot
+from nmrquant.engine.visualizer import IndHistA, IndHistB, MultHistB, NoRepIndLine, IndLine, MeanLine
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.explorer")
+
+# Plot kinds (as named in the notebook) and the folder their figures are exported to
+PLOT_FOLDERS = {"individual_histogram": "Histograms_Individual",
+                "meaned_histogram": "Histograms_Meaned",
+                "individual_lineplot": "Lineplots_Individual",
+                "summary_lineplot": "Lineplots_Summary"}
+
+# Default memory bound of the figure cache (bytes)
+CACHE_SIZE = 64 * 2 ** 20
+
+
+class FigureCache:
+    """
+    Least recently used cache of rendered figures, bounded by the memory taken by the figures. Each entry is the list
+    of (file name, file content) of one view.
+    """
+
+    def __init__(self, max_bytes=CACHE_SIZE):
+
+        if max_bytes <= 0:
+            raise ValueError("The size of the figure cache must be positive")
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"FigureCache({len(self)} views, {self.nbytes} of {self.max_bytes} bytes)"
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Get a view and mark it as the most recently used
+
+        :param key: key of the view
+        :return: list of (file name, file content), or None if the view is not cached
+        """
+
+        with self._lock:
+            figures = self._entries.get(key)
+            if figures is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return figures
+
+    def put(self, key, figures):
+        """
+        Cache a view, evicting the least recently used ones until the cache fits in its memory bound. Views larger
+        than the bound are not cached.
+
+        :param key: key of the view
+        :param figures: list of (file name, file content)
+        """
+
+        size = _size(figures)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= _size(self._entries.pop(key))
+            if size > self.max_bytes:
+                mod_logger.debug("View %s (%s bytes) is larger than the figure cache and is not kept", key, size)
+                return
+            while self.nbytes + size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= _size(evicted)
+            self._entries[key] = figures
+            self.nbytes += size
+
+    def clear(self):
+        """Empty the cache"""
+
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class PlotExplorer:
+    """
+    Render the plots of a Quantifier one view at a time (plot kind, metabolite and conditions), when they are asked
+    for. Rendered views are kept in a FigureCache and every viewed plot is recorded so that it can be exported.
+    """
+
+    def __init__(self, quantifier, fmt="svg", renderer="direct", max_bytes=CACHE_SIZE):
+        """
+        :param quantifier: Quantifier whose concentrations have been computed
+        :param fmt: format of the figures
+        :param renderer: 'matplotlib' or 'direct' (see render.render_plot)
+        :param max_bytes: memory bound of the figure cache
+        """
+
+        # The concentrations DataFrame is built once (conc_data is a view rebuilt from the results cube)
+        self.conc_data = quantifier.conc_data
+        if self.conc_data is None:
+            raise ValueError("Concentrations have not been computed yet")
+        self.quantifier = quantifier
+        self.fmt = fmt
+        self.renderer = renderer
+        self.cache = FigureCache(max_bytes)
+        # Keys of the viewed plots, in viewing order
+        self.viewed = OrderedDict()
+
+    def __repr__(self):
+        return f"PlotExplorer({len(self.viewed)} viewed plots, {self.cache})"
+
+    @property
+    def conditions(self):
+        return list(self.conc_data.index.get_level_values("Conditions").unique())
+
+    @property
+    def kinds(self):
+        """Plot kinds available for the data (histograms for one time point, lineplots for kinetics)"""
+
+        if len(self.quantifier.time_points) > 1:
+            return ["individual_lineplot", "summary_lineplot"]
+        kinds = ["individual_histogram"]
+        if self.quantifier.mean_data is not None and self.quantifier.std_data is not None:
+            kinds.append("meaned_histogram")
+        return kinds
+
+    def key(self, kind, metabolite, conditions=None):
+        """
+        Key of a view in the cache. Selecting no condition or all of them is the same view.
+
+        :return: tuple (kind, metabolite, conditions or None, format, renderer)
+        """
+
+        if kind not in PLOT_FOLDERS:
+            raise ValueError(f"Unknown plot kind '{kind}'. Choose one of {list(PLOT_FOLDERS)}")
+        if conditions is not None:
+            conditions = tuple(condition for condition in self.conditions if condition in set(conditions))
+            if not conditions:
+                raise ValueError("None of the selected conditions are in the data")
+            if len(conditions) == len(self.conditions):
+                conditions = None
+        return kind, metabolite, conditions, self.fmt, self.renderer
+
+    def plot(self, kind, metabolite, conditions=None):
+        """
+        Build the plot object of a view
+
+        :param kind: plot kind (see PLOT_FOLDERS)
+        :param metabolite: metabolite to plot
+        :param conditions: conditions to plot (all if None)
+        :return: plot object of the visualizer
+        """
+
+        if kind not in self.kinds:
+            raise ValueError(f"{kind} plots are not available for this data. Choose one of {self.kinds}")
+        conc_data = _select(self.conc_data, conditions)
+        if kind == "individual_histogram":
+            hist_class = IndHistB if len(self.quantifier.replicates) > 1 else IndHistA
+            return hist_class(conc_data, metabolite, False)
+        if kind == "meaned_histogram":
+            return MultHistB(_select(self.quantifier.mean_data, conditions),
+                             _select(self.quantifier.std_data, conditions), metabolite, False)
+        if kind == "individual_lineplot":
+            if len(self.quantifier.replicates) == 1 or "Replicates" not in conc_data.index.names:
+                return NoRepIndLine(conc_data, metabolite, False)
+            return IndLine(conc_data, metabolite, False)
+        return MeanLine(conc_data, metabolite, False)
+
+    def render(self, kind, metabolite, conditions=None):
+        """
+        Get the figures of a view, rendering them only if they are not cached, and record the view
+
+        :param kind: plot kind (see PLOT_FOLDERS)
+        :param metabolite: metabolite to plot
+        :param conditions: conditions to plot (all if None)
+        :return: list of (file name, file content)
+        """
+
+        key = self.key(kind, metabolite, conditions)
+        figures = self.cache.get(key)
+        if figures is None:
+            # Figures rendered with pyplot are serialized with the other pyplot calls (see render.PYPLOT_LOCK)
+            figures = self._render(key)
+            self.cache.put(key, figures)
+        self.viewed[key] = None
+        self.viewed.move_to_end(key)
+        return figures
+
+    def _render(self, key):
+        kind, metabolite, conditions, fmt, renderer = key
+        figures = render_plot(self.plot(kind, metabolite, conditions), fmt, renderer, bbox_inches="tight")
+        if conditions is not None:
+            # Plots of a subset of the conditions do not overwrite the plots of all the conditions when exported
+            # (plots with one figure per condition are already named after it)
+            suffix = "_".join(str(condition) for condition in conditions)
+            figures = [(f"{fname}_{suffix}" if fname == metabolite else fname, content) for fname, content in figures]
+        return figures
+
+    def export_viewed(self, destination):
+        """
+        Write the figures of every viewed plot, in the folders of the batch plots (Histograms_Individual...). Plots
+        evicted from the cache are rendered again.
+
+        :param destination: folder in which the plot folders are created
+        :return: list of the paths of the written files
+        """
+
+        paths = []
+        for key in list(self.viewed):
+            figures = self.cache.get(key)
+            if figures is None:
+                figures = self._render(key)
+            folder = Path(destination) / PLOT_FOLDERS[key[0]]
+            folder.mkdir(parents=True, exist_ok=True)
+            for fname, content in figures:
+                path = folder / f"{fname}.{key[3]}"
+                path.write_bytes(content)
+                paths.append(path)
+        mod_logger.info("%s figures of %s viewed plots exported to %s", len(paths), len(self.viewed), destination)
+        return paths
+
+
+def _size(figures):
+    return sum(len(content) for _, content in figures)
+
+
+def _select(data, conditions):
+    """Rows of the given conditions (all the rows if None)"""
+
+    if conditions is None:
+        return data
+    return data[data.index.get_level_values("Conditions").isin(list(conditions))]
@@ -0,0 +1,240 @@
+"""Module containing the column expression engine (summed, derived and ratio metabolite columns)"""
+import logging
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.expressions")
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d*)?(?:[eE][+-]?\d+)?|[.,]\d+(?:[eE][+-]?\d+)?")
+_OPERATORS = "+-*/()"
+
+
+def tokenize(text, names):
+    """
+    Split an expression in tokens. Metabolite names can contain operators (ex: 'Isoleucine+Leucine'), so at each
+    position the longest known name is matched first, then numbers and operators.
+
+    :param text: expression to tokenize
+    :param names: known column names
+    :return: list of (kind, value) tuples, kind being 'name', 'number' or 'op'
+    """
+
+    by_length = sorted(set(names), key=len, reverse=True)
+    tokens, pos = [], 0
+    while pos < len(text):
+        if text[pos].isspace():
+            pos += 1
+            continue
+        name = next((n for n in by_length if text.startswith(n, pos)), None)
+        if name is not None:
+            tokens.append(("name", name))
+            pos += len(name)
+            continue
+        number = _NUMBER.match(text, pos)
+        if number:
+            tokens.append(("number", float(number.group().replace(",", "."))))
+            pos = number.end()
+        elif text[pos] in _OPERATORS:
+            tokens.append(("op", text[pos]))
+            pos += 1
+        else:
+            raise KeyError(f"Unknown column at position {pos} of expression '{text}': '{text[pos:]}'")
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser of linear expressions of columns, with an optional ratio of two linear expressions at
+    the top level. Linear expressions are dicts of column name (None for the constant term) to coefficient.
+    """
+
+    def __init__(self, tokens, text):
+        self.tokens = tokens
+        self.text = text
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _error(self, message):
+        return ValueError(f"Invalid expression '{self.text}': {message}")
+
+    def parse(self):
+        numerator = self._sum()
+        denominator = {None: 1.0}
+        if self._peek() == ("op", "/"):
+            self._next()
+            denominator = self._sum()
+        if self.pos != len(self.tokens):
+            raise self._error(f"unexpected '{self._peek()[1]}'")
+        return numerator, denominator
+
+    def _sum(self):
+        result = self._product()
+        while self._peek() in (("op", "+"), ("op", "-")):
+            sign = 1 if self._next()[1] == "+" else -1
+            _add(result, self._product(), sign)
+        return result
+
+    def _product(self):
+        result = self._unary()
+        while self._peek() == ("op", "*") or (self._peek() == ("op", "/") and self._divisor_is_number()):
+            operator = self._next()[1]
+            other = self._unary()
+            if operator == "/":
+                result = _scale(result, 1 / other[None])
+            elif set(other) == {None}:
+                result = _scale(result, other[None])
+            elif set(result) == {None}:
+                result = _scale(other, result[None])
+            else:
+                raise self._error("products of columns are not linear")
+        return result
+
+    def _divisor_is_number(self):
+        # Divisions by a number are coefficients, other divisions are ratios handled at the top level
+        following = self.tokens[self.pos + 1] if self.pos + 1 < len(self.tokens) else (None, None)
+        return following[0] == "number"
+
+    def _unary(self):
+        if self._peek() in (("op", "-"), ("op", "+")):
+            sign = 1 if self._next()[1] == "+" else -1
+            return _scale(self._unary(), sign)
+        kind, value = self._next()
+        if kind == "name":
+            return {value: 1.0}
+        if kind == "number":
+            return {None: value}
+        if (kind, value) == ("op", "("):
+            result = self._sum()
+            if self._next() != ("op", ")"):
+                raise self._error("missing ')'")
+            return result
+        raise self._error("unexpected end of expression" if kind is None else f"unexpected '{value}'")
+
+
+def _add(result, other, sign=1):
+    for key, coef in other.items():
+        result[key] = result.get(key, 0.0) + sign * coef
+    return result
+
+
+def _scale(linear, factor):
+    return {key: coef * factor for key, coef in linear.items()}
+
+
+def parse_expression(text, names):
+    """
+    Parse an expression of columns: a linear combination of columns and numbers ('A+B - 0.5*C'), or a ratio of two
+    linear combinations ('Lactate / (Pyruvate + Acetate)')
+
+    :param text: expression to parse
+    :param names: known column names
+    :return: tuple of dicts (numerator, denominator) of column name (None for constants) to coefficient
+    """
+
+    return _Parser(tokenize(text, names), text).parse()
+
+
+def read_definitions(definitions):
+    """
+    Normalize expression definitions to a dict of target name to expression
+
+    :param definitions: dict of target to expression, list of 'target = expression' strings, path to a text file
+                        with one 'target = expression' definition per line ('#' starts a comment), or database
+                        DataFrame with "Metabolite" and "Expression" columns
+    :return: dict of target name to expression
+    """
+
+    if isinstance(definitions, pd.DataFrame):
+        if "Expression" not in definitions.columns:
+            return {}
+        rows = definitions.dropna(subset=["Expression"])
+        return {_check_target(str(met).strip()): str(expr) for met, expr in zip(rows["Metabolite"], rows["Expression"])
+                if str(expr).strip()}
+    if isinstance(definitions, dict):
+        return {_check_target(target): expression for target, expression in definitions.items()}
+    if isinstance(definitions, (str, Path)) and Path(definitions).is_file():
+        definitions = Path(definitions).read_text().splitlines()
+    elif isinstance(definitions, str):
+        definitions = [definitions]
+    result = {}
+    for line in definitions:
+        line = line.split("#")[0].strip()
+        if not line:
+            continue
+        if "=" not in line:
+            raise ValueError(f"Expression definitions must be written 'target = expression': '{line}'")
+        target, expression = line.split("=", 1)
+        result[_check_target(target.strip())] = expression.strip()
+    return result
+
+
+def _check_target(target):
+    # Targets become column names and plot file names
+    if not target or any(char in target for char in '/\\'):
+        raise ValueError(f"Invalid name for a derived column: '{target}' (names cannot contain '/' or '\\')")
+    return target
+
+
+class CompiledExpressions:
+    """
+    Expressions compiled to coefficient matrices, evaluated on all the rows and expressions at once with two matrix
+    products: (values @ numerators) / (values @ denominators), a column of ones carrying the constant terms
+    """
+
+    def __init__(self, definitions, names):
+        """
+        :param definitions: dict of target name to expression (see read_definitions), or to an already parsed
+                            expression (see parse_expression)
+        :param names: names of the columns the expressions can use
+        """
+
+        self.targets = list(definitions)
+        parsed = [expression if isinstance(expression, tuple) else parse_expression(expression, names)
+                  for expression in definitions.values()]
+        used = sorted({name for pair in parsed for part in pair for name in part if name is not None})
+        self.columns = used
+        position = {name: ind for ind, name in enumerate(used)}
+        constant = len(used)
+        self.numerators = np.zeros((len(used) + 1, len(parsed)))
+        self.denominators = np.zeros((len(used) + 1, len(parsed)))
+        for ind, (numerator, denominator) in enumerate(parsed):
+            for matrix, linear in ((self.numerators, numerator), (self.denominators, denominator)):
+                for name, coef in linear.items():
+                    matrix[constant if name is None else position[name], ind] += coef
+        self.ratios = np.array([set(den) != {None} for _, den in parsed], dtype=bool)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __repr__(self):
+        return f"CompiledExpressions({self.targets})"
+
+    def evaluate(self, data):
+        """
+        Evaluate all the expressions
+
+        :param data: DataFrame containing the columns used by the expressions
+        :return: DataFrame of results with one column per expression, indexed like data
+        """
+
+        values = np.hstack([data[self.columns].to_numpy(dtype=float), np.ones((len(data), 1))])
+        missing = np.isnan(values)
+        values[missing] = 0
+        denominators = values @ self.denominators
+        # Ratios with a null denominator are undefined
+        denominators[denominators == 0] = np.nan
+        results = (values @ self.numerators) / denominators
+        # A missing value only propagates to the expressions using its column
+        used = (self.numerators != 0) | (self.denominators != 0)
+        results[(missing.astype(float) @ used) > 0] = np.nan
+        return pd.DataFrame(results, index=data.index, columns=self.targets)
@@ -0,0 +1,172 @@
+"""Module containing the estimation of kinetic rates from the metabolite time courses"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from nmrquant.engine.utilities import replicate_cube
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.kinetics")
+
+MODELS = ("slope", "initial_rate", "exponential")
+
+
+def time_course_cube(data, by=("Conditions", "Replicates")):
+    """
+    Arrange concentrations in time courses: dense arrays of times of shape (series, points) and values of shape
+    (series, points, metabolites), points being sorted by time in each series. A series is a unique combination of
+    the levels in by (a replicate, or a whole condition to pool its replicates).
+
+    :param data: concentrations indexed by conditions, time points and replicates (Quantifier.conc_data)
+    :param by: index levels defining the series
+    :return: tuple (times, values, series index, metabolites)
+    """
+
+    times = pd.to_numeric(data.index.get_level_values("Time_Points"), errors="coerce").to_numpy(dtype=float)
+    if np.isnan(times).all():
+        raise ValueError("Time points must be numeric to estimate kinetic rates")
+    order = np.argsort(times, kind="stable")
+    values, series, metabolites, (codes, positions) = replicate_cube(data.iloc[order], group_levels=by,
+                                                                     return_positions=True)
+    time_cube = np.full(values.shape[:2], np.nan)
+    time_cube[codes, positions] = times[order]
+    return time_cube, values, series, metabolites
+
+
+def batched_ols(x, y, mask):
+    """
+    Ordinary least-squares straight lines fitted on many series at once. Each (series, metabolite) cell is fitted on
+    its own points.
+
+    :param x: array of times of shape (series, points, 1)
+    :param y: array of values of shape (series, points, metabolites)
+    :param mask: boolean array with the shape of y, True for the points to use
+    :return: dict of arrays of shape (series, metabolites): n, slope, slope_se, intercept, r2
+    """
+
+    w = mask & ~np.isnan(x) & ~np.isnan(y)
+    x, y = np.where(w, x, 0.0), np.where(w, y, 0.0)
+    n = w.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_mean, y_mean = x.sum(axis=1) / n, y.sum(axis=1) / n
+        dx = np.where(w, x - x_mean[:, None], 0.0)
+        dy = np.where(w, y - y_mean[:, None], 0.0)
+        sxx, sxy, syy = (dx ** 2).sum(axis=1), (dx * dy).sum(axis=1), (dy ** 2).sum(axis=1)
+        slope = sxy / sxx
+        intercept = y_mean - slope * x_mean
+        ss_res = np.where(w, (dy - slope[:, None] * dx) ** 2, 0.0).sum(axis=1)
+        slope_se = np.sqrt(ss_res / (n - 2) / sxx)
+        r2 = 1 - ss_res / syy
+    fitted = (n >= 2) & (sxx > 0)
+    return {
+        "n": n,
+        "slope": np.where(fitted, slope, np.nan),
+        "slope_se": np.where(fitted & (n > 2), slope_se, np.nan),
+        "intercept": np.where(fitted, intercept, np.nan),
+        "r2": np.where(fitted, r2, np.nan),
+    }
+
+
+def first_times(x, valid, count):
+    """
+    Mask of the points belonging to the first time points of each (series, metabolite) cell
+
+    :param x: array of times of shape (series, points, 1), sorted along the points
+    :param valid: boolean array of shape (series, points, metabolites) of the usable points
+    :param count: number of distinct time points to keep
+    :return: boolean mask with the shape of valid
+    """
+
+    points = np.arange(valid.shape[1])[None, :, None]
+    # Index of the previous valid point of each point, to find the points starting a new time
+    last_valid = np.maximum.accumulate(np.where(valid, points, -1), axis=1)
+    previous = np.concatenate([np.full_like(last_valid[:, :1], -1), last_valid[:, :-1]], axis=1)
+    x = np.broadcast_to(x, valid.shape)
+    previous_time = np.take_along_axis(x, previous.clip(min=0), axis=1)
+    new_time = valid & ((previous < 0) | (x != previous_time))
+    return valid & (np.cumsum(new_time, axis=1) <= count)
+
+
+def fit_kinetics(data, by=("Conditions", "Replicates"), initial_points=3):
+    """
+    Fit kinetic models on every time course (metabolite x series) in one batched computation:
+
+        * slope: straight line over the whole time course
+        * initial_rate: straight line over the first time points
+        * exponential: c = amplitude * exp(rate * t), fitted as a straight line on log-concentrations (only positive
+          concentrations are used)
+
+    :param data: concentrations indexed by conditions, time points and replicates (Quantifier.conc_data)
+    :param by: index levels defining a time course. ("Conditions", "Replicates") fits each replicate,
+               ("Conditions",) pools the replicates of each condition
+    :param initial_points: number of time points used for the initial rates
+    :return: tidy DataFrame indexed by the by levels and the metabolite, with the rates, their standard errors,
+             intercepts and coefficients of determination
+    """
+
+    if initial_points < 2:
+        raise ValueError("At least 2 time points are needed to estimate initial rates")
+    if "# Spectrum#" in data.index.names:
+        data = data.droplevel("# Spectrum#")
+    by = [level for level in by if level in data.index.names]
+    x, y, series, metabolites = time_course_cube(data, by)
+    x = x[:, :, None]
+    mod_logger.debug("Fitting kinetics on %s series x %s points x %s metabolites", *y.shape)
+    valid = ~np.isnan(y) & ~np.isnan(x)
+    linear = batched_ols(x, y, valid)
+    initial_mask = first_times(x, valid, initial_points)
+    initial = batched_ols(x, y, initial_mask)
+    positive = valid & (np.nan_to_num(y) > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exponential = batched_ols(x, np.log(np.where(positive, y, np.nan)), positive)
+    times = np.broadcast_to(x, y.shape)
+    with np.errstate(invalid="ignore"):
+        t_start = np.nanmin(np.where(valid, times, np.inf), axis=1)
+        t_end = np.nanmax(np.where(valid, times, -np.inf), axis=1)
+        initial_end = np.nanmax(np.where(initial_mask, times, -np.inf), axis=1)
+    columns = {
+        "n_points": linear["n"],
+        "t_start": np.where(np.isfinite(t_start), t_start, np.nan),
+        "t_end": np.where(np.isfinite(t_end), t_end, np.nan),
+        "slope": linear["slope"],
+        "slope_se": linear["slope_se"],
+        "intercept": linear["intercept"],
+        "r2": linear["r2"],
+        "initial_rate": initial["slope"],
+        "initial_rate_se": initial["slope_se"],
+        "initial_intercept": initial["intercept"],
+        "initial_end": np.where(np.isfinite(initial_end), initial_end, np.nan),
+        "exp_rate": exponential["slope"],
+        "exp_rate_se": exponential["slope_se"],
+        "exp_amplitude": np.exp(exponential["intercept"]),
+        "exp_r2": exponential["r2"],
+    }
+    frame = series.to_frame(index=False).loc[np.repeat(np.arange(len(series)), len(metabolites))]
+    frame["Metabolite"] = np.tile(np.asarray(metabolites), len(series))
+    return pd.DataFrame({name: values.ravel() for name, values in columns.items()},
+                        index=pd.MultiIndex.from_frame(frame))
+
+
+def model_curve(fit, model="slope", points=50):
+    """
+    Coordinates of a fitted kinetic model, for plotting
+
+    :param fit: row of the table returned by fit_kinetics
+    :param model: 'slope', 'initial_rate' or 'exponential'
+    :param points: number of points of the curve
+    :return: tuple (times, values), empty if the model could not be fitted
+    """
+
+    if model not in MODELS:
+        raise ValueError(f"Unknown kinetic model: {model}. Choose from {MODELS}")
+    if model == "slope":
+        start, end, a, b = fit["t_start"], fit["t_end"], fit["slope"], fit["intercept"]
+    elif model == "initial_rate":
+        start, end, a, b = fit["t_start"], fit["initial_end"], fit["initial_rate"], fit["initial_intercept"]
+    else:
+        start, end, a, b = fit["t_start"], fit["t_end"], fit["exp_rate"], fit["exp_amplitude"]
+    if not np.all(np.isfinite([start, end, a, b])):
+        return np.array([]), np.array([])
+    times = np.linspace(start, end, points if model == "exponential" else 2)
+    values = b * np.exp(a * times) if model == "exponential" else a * times + b
+    return times, values
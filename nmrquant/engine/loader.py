@@ -0,0 +1,126 @@
+"""Module containing the concurrent loading of the inputs of a Quantifier (data, database and template)"""
+import logging
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from pathlib import PurePath
+
+import pandas as pd
+
+from nmrquant.engine.utilities import read_data
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.loader")
+
+# Columns each input must contain
+REQUIRED_COLUMNS = {"data": ["# Spectrum#"],
+                    "database": ["Metabolite", "Heq"],
+                    "template": ["Conditions", "Time_Points", "Replicates", "# Spectrum#"]}
+
+
+def check_columns(kind, frame):
+    """
+    Check that an input contains the columns it needs
+
+    :param kind: 'data', 'database' or 'template'
+    :param frame: DataFrame read from the input
+    :raises ValueError: if columns are missing
+    """
+
+    missing = [col for col in REQUIRED_COLUMNS[kind] if col not in frame.columns]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in the {kind}. Please check the file headers")
+
+
+def read_input(source, kind, excel_sheet=0):
+    """
+    Read one input and check its columns
+
+    :param source: path, DataFrame, or Future of a DataFrame (ex: a file read in the background)
+    :param kind: 'data', 'database' or 'template'
+    :param excel_sheet: sheet to read if the input is an Excel file
+    :return: DataFrame
+    """
+
+    if isinstance(source, Future):
+        # Futures may be shared (prefetch caches): the Quantifier gets its own copy, as it modifies its inputs
+        frame = source.result().copy()
+    elif isinstance(source, (str, PurePath)):
+        frame = read_data(str(source), excel_sheet if kind == "data" else 0)
+    elif isinstance(source, pd.DataFrame):
+        frame = source
+    else:
+        raise TypeError(f"The {kind} must be a path, a DataFrame or a Future, not {type(source).__name__}")
+    check_columns(kind, frame)
+    return frame
+
+
+def _check_spectra(data, template):
+    """Cross-check the spectra of the data and of the template"""
+
+    data_spectra, template_spectra = set(data["# Spectrum#"]), set(template["# Spectrum#"])
+    if not data_spectra & template_spectra:
+        raise ValueError("No spectrum of the data is described in the template. Please check that the template "
+                         "corresponds to the data")
+    for missing, where in [(data_spectra - template_spectra, "the template"),
+                           (template_spectra - data_spectra, "the data")]:
+        if missing:
+            mod_logger.warning("Spectra %s not found in %s and will be ignored", sorted(missing), where)
+
+
+def load_quantifier(data, database, template, quantifier=None, excel_sheet=0, max_workers=None):
+    """
+    Read the data, the database(s) and the template concurrently, check them together and load them in a
+    Quantifier. Inputs are read in threads (file reading and parsing release the GIL most of the time). If one input
+    cannot be read, the error is raised as soon as it happens, without waiting for the other inputs.
+
+    :param data: data (path, DataFrame or Future), or None if the data is loaded afterwards (ex: integration of
+                 spectra, which needs the database)
+    :param database: database (path, DataFrame or Future), or list/dict of databases (see Quantifier.get_db)
+    :param template: template (path, DataFrame or Future)
+    :param quantifier: Quantifier to load (a new one if None)
+    :param excel_sheet: sheet to read if the data is an Excel file
+    :param max_workers: maximum number of reading threads (one per input by default)
+    :return: the loaded Quantifier
+    :raises ValueError: if an input cannot be read or the inputs do not match
+    """
+
+    if quantifier is None:
+        from nmrquant.engine.calculator import Quantifier
+        quantifier = Quantifier()
+    sources = {} if data is None else {"data": ("data", data)}
+    if isinstance(database, dict):
+        sources.update({("database", key): ("database", db) for key, db in database.items()})
+    elif isinstance(database, (list, tuple)):
+        sources.update({("database", ind): ("database", db) for ind, db in enumerate(database)})
+    else:
+        sources["database"] = ("database", database)
+    sources["template"] = ("template", template)
+
+    pool = ThreadPoolExecutor(max_workers=max_workers or len(sources), thread_name_prefix="nmrquant_loader")
+    futures = {pool.submit(read_input, source, kind, excel_sheet): name for name, (kind, source) in sources.items()}
+    try:
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [future for future in done if future.exception() is not None]
+        if failed:
+            for future in pending:
+                future.cancel()
+            name = futures[failed[0]]
+            kind, source = sources[name]
+            label = source if isinstance(source, (str, PurePath)) else type(source).__name__
+            raise ValueError(f"Error while reading the {kind} ({label}): {failed[0].exception()}") \
+                from failed[0].exception()
+        frames = {name: future.result() for future, name in futures.items()}
+    finally:
+        # Threads still reading after an error are not waited for
+        pool.shutdown(wait=False)
+
+    if data is not None:
+        _check_spectra(frames["data"], frames["template"])
+    if isinstance(database, dict):
+        quantifier.get_db({key: frames[("database", key)] for key in database})
+    elif isinstance(database, (list, tuple)):
+        quantifier.get_db([frames[("database", ind)] for ind in range(len(database))])
+    else:
+        quantifier.get_db(frames["database"])
+    if data is not None:
+        quantifier.get_data(frames["data"])
+    quantifier.import_md(frames["template"])
+    return quantifier
@@ -0,0 +1,189 @@
+"""Module containing the resolution of metabolite names against the proton databases (aliases and fuzzy matching)"""
+import logging
+import re
+from collections import Counter, defaultdict
+
+import pandas as pd
+
+from nmrquant.engine.utilities import read_data
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.names")
+
+# Precedence of the databases merged by merge_databases (later levels override earlier ones)
+PRECEDENCE = ("site", "project", "user")
+
+# Minimum trigram similarity of the fuzzy suggestions
+SUGGESTION_CUTOFF = 0.4
+
+
+def normalize(name):
+    """
+    Normalize a metabolite name for matching: case folding, stripped and collapsed whitespace
+
+    :param name: metabolite name
+    :return: normalized name
+    """
+
+    return re.sub(r"\s+", " ", str(name)).strip().casefold()
+
+
+def trigrams(name):
+    """Set of the character trigrams of a normalized name (padded so that short names have trigrams too)"""
+
+    padded = f"  {normalize(name)} "
+    return {padded[ind:ind + 3] for ind in range(len(padded) - 2)}
+
+
+def read_aliases(aliases):
+    """
+    Normalize alias definitions to a dict of alias to database name
+
+    :param aliases: dict of alias to database name, or DataFrame (or path to a file) with "Alias" and "Metabolite"
+                    columns, or database DataFrame with an "Aliases" column (aliases separated by ';')
+    :return: dict of alias to database name
+    """
+
+    if isinstance(aliases, dict):
+        return dict(aliases)
+    if not isinstance(aliases, pd.DataFrame):
+        aliases = read_data(aliases)
+    if "Aliases" in aliases.columns:
+        rows = aliases.dropna(subset=["Aliases"])
+        return {alias.strip(): met for met, names in zip(rows["Metabolite"], rows["Aliases"])
+                for alias in str(names).split(";") if alias.strip()}
+    if {"Alias", "Metabolite"}.issubset(aliases.columns):
+        rows = aliases.dropna(subset=["Alias", "Metabolite"])
+        return dict(zip(rows["Alias"].astype(str), rows["Metabolite"].astype(str)))
+    raise KeyError("Alias tables must contain 'Alias' and 'Metabolite' columns")
+
+
+def merge_databases(databases):
+    """
+    Merge several proton databases. Databases are given in increasing precedence (site, project, user): an entry of
+    a later database replaces the entries of earlier databases with the same normalized name. Numbered entries of a
+    metabolite (Glucose_1, Glucose_2, summed by the Quantifier) and its base entry (Glucose) are one metabolite: the
+    entries of a later database replace all of them.
+
+    :param databases: list of database DataFrames, or dict of level name to database DataFrame
+    :return: merged database with a "Source" column giving the database of each entry
+    """
+
+    if isinstance(databases, dict):
+        levels = sorted(databases, key=lambda lvl: PRECEDENCE.index(lvl) if lvl in PRECEDENCE else len(PRECEDENCE))
+        databases = [(level, databases[level]) for level in levels]
+    else:
+        databases = [(PRECEDENCE[ind] if ind < len(PRECEDENCE) else f"database {ind + 1}", database)
+                     for ind, database in enumerate(databases)]
+    merged = {}
+    for level, database in databases:
+        if "Metabolite" not in database.columns:
+            raise KeyError(f"'Metabolite' column not found in the {level} database")
+        bases = {_base(name) for name in database["Metabolite"]}
+        for key in [key for key, entry in merged.items() if _base(entry["Metabolite"]) in bases]:
+            mod_logger.debug("%s from the %s database replaced by the %s database", merged[key]["Metabolite"],
+                             merged[key]["Source"], level)
+            del merged[key]
+        for _, row in database.iterrows():
+            merged[normalize(row["Metabolite"])] = {**row.to_dict(), "Source": level}
+    return pd.DataFrame(list(merged.values())).reset_index(drop=True)
+
+
+def _base(name):
+    # Numbered entries (Glucose_1, Glucose_2) are summed under their base name (see Quantifier._prepare_db)
+    return normalize(name).split("_")[0]
+
+
+class NameResolver:
+    """
+    Index of the metabolite names of a database, built once and queried in constant time per name. Names are matched
+    exactly, then through the alias table, then after normalization (case and whitespace). Names that cannot be
+    resolved get fuzzy suggestions from a trigram index.
+    """
+
+    def __init__(self, names, aliases=None):
+        """
+        :param names: metabolite names of the database
+        :param aliases: dict of alias to database name (see read_aliases)
+        """
+
+        self.names = list(dict.fromkeys(names))
+        self._exact = set(self.names)
+        self._normalized = {}
+        for name in self.names:
+            self._normalized.setdefault(normalize(name), name)
+        self._aliases = {}
+        for alias, name in (aliases or {}).items():
+            target = name if name in self._exact else self._normalized.get(normalize(name))
+            if target is None:
+                mod_logger.warning("Alias '%s' refers to '%s', which is not in the database", alias, name)
+                continue
+            self._aliases[normalize(alias)] = target
+        # Inverted index of trigrams to the names containing them
+        self._trigrams = defaultdict(set)
+        self._sizes = {}
+        for name in self.names:
+            grams = trigrams(name)
+            self._sizes[name] = len(grams)
+            for gram in grams:
+                self._trigrams[gram].add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f"NameResolver({len(self.names)} names, {len(self._aliases)} aliases)"
+
+    def match(self, name):
+        """
+        Resolve a name
+
+        :param name: name to resolve
+        :return: tuple (database name or None, kind of match: 'exact', 'alias', 'normalized' or 'unresolved')
+        """
+
+        if name in self._exact:
+            return name, "exact"
+        key = normalize(name)
+        if key in self._aliases:
+            return self._aliases[key], "alias"
+        if key in self._normalized:
+            return self._normalized[key], "normalized"
+        return None, "unresolved"
+
+    def resolve(self, name):
+        """Database name of a name, or None if it cannot be resolved"""
+
+        return self.match(name)[0]
+
+    def suggest(self, name, n=3, cutoff=SUGGESTION_CUTOFF):
+        """
+        Fuzzy suggestions for a name, ranked by trigram similarity (Jaccard index of the trigram sets)
+
+        :param name: name to look up
+        :param n: maximum number of suggestions
+        :param cutoff: minimum similarity
+        :return: list of (database name, similarity) tuples
+        """
+
+        grams = trigrams(name)
+        shared = Counter(candidate for gram in grams for candidate in self._trigrams.get(gram, ()))
+        scores = [(candidate, count / (len(grams) + self._sizes[candidate] - count))
+                  for candidate, count in shared.items()]
+        scores = [(candidate, round(score, 3)) for candidate, score in scores if score >= cutoff]
+        return sorted(scores, key=lambda item: (-item[1], item[0]))[:n]
+
+    def report(self, names):
+        """
+        Resolve a list of names
+
+        :param names: names to resolve (data columns)
+        :return: DataFrame indexed by name with the database name, the kind of match and the suggestions for the
+                 unresolved names
+        """
+
+        rows = []
+        for name in names:
+            target, kind = self.match(name)
+            suggestions = ", ".join(sug for sug, _ in self.suggest(name)) if target is None else ""
+            rows.append({"Name": name, "Database name": target, "Match": kind, "Suggestions": suggestions})
+        return pd.DataFrame(rows, columns=["Name", "Database name", "Match", "Suggestions"]).set_index("Name")
@@ -0,0 +1,203 @@
+"""Module containing the screening of replicate outliers before aggregation"""
+import logging
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from nmrquant.engine.utilities import replicate_cube
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.outliers")
+
+METHODS = ("mad", "grubbs", "dixon")
+
+# The median and MAD of less values are too unstable: with 3 replicates of pure noise, about a quarter of the cells
+# get a robust z-score above 3.5. Smaller cells are screened with the Grubbs test instead.
+MAD_MIN_VALUES = 6
+
+# Critical values of the Dixon Q test (r10 ratio) for 3 to 10 replicates (Rorabacher, Anal. Chem. 1991)
+DIXON_CRITICAL = {
+    0.10: [0.941, 0.765, 0.642, 0.560, 0.507, 0.468, 0.437, 0.412],
+    0.05: [0.970, 0.829, 0.710, 0.625, 0.568, 0.526, 0.493, 0.466],
+    0.01: [0.994, 0.926, 0.821, 0.740, 0.680, 0.634, 0.598, 0.568],
+}
+
+
+def robust_z(cube):
+    """
+    Robust z-scores (0.6745 * (x - median) / MAD) of every value of a replicate cube, computed per
+    (group, metabolite) cell. When more than half of the values of a cell are equal (null MAD), the mean absolute
+    deviation is used instead ((x - median) / (1.2533 * MeanAD)).
+
+    :param cube: array of shape (groups, replicates, metabolites), NaN-padded (see utilities.replicate_cube)
+    :return: array of scores with the shape of cube
+    """
+
+    with warnings.catch_warnings():
+        # Cells without values are expected and return NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(cube, axis=1, keepdims=True)
+        mad = np.nanmedian(np.abs(cube - median), axis=1, keepdims=True)
+        mean_ad = np.nanmean(np.abs(cube - median), axis=1, keepdims=True)
+    deviation = cube - median
+    scale = np.where(mad > 0, mad / 0.6745, 1.253314 * mean_ad)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = deviation / scale
+    return np.where(scale == 0, 0.0, scores)
+
+
+def grubbs_critical(n, alpha=0.05):
+    """
+    Critical values of the two-sided Grubbs test
+
+    :param n: array of sample sizes
+    :param alpha: significance level
+    :return: array of critical values (NaN for samples of less than 3 values)
+    """
+
+    n = np.asarray(n, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = stats.t.ppf(1 - alpha / (2 * n), n - 2)
+        critical = (n - 1) / np.sqrt(n) * np.sqrt(t ** 2 / (n - 2 + t ** 2))
+    return np.where(n >= 3, critical, np.nan)
+
+
+def grubbs(cube, alpha=0.05):
+    """
+    Iterated two-sided Grubbs test on every (group, metabolite) cell of a replicate cube at once. At each pass the
+    most extreme value of each cell still under test is tested, and removed if it is an outlier.
+
+    :param cube: array of shape (groups, replicates, metabolites), NaN-padded
+    :param alpha: significance level
+    :return: tuple (outlier mask, statistics, critical values), the last two being NaN for untested values
+    """
+
+    flagged = np.zeros(cube.shape, dtype=bool)
+    statistics = np.full(cube.shape, np.nan)
+    critical = np.full(cube.shape, np.nan)
+    testing = np.ones((cube.shape[0], 1, cube.shape[2]), dtype=bool)
+    g_idx, m_idx = np.indices((cube.shape[0], cube.shape[2]))
+    for _ in range(max(cube.shape[1] - 2, 0)):
+        values = np.where(flagged, np.nan, cube)
+        n = np.sum(~np.isnan(values), axis=1, keepdims=True)
+        testing &= n >= 3
+        if not testing.any():
+            break
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            deviation = np.abs(values - np.nanmean(values, axis=1, keepdims=True))
+            std = np.nanstd(values, axis=1, ddof=1, keepdims=True)
+        suspect = np.argmax(np.nan_to_num(deviation, nan=-1), axis=1)  # (groups, metabolites)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            g = deviation[g_idx, suspect, m_idx] / std[:, 0]
+        g_crit = grubbs_critical(n[:, 0], alpha)
+        tested = testing[:, 0] & np.isfinite(g)
+        statistics[g_idx[tested], suspect[tested], m_idx[tested]] = g[tested]
+        critical[g_idx[tested], suspect[tested], m_idx[tested]] = g_crit[tested]
+        outlier = tested & (g > g_crit)
+        flagged[g_idx[outlier], suspect[outlier], m_idx[outlier]] = True
+        # Only cells in which an outlier was found are tested again
+        testing &= outlier[:, None, :]
+    return flagged, statistics, critical
+
+
+def dixon(cube, alpha=0.05):
+    """
+    Dixon Q test (r10 ratio) of the lowest and highest value of every (group, metabolite) cell of a replicate cube
+    at once. Only cells with 3 to 10 values can be tested.
+
+    :param cube: array of shape (groups, replicates, metabolites), NaN-padded
+    :param alpha: significance level (0.1, 0.05 or 0.01)
+    :return: tuple (outlier mask, statistics, critical values), the last two being NaN for untested values
+    """
+
+    if alpha not in DIXON_CRITICAL:
+        raise ValueError(f"Dixon critical values are only available for alpha in {list(DIXON_CRITICAL)}")
+    order = np.argsort(cube, axis=1)  # NaNs are sorted at the end
+    ordered = np.take_along_axis(cube, order, axis=1)
+    n = np.sum(~np.isnan(cube), axis=1)  # (groups, metabolites)
+    top = np.clip(n - 1, 0, None)[:, None, :]
+    second = np.clip(n - 2, 0, None)[:, None, :]
+    highest = np.take_along_axis(ordered, top, axis=1)[:, 0]
+    below_highest = np.take_along_axis(ordered, second, axis=1)[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spread = highest - ordered[:, 0]
+        q_low = (ordered[:, min(1, cube.shape[1] - 1)] - ordered[:, 0]) / spread
+        q_high = (highest - below_highest) / spread
+    high_side = q_high >= q_low
+    q = np.where(high_side, q_high, q_low)
+    table = np.concatenate([[np.nan] * 3, DIXON_CRITICAL[alpha]])
+    q_crit = np.where((n >= 3) & (n <= 10), table[np.clip(n, 0, 10)], np.nan)
+    if np.any(n > 10):
+        mod_logger.warning("Dixon test is only tabulated up to 10 replicates, groups with more replicates are not "
+                           "tested")
+    suspect = np.take_along_axis(order, np.where(high_side, top[:, 0], 0)[:, None, :], axis=1)[:, 0]
+    tested = np.isfinite(q) & np.isfinite(q_crit)
+    g_idx, m_idx = np.nonzero(tested)
+    rows = suspect[g_idx, m_idx]
+    flagged = np.zeros(cube.shape, dtype=bool)
+    statistics = np.full(cube.shape, np.nan)
+    critical = np.full(cube.shape, np.nan)
+    statistics[g_idx, rows, m_idx] = q[tested]
+    critical[g_idx, rows, m_idx] = q_crit[tested]
+    flagged[g_idx, rows, m_idx] = q[tested] > q_crit[tested]
+    return flagged, statistics, critical
+
+
+def detect_outliers(data, method="mad", threshold=3.5, alpha=0.05):
+    """
+    Screen the replicates of every (condition, time point, metabolite) cell for outliers
+
+    :param data: concentrations indexed by conditions, time points and replicates (Quantifier.conc_data)
+    :param method: 'mad' (robust z-scores), 'grubbs' (iterated Grubbs test) or 'dixon' (Dixon Q test)
+    :param threshold: robust z-score above which a value is an outlier (mad method)
+    :param alpha: significance level of the tests (grubbs and dixon methods, and cells of less than MAD_MIN_VALUES
+                  values with the mad method)
+    :return: tuple (mask, report). The mask has the shape of data and is True for outliers. The report lists the
+             outliers ranked from the most to the least extreme, with their statistic, critical value and the
+             ratio of both used for ranking.
+    """
+
+    if method not in METHODS:
+        raise ValueError(f"Unknown outlier detection method: {method}. Choose from {METHODS}")
+    cube, _, metabolites, (group_codes, positions) = replicate_cube(data, return_positions=True)
+    mod_logger.debug("Screening %s groups x %s replicates x %s metabolites for outliers (%s)", *cube.shape, method)
+    methods = np.full(cube.shape, method, dtype=object)
+    if method == "mad":
+        counts = np.sum(~np.isnan(cube), axis=1, keepdims=True)
+        enough = (counts >= MAD_MIN_VALUES) & ~np.isnan(cube)
+        statistics = np.where(enough, np.abs(robust_z(cube)), np.nan)
+        critical = np.where(enough, float(threshold), np.nan)
+        flagged = statistics > critical
+        small = (counts >= 3) & (counts < MAD_MIN_VALUES)
+        if small.any():
+            mod_logger.warning("%s cells have less than %s replicates, they are screened with the Grubbs test "
+                               "instead of robust z-scores", int(small.sum()), MAD_MIN_VALUES)
+            small = np.broadcast_to(small, cube.shape)
+            g_flagged, g_statistics, g_critical = grubbs(np.where(small, cube, np.nan), alpha)
+            flagged = np.where(small, g_flagged, flagged)
+            statistics = np.where(small, g_statistics, statistics)
+            critical = np.where(small, g_critical, critical)
+            methods[small] = "grubbs"
+    elif method == "grubbs":
+        flagged, statistics, critical = grubbs(cube, alpha)
+    else:
+        flagged, statistics, critical = dixon(cube, alpha)
+
+    # Back from the cube to the rows of data
+    mask = pd.DataFrame(flagged[group_codes, positions], index=data.index, columns=metabolites)
+    rows, cols = np.nonzero(mask.to_numpy())
+    report = data.index[rows].to_frame(index=False)
+    report["Metabolite"] = np.asarray(metabolites)[cols]
+    report["value"] = data.to_numpy(dtype=float)[rows, cols]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        report["group_median"] = np.nanmedian(cube, axis=1)[group_codes[rows], cols]
+    report["statistic"] = statistics[group_codes, positions][rows, cols]
+    report["critical"] = critical[group_codes, positions][rows, cols]
+    report["ratio"] = report["statistic"] / report["critical"]
+    report["method"] = methods[group_codes, positions][rows, cols]
+    report = report.sort_values("ratio", ascending=False, kind="stable").reset_index(drop=True)
+    report.index = pd.RangeIndex(1, len(report) + 1, name="Rank")
+    return mask, report
@@ -0,0 +1,159 @@
+"""Module containing the stage profiler used to instrument Quantifier runs"""
+import json
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+import pandas as pd
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.profiler")
+
+
+class _StageRecord(dict):
+    """Dictionary holding the measurements of one stage"""
+
+    def set_shape(self, data):
+        """
+        Store the row and column counts of the data produced by the stage
+
+        :param data: DataFrame (or any object with a shape attribute) produced by the stage
+        """
+
+        shape = getattr(data, "shape", None)
+        if shape is None:
+            return
+        self["rows"] = int(shape[0])
+        self["columns"] = int(shape[1]) if len(shape) > 1 else 1
+
+    def add(self, key, value):
+        """Add an extra measurement (number of figures, files...) to the record"""
+
+        self[key] = value
+
+
+class _NullRecord:
+    """Record handed out when profiling is disabled. Every call is a no-op."""
+
+    def set_shape(self, data):
+        pass
+
+    def add(self, key, value):
+        pass
+
+
+_NULL_RECORD = _NullRecord()
+
+
+class StageProfiler:
+    """
+    Collect wall time, CPU time, peak memory and row/column counts for each stage of a run. When the profiler is
+    disabled, entering a stage only costs a boolean check.
+    """
+
+    def __init__(self, enabled=False):
+
+        self.enabled = enabled
+        self.records = []
+        # Stack of the stages currently running, used to keep the peak memory of nested stages consistent
+        self._stack = []
+
+    def __repr__(self):
+        return f"StageProfiler(enabled={self.enabled}, stages={len(self.records)})"
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager measuring the enclosed block
+
+        :param name: name of the stage in the report
+        :return: record on which the data shape and extra measurements can be set
+        """
+
+        if not self.enabled:
+            yield _NULL_RECORD
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        # Resetting the peak would lose the parent's peak so we fold it in the parent first
+        if self._stack:
+            self._stack[-1]["_peak"] = max(self._stack[-1]["_peak"], peak)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        record = _StageRecord(stage=name, rows=None, columns=None)
+        frame = {"_start_mem": current, "_peak": current}
+        self._stack.append(frame)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            self._stack.pop()
+            peak = max(frame["_peak"], tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1]["_peak"] = max(self._stack[-1]["_peak"], peak)
+            record.update(wall_time_s=round(wall, 6),
+                          cpu_time_s=round(cpu, 6),
+                          peak_memory_mb=round((peak - frame["_start_mem"]) / 1024 ** 2, 3))
+            self.records.append(record)
+            mod_logger.debug("Stage %s: %.4fs wall, %.4fs cpu, %.3f MB peak",
+                             name, wall, cpu, record["peak_memory_mb"])
+
+    @property
+    def report(self):
+        """Structured report: one dictionary per stage, in order of completion"""
+
+        return [dict(record) for record in self.records]
+
+    def to_frame(self):
+        """Return the report as a DataFrame"""
+
+        return pd.DataFrame(self.report, columns=["stage", "wall_time_s", "cpu_time_s",
+                                                  "peak_memory_mb", "rows", "columns"])
+
+    def dump(self, path):
+        """
+        Write the report to a json file
+
+        :param path: path of the json file to create
+        """
+
+        with open(path, "w") as json_file:
+            json.dump({"stages": self.report,
+                       "total_wall_time_s": round(sum(r["wall_time_s"] for r in self.records), 6)},
+                      json_file, indent=4)
+
+    def reset(self):
+        """Clear the collected records and stop memory tracing"""
+
+        self.records = []
+        self._stack = []
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def profiled(name, output=None):
+    """
+    Decorator to profile a Quantifier method as a stage. The instance must have a 'profiler' attribute.
+
+    :param name: name of the stage in the report
+    :param output: name of the attribute holding the data produced by the stage (used for row/column counts)
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self.profiler.enabled:
+                return func(self, *args, **kwargs)
+            with self.profiler.stage(name) as record:
+                result = func(self, *args, **kwargs)
+                if output is not None:
+                    record.set_shape(getattr(self, output, None))
+            return result
+
+        return wrapper
+
+    return decorator
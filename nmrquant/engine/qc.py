@@ -0,0 +1,95 @@
+"""Module containing the quality control of the runs on the signal of the internal standard"""
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from nmrquant.engine.outliers import robust_z
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.qc")
+
+# Default acceptance limits: coefficient of variation of the standard (%), drift of the standard over the run (% of
+# the mean, from the linear trend against spectrum order) and robust z-score of an outlying spectrum
+CV_LIMIT = 10.0
+DRIFT_LIMIT = 10.0
+Z_THRESHOLD = 3.5
+
+# Names of the area column of the usual chemical shift standards, looked for when no column is given
+STANDARD_NAMES = ("TSP", "TMSP", "DSS", "Standard")
+
+
+def find_standard(columns, name=None):
+    """
+    Find the area column of the standard in the data (the Strd column only flags the calibration and is not an area)
+
+    :param columns: columns of the data
+    :param name: name of the column (case and whitespace insensitive), or None to look for the usual standards
+    :return: name of the column, or None if there is none
+    """
+
+    by_name = {str(column).strip().casefold(): column for column in columns}
+    for wanted in [name] if name else STANDARD_NAMES:
+        column = by_name.get(str(wanted).strip().casefold())
+        if column is not None:
+            return column
+    return None
+
+
+def standard_qc(strd, cv_limit=CV_LIMIT, drift_limit=DRIFT_LIMIT, threshold=Z_THRESHOLD):
+    """
+    Quality control of the standard areas of all the spectra of a run, in one vectorized pass: coefficient of
+    variation, drift (linear trend of the areas against spectrum order) and outlying spectra (robust z-scores).
+
+    :param strd: standard area of each spectrum, indexed by spectrum number
+    :param cv_limit: maximum coefficient of variation (%)
+    :param drift_limit: maximum drift over the run (% of the mean area)
+    :param threshold: robust z-score above which a spectrum is an outlier
+    :return: tuple (DataFrame indexed by spectrum with the area, relative area, fitted trend, robust z-score and
+             outlier flag of each spectrum, Series summarizing the run with its status)
+    """
+
+    strd = pd.to_numeric(strd, errors="coerce").sort_index()
+    order = np.asarray(strd.index, dtype=float)
+    areas = strd.to_numpy(dtype=float)
+    valid = np.isfinite(areas)
+    n = int(valid.sum())
+    mean = areas[valid].mean() if n else np.nan
+    std = areas[valid].std(ddof=1) if n > 1 else np.nan
+    cv = 100 * std / mean if n > 1 and mean else np.nan
+    if n > 2 and np.ptp(order[valid]) > 0 and np.ptp(areas[valid]) > 0:
+        fit = stats.linregress(order[valid], areas[valid])
+        slope, intercept, p_value = fit.slope, fit.intercept, fit.pvalue
+    else:
+        slope, intercept, p_value = 0.0, mean, np.nan
+    trend = intercept + slope * order
+    drift = 100 * slope * np.ptp(order[valid]) / mean if n > 1 and mean else np.nan
+    scores = robust_z(areas.reshape(1, -1, 1)).ravel()
+    outliers = np.abs(scores) > threshold
+    spectra = pd.DataFrame({"Area": areas, "Relative": areas / mean, "Trend": trend, "Robust z": scores,
+                            "Outlier": outliers}, index=strd.index.rename("# Spectrum#"))
+    failures = [name for name, failed in [("CV", cv > cv_limit), ("drift", abs(drift) > drift_limit),
+                                          ("outliers", outliers.any())] if failed]
+    summary = pd.Series({"Spectra": n, "Mean": mean, "SD": std, "CV (%)": cv, "CV limit (%)": cv_limit,
+                         "Drift (%)": drift, "Drift p-value": p_value, "Drift limit (%)": drift_limit,
+                         "Slope (per spectrum)": slope, "Outliers": int(outliers.sum()),
+                         "Outlying spectra": ", ".join(str(spc) for spc in strd.index[outliers]),
+                         "Status": "fail: " + ", ".join(failures) if failures else "pass"}, name="Standard QC")
+    return spectra, summary
+
+
+def normalize_to_standard(areas, strd):
+    """
+    Divide the areas of each spectrum by the area of the standard of the spectrum
+
+    :param areas: areas indexed (or with an index level) by spectrum number
+    :param strd: standard area of each spectrum, indexed by spectrum number
+    :return: normalized areas
+    """
+
+    spectra = areas.index.get_level_values("# Spectrum#")
+    factors = pd.to_numeric(strd, errors="coerce").reindex(spectra).to_numpy(dtype=float)
+    if np.isnan(factors).any() or (factors == 0).any():
+        raise ValueError("The standard area is missing or null for spectra "
+                         f"{list(spectra[np.isnan(factors) | (factors == 0)])}, areas cannot be normalized")
+    return areas.div(factors, axis=0)
@@ -0,0 +1,635 @@
+"""
+Module containing the direct renderer of the simple bar and line plots: the drawing primitives of a plot (see the
+scenes method of the plot classes of the visualizer) are written directly as SVG, or rasterized to PNG, without going
+through the matplotlib figure and artist machinery
+"""
+import io
+import logging
+import math
+import struct
+import threading
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import numpy as np
+from matplotlib import colors as mcolors
+from matplotlib import font_manager, rcParams
+from matplotlib.ft2font import FT2Font
+from scipy import ndimage
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.render")
+
+RENDERERS = ("matplotlib", "direct")
+DIRECT_FORMATS = ("svg", "png")
+
+# Figure geometry in pixels (matplotlib default figure size and dpi) and font sizes in points
+WIDTH, HEIGHT = 640, 480
+DPI = 100
+PX = DPI / 72
+TICK_SIZE, LABEL_SIZE, TITLE_SIZE = 10, 10, 12
+TICK_LENGTH = 3.5 * PX
+# Approximate spacing of the ticks of numeric axes in pixels
+TICK_SPACING = 45
+LEGEND_COLUMNS = 5
+PNG_COMPRESSION = 3
+
+_font_lock = threading.Lock()
+
+# The figure manager of pyplot is global and not thread safe: every figure built and saved with pyplot outside of the
+# main thread (background jobs and explorer of the notebook) is built under this lock
+PYPLOT_LOCK = threading.RLock()
+
+
+class Scene:
+    """
+    Drawing primitives of one plot, in data coordinates: bars, lines, error bars, axis labels, categorical x ticks
+    and legend. Scenes are written as SVG or PNG with a fixed layout.
+    """
+
+    def __init__(self, title, xlabel=None, ylabel=None):
+
+        self.title = str(title)
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.bars = []
+        self.lines = []
+        self.errorbars = []
+        self.legend = []
+        self.categories = None
+        self.y_limits = (None, None)
+
+    def __repr__(self):
+        return f"Scene({self.title!r}: {len(self.bars)} bars, {len(self.lines)} lines, " \
+               f"{len(self.errorbars)} error bars)"
+
+    def add_bars(self, x, heights, colors, yerr=None, width=0.8):
+        """
+        Add bars (and their error bars)
+
+        :param x: bar centers
+        :param heights: bar heights
+        :param colors: color of each bar (cycled if shorter than the bars, as in matplotlib)
+        :param yerr: symmetric error of each bar
+        :param width: width of the bars in data units
+        """
+
+        x, heights = _floats(x), _floats(heights)
+        colors = [colors] if isinstance(colors, str) else list(colors)
+        for ind, (pos, height) in enumerate(zip(x, heights)):
+            self.bars.append((pos, height, width, _hex(colors[ind % len(colors)])))
+        if yerr is not None:
+            self.add_errorbars(x, heights, yerr, "#000000", capsize=0)
+
+    def add_line(self, x, y, color, label=None, dashed=False, width=1.5):
+        """
+        Add a line (broken at missing values, as in matplotlib)
+
+        :param x: x coordinates
+        :param y: y coordinates
+        :param color: line color
+        :param label: legend label (no legend entry if None)
+        :param dashed: draw a dashed line
+        :param width: line width in points
+        """
+
+        self.lines.append((_floats(x), _floats(y), _hex(color), dashed, width))
+        if label is not None:
+            self.legend.append((str(label), _hex(color)))
+
+    def add_errorbars(self, x, y, yerr, color, capsize=5):
+        """
+        Add vertical error bars
+
+        :param x: x coordinates
+        :param y: centers of the error bars
+        :param yerr: symmetric errors
+        :param color: color of the error bars
+        :param capsize: length of the caps in points
+        """
+
+        self.errorbars.append((_floats(x), _floats(y), _floats(yerr), _hex(color), capsize))
+
+    def set_categories(self, positions, labels):
+        """Use categorical x ticks, with labels rotated by 45 degrees"""
+
+        self.categories = (_floats(positions), [str(label) for label in labels])
+
+    def set_ylim(self, bottom=None, top=None):
+        """Fix the limits of the y axis (the missing ones are computed from the data)"""
+
+        self.y_limits = (bottom, top)
+
+    def to_svg(self):
+        """
+        :return: the plot as an SVG document (str)
+        """
+        return _to_svg(self._layout())
+
+    def to_png(self):
+        """
+        :return: the plot as a PNG image (bytes)
+        """
+        return _to_png(self._layout())
+
+    def save(self, path, fmt=None):
+        """
+        Write the plot to a file
+
+        :param path: path of the file
+        :param fmt: 'svg' or 'png' (deduced from the file suffix if None)
+        """
+
+        fmt = (fmt or Path(path).suffix.lstrip(".")).lower()
+        if fmt == "svg":
+            Path(path).write_text(self.to_svg(), encoding="utf-8")
+        elif fmt == "png":
+            Path(path).write_bytes(self.to_png())
+        else:
+            raise ValueError(f"The direct renderer writes {' and '.join(DIRECT_FORMATS)} files, not {fmt}")
+
+    def _data_limits(self):
+        """Limits of the axes in data coordinates, with the matplotlib margins (5% of the data range)"""
+
+        xs = [np.array([pos - width / 2, pos + width / 2]) for pos, _, width, _ in self.bars]
+        ys = [np.array([0.0, height]) for _, height, _, _ in self.bars]
+        xs += [x for x, _, _, _, _ in self.lines] + [x for x, _, _, _, _ in self.errorbars]
+        ys += [y for _, y, _, _, _ in self.lines]
+        ys += [values for _, y, err, _, _ in self.errorbars for values in (y - err, y + err)]
+        x_low, x_high = _finite_range(xs)
+        y_low, y_high = _finite_range(ys)
+        x_low, x_high = _margins(x_low, x_high)
+        if self.bars and y_low >= 0:
+            # Bars stick to the bottom of the axes
+            _, y_high = _margins(0.0, y_high)
+        else:
+            y_low, y_high = _margins(y_low, y_high)
+        bottom, top = self.y_limits
+        y_low = y_low if bottom is None else bottom
+        y_high = y_high if top is None or not np.isfinite(top) else top
+        if y_high <= y_low:
+            y_high = y_low + 1
+        return x_low, x_high, y_low, y_high
+
+    def _layout(self):
+        """
+        Place every element of the plot on the figure
+
+        :return: tuple (box of the axes in pixels, list of (clipped to the axes, item)), items being ('rect', x0, y0,
+                 x1, y1, color), ('frame', x0, y0, x1, y1, color), ('line', points, color, width, dashed) or
+                 ('text', x, y, text, size, color, ha, va, rotation), in pixels
+        """
+
+        x_low, x_high, y_low, y_high = self._data_limits()
+        tick_height = _line_height(TICK_SIZE)
+        label_height = _line_height(LABEL_SIZE)
+
+        # Margins around the axes (the y ticks depend on the height of the axes, the left margin on the y ticks)
+        top = 8 + _line_height(TITLE_SIZE) * len(self.title.split("\n")) + 4
+        bottom = 8 + TICK_LENGTH + 4
+        if self.categories is not None:
+            widest = max([_text_width(label, TICK_SIZE) for label in self.categories[1]], default=0)
+            bottom += min((widest + tick_height) * math.sqrt(0.5), HEIGHT / 3)
+        else:
+            bottom += tick_height
+        if self.xlabel:
+            bottom += label_height + 4
+        legend_rows = math.ceil(len(self.legend) / LEGEND_COLUMNS)
+        legend_width = 0
+        if self.legend:
+            column_width = 30 + max(_text_width(label, TICK_SIZE) for label, _ in self.legend)
+            legend_width = min(len(self.legend), LEGEND_COLUMNS) * column_width + 8
+            bottom += legend_rows * (tick_height + 4) + 16
+        y_ticks, y_labels = nice_ticks(y_low, y_high, (HEIGHT - bottom - top) / TICK_SPACING)
+        left = 8 + TICK_LENGTH + 4 + max([_text_width(label, TICK_SIZE) for label in y_labels], default=0)
+        if self.ylabel:
+            left += label_height + 4
+        box = (left, top, WIDTH - 20, HEIGHT - bottom)
+        if self.categories is not None:
+            x_ticks, x_labels = self.categories
+        else:
+            x_ticks, x_labels = nice_ticks(x_low, x_high, (box[2] - box[0]) / TICK_SPACING)
+
+        def to_x(values):
+            return box[0] + (np.asarray(values, dtype=float) - x_low) / (x_high - x_low) * (box[2] - box[0])
+
+        def to_y(values):
+            return box[3] - (np.asarray(values, dtype=float) - y_low) / (y_high - y_low) * (box[3] - box[1])
+
+        items = []
+        for pos, height, width, color in self.bars:
+            if not np.isfinite(height):
+                continue
+            x0, x1 = to_x([pos - width / 2, pos + width / 2])
+            y0, y1 = sorted(to_y([0.0, height]))
+            items.append((True, ("rect", x0, y0, x1, y1, color)))
+        for x, y, err, color, capsize in self.errorbars:
+            valid = np.isfinite(x) & np.isfinite(y) & np.isfinite(err)
+            for pos, low, high in zip(to_x(x[valid]), to_y(y[valid] - err[valid]), to_y(y[valid] + err[valid])):
+                items.append((True, ("line", np.array([[pos, low], [pos, high]]), color, 1.5 * PX, False)))
+                if capsize:
+                    cap = capsize * PX / 2
+                    for end in (low, high):
+                        items.append((True, ("line", np.array([[pos - cap, end], [pos + cap, end]]), color,
+                                             1.5 * PX, False)))
+        for x, y, color, dashed, width in self.lines:
+            points = np.column_stack([to_x(x), to_y(y)])
+            for run in _finite_runs(points):
+                items.append((True, ("line", run, color, width * PX, dashed)))
+
+        # Axes frame, ticks and labels
+        items.append((False, ("frame", box[0], box[1], box[2], box[3], "#000000")))
+        for tick, label in zip(to_y(y_ticks), y_labels):
+            items.append((False, ("line", np.array([[box[0] - TICK_LENGTH, tick], [box[0], tick]]), "#000000",
+                                  0.8 * PX, False)))
+            items.append((False, ("text", box[0] - TICK_LENGTH - 3, tick, label, TICK_SIZE, "#000000", "right",
+                                  "center", 0)))
+        for tick, label in zip(to_x(x_ticks), x_labels):
+            if not box[0] - 0.5 <= tick <= box[2] + 0.5:
+                continue
+            items.append((False, ("line", np.array([[tick, box[3]], [tick, box[3] + TICK_LENGTH]]), "#000000",
+                                  0.8 * PX, False)))
+            if self.categories is not None:
+                items.append((False, ("text", tick, box[3] + TICK_LENGTH + 3, label, TICK_SIZE, "#000000", "right",
+                                      "top", 45)))
+            else:
+                items.append((False, ("text", tick, box[3] + TICK_LENGTH + 3, label, TICK_SIZE, "#000000", "center",
+                                      "top", 0)))
+        center = (box[0] + box[2]) / 2
+        for ind, line in enumerate(self.title.split("\n")):
+            items.append((False, ("text", center, 8 + ind * _line_height(TITLE_SIZE), line, TITLE_SIZE, "#000000",
+                                  "center", "top", 0)))
+        if self.ylabel:
+            items.append((False, ("text", 8, (box[1] + box[3]) / 2, self.ylabel, LABEL_SIZE, "#000000", "center",
+                                  "top", 90)))
+        position = HEIGHT - 8 - (legend_rows * (tick_height + 4) + 16 if self.legend else 0)
+        if self.xlabel:
+            items.append((False, ("text", center, position - label_height, self.xlabel, LABEL_SIZE, "#000000",
+                                  "center", "top", 0)))
+        if self.legend:
+            x0 = center - legend_width / 2
+            y0 = position + 8
+            items.append((False, ("frame", x0, y0, x0 + legend_width, y0 + legend_rows * (tick_height + 4) + 4,
+                                  "#cccccc")))
+            for ind, (label, color) in enumerate(self.legend):
+                row, column = divmod(ind, LEGEND_COLUMNS)
+                x = x0 + 4 + column * column_width
+                y = y0 + 4 + row * (tick_height + 4) + tick_height / 2
+                items.append((False, ("line", np.array([[x, y], [x + 20, y]]), color, 1.5 * PX, False)))
+                items.append((False, ("text", x + 26, y, label, TICK_SIZE, "#000000", "left", "center", 0)))
+        return box, items
+
+
+def nice_ticks(low, high, target=6):
+    """
+    Ticks of an axis at round values (1, 2, 2.5 or 5 times a power of ten), as the matplotlib default locator
+
+    :param low: lower limit of the axis
+    :param high: upper limit of the axis
+    :param target: approximate number of ticks
+    :return: tuple (tick positions, tick labels)
+    """
+
+    span = high - low
+    if not np.isfinite(span) or span <= 0:
+        return np.array([]), []
+    raw = span / max(target, 2)
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(mult * magnitude for mult in (1, 2, 2.5, 5, 10) if mult * magnitude >= raw * 0.999)
+    ticks = np.arange(math.ceil(low / step - 1e-9), math.floor(high / step + 1e-9) + 1) * step
+    decimals = max(0, -math.floor(math.log10(step) + 1e-9))
+    if round(step / magnitude, 1) == 2.5:
+        decimals += 1
+    return ticks, [f"{tick:.{decimals}f}" if abs(tick) > step * 1e-9 else f"{0:.{decimals}f}" for tick in ticks]
+
+
+def render_plot(plot, fmt, renderer="matplotlib", **savefig_kwargs):
+    """
+    Render the figure(s) of a plot object of the visualizer in memory
+
+    :param plot: plot object (IndHistA, IndHistB, MultHistB, NoRepIndLine, IndLine or MeanLine)
+    :param fmt: file format
+    :param renderer: 'matplotlib' or 'direct'. Formats the direct renderer does not write fall back to matplotlib
+    :param savefig_kwargs: extra arguments of savefig (matplotlib renderer)
+    :return: list of (file name, file content as bytes), file names being the metabolite (and the condition for
+             plots with one figure per condition)
+    """
+
+    if renderer not in RENDERERS:
+        raise ValueError(f"Unknown renderer '{renderer}'. Choose one of {RENDERERS}")
+    if renderer == "direct" and fmt.lower() in DIRECT_FORMATS:
+        return [(fname, scene.to_svg().encode("utf-8") if fmt.lower() == "svg" else scene.to_png())
+                for fname, scene in plot.scenes()]
+    if renderer == "direct":
+        mod_logger.debug("The direct renderer does not write %s files, falling back to matplotlib", fmt)
+    import matplotlib.pyplot as plt
+    rendered = []
+    with PYPLOT_LOCK:
+        figures = plot()
+        if not isinstance(figures, list):
+            figures = [(plot.metabolite, figures)]
+        for fname, fig in figures:
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format=fmt, **savefig_kwargs)
+            plt.close(fig)
+            rendered.append((fname, buffer.getvalue()))
+    return rendered
+
+
+def save_plot(plot, fmt, directory=".", renderer="matplotlib", **savefig_kwargs):
+    """
+    Save the figure(s) of a plot object of the visualizer, one file per figure (see render_plot)
+
+    :param plot: plot object (IndHistA, IndHistB, MultHistB, NoRepIndLine, IndLine or MeanLine)
+    :param fmt: file format
+    :param directory: folder in which the files are written
+    :param renderer: 'matplotlib' or 'direct'
+    :param savefig_kwargs: extra arguments of savefig (matplotlib renderer)
+    :return: list of the paths of the written files
+    """
+
+    paths = []
+    for fname, content in render_plot(plot, fmt, renderer, **savefig_kwargs):
+        path = Path(directory) / f"{fname}.{fmt}"
+        path.write_bytes(content)
+        paths.append(path)
+    return paths
+
+
+def _floats(values):
+    return np.asarray(values, dtype=float).ravel()
+
+
+def _hex(color):
+    # Colormaps give colors as hex strings or as lists of RGB fractions
+    return _to_hex(color if isinstance(color, str) else tuple(color))
+
+
+@lru_cache(maxsize=1024)
+def _to_hex(color):
+    return mcolors.to_hex(color)
+
+
+def _finite_range(arrays):
+    """Minimum and maximum of the finite values of a list of arrays ((0, 1) if there are none)"""
+
+    values = np.concatenate([np.ravel(array) for array in arrays]) if arrays else np.array([])
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return 0.0, 1.0
+    return float(values.min()), float(values.max())
+
+
+def _margins(low, high, margin=0.05):
+    if high == low:
+        return low - 0.5, high + 0.5
+    span = high - low
+    return low - span * margin, high + span * margin
+
+
+def _finite_runs(points):
+    """Split a polyline at its missing points"""
+
+    valid = np.isfinite(points).all(axis=1)
+    bounds = np.flatnonzero(np.diff(np.concatenate([[0], valid.astype(int), [0]])))
+    return [points[start:stop] for start, stop in zip(bounds[::2], bounds[1::2])]
+
+
+@lru_cache(maxsize=1)
+def _font():
+    return FT2Font(font_manager.findfont(font_manager.FontProperties(family=rcParams["font.family"])))
+
+
+def _line_height(size):
+    return size * PX * 1.2
+
+
+@lru_cache(maxsize=4096)
+def _text_width(text, size):
+    """
+    Width of a text in pixels
+
+    :param text: text
+    :param size: font size in points
+    :return: width in pixels
+    """
+
+    with _font_lock:
+        font = _font()
+        font.set_size(size, DPI)
+        font.set_text(text, 0.0)
+        return font.get_width_height()[0] / 64
+
+
+# Anchor of the text relative to its baseline (fraction of the font size in pixels)
+_BASELINE = {"top": 0.76, "center": 0.38, "baseline": 0.0}
+_SVG_ANCHOR = {"left": "start", "center": "middle", "right": "end"}
+
+
+@lru_cache(maxsize=4096)
+def _text_bitmap(text, size, ha, va, rotation):
+    """
+    Rasterize a text with the matplotlib font
+
+    :return: tuple (coverage of each pixel between 0 and 1, column and row offsets of the bitmap from the anchor)
+    """
+
+    with _font_lock:
+        font = _font()
+        font.set_size(size, DPI)
+        font.set_text(text, 0.0)
+        font.draw_glyphs_to_bitmap(antialiased=True)
+        bitmap = np.asarray(font.get_image(), dtype=np.float32) / 255
+        width = font.get_width_height()[0] / 64
+        descent = font.get_descent() / 64
+    if not bitmap.size:
+        return bitmap, 0, 0
+    # Position of the top left corner of the bitmap in the text frame (u along the text, v downwards), whose origin
+    # is the anchor
+    u0 = {"left": 0.0, "center": -width / 2, "right": -width}[ha]
+    v0 = _BASELINE[va] * size * PX - (bitmap.shape[0] - descent)
+    if not rotation:
+        return bitmap, int(round(u0)), int(round(v0))
+    if rotation == 90:
+        # Exact rotation of the bitmap: the top of the text faces left, the text frame is (u, v) -> (v, -u)
+        return np.rot90(bitmap), int(round(v0)), int(round(-u0 - bitmap.shape[1]))
+    cos, sin = math.cos(math.radians(rotation)), math.sin(math.radians(rotation))
+    corners = np.array([[u0, v0], [u0 + bitmap.shape[1], v0], [u0, v0 + bitmap.shape[0]],
+                        [u0 + bitmap.shape[1], v0 + bitmap.shape[0]]])
+    xs = corners[:, 0] * cos + corners[:, 1] * sin
+    ys = -corners[:, 0] * sin + corners[:, 1] * cos
+    col0, row0 = math.floor(xs.min()), math.floor(ys.min())
+    rows, cols = np.mgrid[row0:math.ceil(ys.max()) + 1, col0:math.ceil(xs.max()) + 1] + 0.5
+    # Sample the unrotated bitmap at the position of each pixel of the rotated one
+    u = cols * cos - rows * sin
+    v = cols * sin + rows * cos
+    rotated = ndimage.map_coordinates(bitmap, [v - v0 - 0.5, u - u0 - 0.5], order=1, cval=0.0)
+    return np.clip(rotated, 0, 1), col0, row0
+
+
+def _to_svg(layout):
+    """Write a laid out scene as an SVG document"""
+
+    box, items = layout
+    family = ", ".join(rcParams["font.sans-serif"][:1] + ["sans-serif"])
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{WIDTH}" height="{HEIGHT}" '
+             f'viewBox="0 0 {WIDTH} {HEIGHT}" font-family="{escape(family)}">',
+             f'<clipPath id="axes"><rect x="{box[0]:.1f}" y="{box[1]:.1f}" width="{box[2] - box[0]:.1f}" '
+             f'height="{box[3] - box[1]:.1f}"/></clipPath>',
+             f'<rect width="{WIDTH}" height="{HEIGHT}" fill="#ffffff"/>',
+             '<g clip-path="url(#axes)">']
+    clipped = True
+    for in_axes, item in items:
+        if clipped and not in_axes:
+            parts.append("</g>")
+            clipped = False
+        kind = item[0]
+        if kind == "rect":
+            _, x0, y0, x1, y1, color = item
+            parts.append(f'<rect x="{x0:.1f}" y="{y0:.1f}" width="{x1 - x0:.1f}" height="{y1 - y0:.1f}" '
+                         f'fill="{color}"/>')
+        elif kind == "frame":
+            _, x0, y0, x1, y1, color = item
+            parts.append(f'<rect x="{x0:.1f}" y="{y0:.1f}" width="{x1 - x0:.1f}" height="{y1 - y0:.1f}" '
+                         f'fill="none" stroke="{color}" stroke-width="{0.8 * PX:.2f}"/>')
+        elif kind == "line":
+            _, points, color, width, dashed = item
+            coords = " ".join(f"{x:.1f},{y:.1f}" for x, y in points)
+            dash = f' stroke-dasharray="{3.7 * width:.1f},{1.6 * width:.1f}"' if dashed else ""
+            parts.append(f'<polyline points="{coords}" fill="none" stroke="{color}" stroke-width="{width:.2f}" '
+                         f'stroke-linejoin="round"{dash}/>')
+        else:
+            _, x, y, text, size, color, ha, va, rotation = item
+            transform = f' transform="rotate({-rotation} {x:.1f} {y:.1f})"' if rotation else ""
+            parts.append(f'<text x="{x:.1f}" y="{y + _BASELINE[va] * size * PX:.1f}" font-size="{size * PX:.1f}" '
+                         f'fill="{color}" text-anchor="{_SVG_ANCHOR[ha]}"{transform}>{escape(text)}</text>')
+    if clipped:
+        parts.append("</g>")
+    parts.append("</svg>\n")
+    return "\n".join(parts)
+
+
+@lru_cache(maxsize=1024)
+def _rgb(color):
+    return np.array(mcolors.to_rgb(color), dtype=np.float32) * 255
+
+
+def _blend(pixels, coverage, color):
+    """Blend a color into pixels (uint8 RGB array) with the given coverage (between 0 and 1)"""
+
+    pixels = pixels.astype(np.float32)
+    return np.round(pixels + (_rgb(color) - pixels) * coverage[..., None]).astype(np.uint8)
+
+
+def _fill(canvas, x0, y0, x1, y1, color, clip):
+    """Fill a rectangle, snapped to the pixel grid (at least one pixel wide)"""
+
+    x0, x1 = int(round(x0)), max(int(round(x1)), int(round(x0)) + 1)
+    y0, y1 = int(round(y0)), max(int(round(y1)), int(round(y0)) + 1)
+    x0, x1, y0, y1 = max(x0, clip[0]), min(x1, clip[2]), max(y0, clip[1]), min(y1, clip[3])
+    if x1 > x0 and y1 > y0:
+        canvas[y0:y1, x0:x1] = np.round(_rgb(color)).astype(np.uint8)
+
+
+def _draw_line(canvas, points, color, width, dashed, clip):
+    """Rasterize a polyline: rectangles for straight horizontal or vertical strokes, else an antialiased disc
+    stamped along the line"""
+
+    segments = np.diff(points, axis=0)
+    if not len(segments):
+        return
+    if len(segments) == 1 and not dashed and (segments[0] == 0).any():
+        (x0, y0), (x1, y1) = np.sort(points, axis=0)
+        thickness = max(1, int(round(width)))
+        if x0 == x1:
+            x0 = math.floor(x0 - thickness / 2 + 0.5)
+            x1 = x0 + thickness
+        else:
+            y0 = math.floor(y0 - thickness / 2 + 0.5)
+            y1 = y0 + thickness
+        _fill(canvas, x0, y0, x1, y1, color, clip)
+        return
+    lengths = np.hypot(segments[:, 0], segments[:, 1])
+    steps = np.maximum(np.ceil(lengths).astype(int), 1)
+    segment = np.repeat(np.arange(len(steps)), steps)
+    fraction = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+    samples = np.vstack([points[:-1][segment] + segments[segment] * fraction[:, None], points[-1:]])
+    if dashed:
+        position = np.append(np.repeat(np.cumsum(lengths) - lengths, steps) + lengths[segment] * fraction,
+                             lengths.sum())
+        samples = samples[position % (5.3 * width) < 3.7 * width]
+    radius = width / 2
+    reach = int(math.ceil(radius + 0.5))
+    offsets = np.arange(-reach, reach + 1)
+    cols = (np.floor(samples[:, 0]).astype(int)[:, None, None] + offsets[None, None, :])
+    rows = (np.floor(samples[:, 1]).astype(int)[:, None, None] + offsets[None, :, None])
+    cols, rows = np.broadcast_arrays(cols, rows)
+    distance = np.hypot(cols + 0.5 - samples[:, 0, None, None], rows + 0.5 - samples[:, 1, None, None])
+    coverage = np.clip(radius + 0.5 - distance, 0, 1)
+    inside = (coverage > 0) & (cols >= clip[0]) & (cols < clip[2]) & (rows >= clip[1]) & (rows < clip[3])
+    if not inside.any():
+        return
+    rows, cols, coverage = rows[inside], cols[inside], coverage[inside]
+    # Each pixel takes the largest coverage of the samples touching it (on a layer covering the line only)
+    top, left = rows.min(), cols.min()
+    layer = np.zeros((rows.max() - top + 1, cols.max() - left + 1), dtype=np.float32)
+    np.maximum.at(layer, (rows - top, cols - left), coverage)
+    touched_rows, touched_cols = np.nonzero(layer)
+    region = canvas[top:top + layer.shape[0], left:left + layer.shape[1]]
+    region[touched_rows, touched_cols] = _blend(region[touched_rows, touched_cols],
+                                                layer[touched_rows, touched_cols], color)
+
+
+def _draw_text(canvas, x, y, text, size, color, ha, va, rotation):
+    bitmap, col0, row0 = _text_bitmap(text, size, ha, va, rotation)
+    col0 += int(round(x))
+    row0 += int(round(y))
+    top, left = max(row0, 0), max(col0, 0)
+    bottom, right = min(row0 + bitmap.shape[0], canvas.shape[0]), min(col0 + bitmap.shape[1], canvas.shape[1])
+    if bottom <= top or right <= left:
+        return
+    coverage = bitmap[top - row0:bottom - row0, left - col0:right - col0]
+    canvas[top:bottom, left:right] = _blend(canvas[top:bottom, left:right], coverage, color)
+
+
+def _to_png(layout):
+    """Rasterize a laid out scene as a PNG image"""
+
+    box, items = layout
+    canvas = np.full((HEIGHT, WIDTH, 3), 255, dtype=np.uint8)
+    axes = (int(round(box[0])), int(round(box[1])), int(round(box[2])) + 1, int(round(box[3])) + 1)
+    full = (0, 0, WIDTH, HEIGHT)
+    for in_axes, item in items:
+        kind = item[0]
+        if kind == "rect":
+            _fill(canvas, *item[1:], axes)
+        elif kind == "frame":
+            _, x0, y0, x1, y1, color = item
+            for start, stop in [((x0, y0), (x1, y0)), ((x1, y0), (x1, y1)), ((x0, y1), (x1, y1)),
+                                ((x0, y0), (x0, y1))]:
+                _draw_line(canvas, np.array([start, stop]), color, 0.8 * PX, False, full)
+        elif kind == "line":
+            _, points, color, width, dashed = item
+            _draw_line(canvas, points, color, width, dashed, axes if in_axes else full)
+        else:
+            _draw_text(canvas, *item[1:])
+    return encode_png(canvas)
+
+
+def encode_png(image):
+    """
+    Encode an RGB image as PNG
+
+    :param image: uint8 array of shape (height, width, 3)
+    :return: PNG file content (bytes)
+    """
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    height, width = image.shape[:2]
+    # Each row starts with its filter type (0: no filter)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)], axis=1)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) \
+        + chunk(b"IDAT", zlib.compress(raw.tobytes(), PNG_COMPRESSION)) + chunk(b"IEND", b"")
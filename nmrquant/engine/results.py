@@ -0,0 +1,153 @@
+"""Module containing the compact array-backed storage of quantification results"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.results")
+
+
+def _smallest_int(codes):
+    """Cast integer codes to the smallest signed integer type holding them (codes are -1 for missing labels)"""
+
+    high = int(codes.max()) if codes.size else 0
+    for dtype in (np.int8, np.int16, np.int32):
+        if high <= np.iinfo(dtype).max:
+            return codes.astype(dtype, copy=False)
+    return codes.astype(np.int64, copy=False)
+
+
+class ResultsCube:
+    """
+    Results stored as one contiguous float array (spectra x metabolites) and integer-coded index levels (conditions,
+    time points, replicates, spectra). DataFrames are built on demand as views on the array, without copying the
+    values, so that the same numbers are not held several times and pickling only carries the raw arrays.
+    """
+
+    def __init__(self, values, codes, levels, names, columns, dtypes=None):
+        """
+        :param values: 2D array of values (rows x columns)
+        :param codes: 2D array of integer codes (index levels x rows)
+        :param levels: list of the labels of each index level
+        :param names: names of the index levels
+        :param columns: column labels
+        :param dtypes: dtypes of the columns given back by to_frame (None if they are all float64)
+        """
+
+        self.values = np.ascontiguousarray(values, dtype=float)
+        self.codes = _smallest_int(np.asarray(codes).reshape(len(names), -1))
+        self.levels = [pd.Index(level) for level in levels]
+        self.names = list(names)
+        self.columns = pd.Index(columns)
+        if self.values.shape != (self.codes.shape[1], len(self.columns)):
+            raise ValueError(f"Values of shape {self.values.shape} do not match {self.codes.shape[1]} index rows and "
+                             f"{len(self.columns)} columns")
+        self.dtypes = None if dtypes is None else list(dtypes)
+        self._frame = None
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Build the cube from a DataFrame with numeric columns
+
+        :param frame: DataFrame (with a MultiIndex or a simple index)
+        :return: ResultsCube
+        """
+
+        index = frame.index
+        if isinstance(index, pd.MultiIndex):
+            codes = np.vstack([np.asarray(level_codes) for level_codes in index.codes]) if index.nlevels else None
+            levels = list(index.levels)
+        else:
+            level_codes, uniques = pd.factorize(index, use_na_sentinel=False)
+            codes, levels = level_codes[None, :], [uniques]
+        dtypes = list(frame.dtypes)
+        if all(dtype == np.float64 for dtype in dtypes):
+            dtypes = None
+        return cls(frame.to_numpy(dtype=float), codes, levels, index.names, frame.columns, dtypes)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __repr__(self):
+        return f"ResultsCube({self.values.shape[0]} rows x {self.values.shape[1]} columns, index={self.names}, " \
+               f"{self.nbytes / 1e6:.2f} MB)"
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        """Memory used by the values and codes"""
+
+        return self.values.nbytes + self.codes.nbytes
+
+    @property
+    def index(self):
+        """Index of the rows, rebuilt from the codes"""
+
+        if len(self.names) == 1:
+            return self.levels[0].take(self.codes[0]).rename(self.names[0])
+        return pd.MultiIndex(levels=self.levels, codes=list(self.codes), names=self.names, verify_integrity=False)
+
+    def level_values(self, name):
+        """
+        Labels of one index level for every row
+
+        :param name: name of the index level
+        :return: Index of labels
+        """
+
+        position = self.names.index(name)
+        return self.levels[position].take(self.codes[position])
+
+    def to_frame(self):
+        """
+        DataFrame view of the results (the values are not copied, and the view is only built once). Columns that were
+        not float64 in the original data are given back with their dtype, as copies.
+
+        :return: DataFrame indexed like the original data
+        """
+
+        if self._frame is None:
+            if self.dtypes is None:
+                self._frame = pd.DataFrame(self.values, index=self.index, columns=self.columns, copy=False)
+            else:
+                index = self.index
+                self._frame = pd.DataFrame({position: pd.Series(self.values[:, position], index=index).astype(dtype)
+                                            for position, dtype in enumerate(self.dtypes)}, index=index)
+                self._frame.columns = self.columns
+        return self._frame
+
+    def sync(self):
+        """
+        Take back the changes of the DataFrame view that did not reach the array: cell writes do, but added, removed
+        or replaced columns and changed rows only modify the DataFrame. The DataFrame is kept as it is.
+
+        :return: self
+        """
+
+        frame = self._frame
+        if frame is None:
+            return self
+        values = frame.to_numpy(dtype=float)
+        # The view still stands on the array (no column was replaced) and has the same labels
+        if values.shape == self.values.shape and np.shares_memory(values, self.values) \
+                and frame.columns.equals(self.columns) and frame.index.equals(self.index):
+            return self
+        synced = ResultsCube.from_frame(frame)
+        self.values, self.codes, self.levels, self.names, self.columns, self.dtypes = \
+            synced.values, synced.codes, synced.levels, synced.names, synced.columns, synced.dtypes
+        mod_logger.debug("Results cube synchronized with its DataFrame (%s)", self)
+        return self
+
+    def __getstate__(self):
+        # Only the raw arrays are pickled, the DataFrame view is rebuilt on demand
+        self.sync()
+        return {"values": self.values, "codes": self.codes, "levels": self.levels, "names": self.names,
+                "columns": self.columns, "dtypes": self.dtypes}
+
+    def __setstate__(self, state):
+        # Cubes pickled before the dtypes were kept only hold float64 columns
+        self.__init__(**state)
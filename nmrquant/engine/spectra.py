@@ -0,0 +1,239 @@
+"""Module containing the reading and integration of processed 1D spectra (Bruker pdata or NumPy arrays)"""
+import logging
+import re
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.spectra")
+
+# Number of spectra integrated at once (bounds the memory used by the cumulative sums)
+CHUNK_SIZE = 256
+
+# Default width (in ppm) of the integration regions defined by a single ppm position in the database
+DEFAULT_WIDTH = 0.02
+
+_BRUKER_DTYPES = {0: "i4", 2: "f8"}
+
+
+class Axis(namedtuple("Axis", ["offset", "step", "size"])):
+    """
+    Linear chemical shift axis of a spectrum: the ppm of point i is offset - i * step (step is positive for the
+    usual decreasing ppm axis)
+    """
+
+    @classmethod
+    def from_ppm(cls, ppm):
+        """Build the axis from an evenly spaced array of chemical shifts"""
+
+        ppm = np.asarray(ppm, dtype=float)
+        if ppm.size < 2:
+            raise ValueError("The ppm axis must contain at least 2 points")
+        step = (ppm[0] - ppm[-1]) / (ppm.size - 1)
+        if not np.allclose(np.diff(ppm), -step, rtol=1e-3, atol=0):
+            raise ValueError("The ppm axis must be evenly spaced")
+        return cls(float(ppm[0]), float(step), int(ppm.size))
+
+    @property
+    def ppm(self):
+        return self.offset - np.arange(self.size) * self.step
+
+    def bounds(self, ppm_min, ppm_max):
+        """
+        Indices [start, stop) of the points inside ppm regions
+
+        :param ppm_min: array of lower bounds of the regions
+        :param ppm_max: array of upper bounds of the regions
+        :return: tuple of arrays (start, stop)
+        """
+
+        from_max = (self.offset - np.asarray(ppm_max, dtype=float)) / self.step
+        from_min = (self.offset - np.asarray(ppm_min, dtype=float)) / self.step
+        first, last = np.minimum(from_max, from_min), np.maximum(from_max, from_min)
+        start = np.clip(np.ceil(first), 0, self.size).astype(int)
+        stop = np.clip(np.floor(last) + 1, 0, self.size).astype(int)
+        return start, np.maximum(start, stop)
+
+
+def read_procs(path):
+    """
+    Read the parameters of a Bruker JCAMP-DX parameter file (procs, acqus...)
+
+    :param path: path to the parameter file
+    :return: dict of parameters (numbers are converted, arrays are kept as strings)
+    """
+
+    params = {}
+    for match in re.finditer(r"^##\$?([\w\-]+)=\s*(.*)$", Path(path).read_text(errors="replace"), re.MULTILINE):
+        key, value = match.groups()
+        try:
+            params[key] = float(value) if any(c in value for c in ".eE") else int(value)
+        except ValueError:
+            params[key] = value.strip("<> ")
+    return params
+
+
+def read_bruker_header(pdata):
+    """
+    Read the layout of a processed Bruker spectrum from its procs file, without opening the data
+
+    :param pdata: path to the processing folder (containing the 1r and procs files)
+    :return: tuple (dtype of the intensities, Axis, scaling factor of the intensities)
+    """
+
+    pdata = Path(pdata)
+    procs = read_procs(pdata / "procs")
+    dtype = _BRUKER_DTYPES.get(procs.get("DTYPP", 0))
+    if dtype is None:
+        raise ValueError(f"Unsupported Bruker data type (DTYPP={procs['DTYPP']}) in {pdata}")
+    dtype = (">" if procs.get("BYTORDP", 0) == 1 else "<") + dtype
+    size = int(procs["SI"])
+    axis = Axis(float(procs["OFFSET"]), float(procs["SW_p"]) / float(procs["SF"]) / size, size)
+    # Integer spectra are stored with a scaling exponent
+    scale = 2.0 ** procs.get("NC_proc", 0) if dtype.endswith("i4") else 1.0
+    return dtype, axis, scale
+
+
+def read_bruker(pdata):
+    """
+    Memory-map the real part of a processed Bruker spectrum
+
+    :param pdata: path to the processing folder (containing the 1r and procs files)
+    :return: tuple (memory-mapped intensities, Axis, scaling factor of the intensities)
+    """
+
+    dtype, axis, scale = read_bruker_header(pdata)
+    data = np.memmap(Path(pdata) / "1r", dtype=dtype, mode="r", shape=(axis.size,))
+    return data, axis, scale
+
+
+def find_bruker_spectra(folder, procno=1):
+    """
+    Find the processed spectra of a Bruker dataset folder (one numbered experiment folder per spectrum)
+
+    :param folder: dataset folder
+    :param procno: processing number to use
+    :return: dict of spectrum number (experiment number) to processing folder
+    """
+
+    spectra = {}
+    for expno in Path(folder).iterdir():
+        pdata = expno / "pdata" / str(procno)
+        if expno.name.isdigit() and (pdata / "1r").is_file():
+            spectra[int(expno.name)] = pdata
+    if not spectra:
+        raise FileNotFoundError(f"No processed Bruker spectra (*/pdata/{procno}/1r) found in {folder}")
+    return dict(sorted(spectra.items()))
+
+
+def regions_from_db(database, width=DEFAULT_WIDTH):
+    """
+    Integration regions of the database. Regions are given by "ppm_min" and "ppm_max" columns, or by a "ppm"
+    column (center of the region) and an optional "width" column (default width otherwise).
+
+    :param database: proton database with one row per integration region
+    :param width: default width of the regions in ppm
+    :return: DataFrame indexed by region name with ppm_min and ppm_max columns
+    """
+
+    def numeric(column):
+        values = database[column]
+        if values.dtype == object:
+            values = values.astype(str).str.replace(",", ".")
+        return pd.to_numeric(values, errors="coerce")
+
+    # Names are kept as in the database so that the integrated areas match the proton counts
+    names = database["Metabolite"].astype(str)
+    if {"ppm_min", "ppm_max"}.issubset(database.columns):
+        low, high = numeric("ppm_min"), numeric("ppm_max")
+    elif "ppm" in database.columns:
+        center = numeric("ppm")
+        half = (numeric("width") if "width" in database.columns else pd.Series(width, index=database.index)) / 2
+        half = half.fillna(width / 2)
+        low, high = center - half, center + half
+    else:
+        raise KeyError("The database must contain 'ppm' or 'ppm_min' and 'ppm_max' columns to integrate spectra")
+    regions = pd.DataFrame({"ppm_min": np.minimum(low, high).to_numpy(),
+                            "ppm_max": np.maximum(low, high).to_numpy()}, index=pd.Index(names, name="Region"))
+    missing = regions.isna().any(axis=1)
+    if missing.any():
+        mod_logger.warning("No ppm region for: %s. They will not be integrated", list(regions.index[missing]))
+    return regions[~missing]
+
+
+def integrate(spectra, axis, regions, scale=1.0):
+    """
+    Integrate all the regions of a stack of spectra sharing the same axis in one vectorized pass (sums of the
+    intensities in each region, times the ppm step, obtained from cumulative sums)
+
+    :param spectra: array of shape (spectra, points)
+    :param axis: Axis of the spectra
+    :param regions: DataFrame of regions (see regions_from_db)
+    :param scale: scaling factor of the intensities
+    :return: array of areas of shape (spectra, regions)
+    """
+
+    start, stop = axis.bounds(regions["ppm_min"].to_numpy(), regions["ppm_max"].to_numpy())
+    cumulated = np.zeros((spectra.shape[0], spectra.shape[1] + 1))
+    np.cumsum(spectra, axis=1, out=cumulated[:, 1:])
+    return (cumulated[:, stop] - cumulated[:, start]) * abs(axis.step) * scale
+
+
+def integrate_spectra(source, regions, ppm=None, spectrum_numbers=None, procno=1, chunk_size=CHUNK_SIZE):
+    """
+    Integrate processed spectra into a data table of areas (same layout as the data file). Spectra are memory-mapped
+    and integrated chunk by chunk, so that only chunk_size spectra are in memory (and open) at once.
+
+    :param source: Bruker dataset folder, processing folder (containing a 1r file), or .npy file of shape
+                   (spectra, points) or (points,)
+    :param regions: DataFrame of regions (see regions_from_db)
+    :param ppm: chemical shift axis of .npy spectra (array or path to a .npy file)
+    :param spectrum_numbers: spectrum numbers of .npy spectra (1 to n by default)
+    :param procno: processing number of Bruker spectra
+    :param chunk_size: number of spectra integrated at once
+    :return: DataFrame with a "# Spectrum#" column and one column of areas per region
+    """
+
+    source = Path(source)
+    if source.suffix == ".npy":
+        if ppm is None:
+            raise ValueError("The ppm axis must be given to integrate NumPy spectra")
+        if isinstance(ppm, (str, Path)):
+            ppm = np.load(ppm, mmap_mode="r")
+        stack = np.load(source, mmap_mode="r")
+        stack = stack[None, :] if stack.ndim == 1 else stack
+        axis = Axis.from_ppm(ppm)
+        if stack.shape[1] != axis.size:
+            raise ValueError(f"Spectra have {stack.shape[1]} points but the ppm axis has {axis.size}")
+        numbers = list(spectrum_numbers) if spectrum_numbers is not None else list(range(1, stack.shape[0] + 1))
+        if len(numbers) != stack.shape[0]:
+            raise ValueError("The number of spectrum numbers does not match the number of spectra")
+        areas = np.vstack([integrate(stack[start:start + chunk_size], axis, regions)
+                           for start in range(0, stack.shape[0], chunk_size)])
+    else:
+        if (source / "1r").is_file():
+            folders = {spectrum_numbers[0] if spectrum_numbers else 1: source}
+        else:
+            folders = find_bruker_spectra(source, procno)
+        # Only the headers are read up front: each memory map holds a file descriptor, so the spectra are mapped
+        # chunk by chunk
+        headers = {number: read_bruker_header(folder) for number, folder in folders.items()}
+        numbers = list(headers)
+        areas = np.empty((len(numbers), len(regions)))
+        # Spectra with the same axis and scale are stacked and integrated together
+        by_axis = {}
+        for row, number in enumerate(numbers):
+            _, axis, scale = headers[number]
+            by_axis.setdefault((axis, scale), []).append(row)
+        for (axis, scale), rows in by_axis.items():
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                stack = np.stack([np.memmap(folders[numbers[row]] / "1r", dtype=headers[numbers[row]][0], mode="r",
+                                            shape=(axis.size,)) for row in chunk])
+                areas[chunk] = integrate(stack, axis, regions, scale)
+    mod_logger.debug("Integrated %s regions in %s spectra", len(regions), len(numbers))
+    data = pd.DataFrame(areas, columns=regions.index.rename(None))
+    data.insert(0, "# Spectrum#", numbers)
+    return data
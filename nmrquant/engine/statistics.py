@@ -0,0 +1,202 @@
+"""Module containing the differential testing of metabolite concentrations between conditions"""
+import logging
+import warnings
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+from natsort import natsorted
+from scipy import stats
+
+from nmrquant.engine.utilities import replicate_cube
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.statistics")
+
+TESTS = ("welch", "mannwhitney")
+
+# Largest sample size for which Mann-Whitney p-values are computed from the exact distribution of U
+EXACT_MAX_SIZE = 10
+
+
+def benjamini_hochberg(pvalues):
+    """
+    Benjamini-Hochberg adjusted p-values (false discovery rate). NaN p-values are ignored and stay NaN.
+
+    :param pvalues: array of p-values
+    :return: array of adjusted p-values
+    """
+
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = np.full(pvalues.shape, np.nan)
+    valid = ~np.isnan(pvalues)
+    p = pvalues[valid]
+    if not p.size:
+        return adjusted
+    order = np.argsort(p)
+    ranked = p[order] * p.size / np.arange(1, p.size + 1)
+    # Enforce monotonicity from the largest p-value down
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1].clip(max=1)
+    result = np.empty_like(p)
+    result[order] = ranked
+    adjusted[valid] = result
+    return adjusted
+
+
+def welch_test(a, b):
+    """
+    Welch t-test between two samples for many cells at once
+
+    :param a: array of shape (tests, replicates, metabolites), NaN-padded
+    :param b: array of shape (tests, replicates, metabolites), NaN-padded
+    :return: tuple (t statistics, p-values, Hedges' g effect sizes), arrays of shape (tests, metabolites)
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        n_a, n_b = np.sum(~np.isnan(a), axis=1), np.sum(~np.isnan(b), axis=1)
+        var_a, var_b = np.nanvar(a, axis=1, ddof=1), np.nanvar(b, axis=1, ddof=1)
+        diff = np.nanmean(b, axis=1) - np.nanmean(a, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        se_a, se_b = var_a / n_a, var_b / n_b
+        t = diff / np.sqrt(se_a + se_b)
+        df = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+        pvalues = 2 * stats.t.sf(np.abs(t), df)
+        pooled = np.sqrt(((n_a - 1) * var_a + (n_b - 1) * var_b) / (n_a + n_b - 2))
+        correction = 1 - 3 / (4 * (n_a + n_b) - 9)
+        hedges_g = diff / pooled * correction
+    return t, pvalues, hedges_g
+
+
+@lru_cache(maxsize=None)
+def _u_distribution(n_a, n_b):
+    """Cumulative distribution of the Mann-Whitney U statistic without ties, for sample sizes n_a and n_b"""
+
+    # counts[j][u]: number of arrangements of i values of a and j values of b giving U = u, built up over i
+    counts = [np.zeros(n_a * n_b + 1) for _ in range(n_b + 1)]
+    for j in range(n_b + 1):
+        counts[j][0] = 1
+    for _ in range(n_a):
+        new = [np.zeros(n_a * n_b + 1) for _ in range(n_b + 1)]
+        new[0][0] = 1
+        for j in range(1, n_b + 1):
+            # The largest value belongs to a (it is above the j values of b) or to b
+            new[j][j:] += counts[j][:len(counts[j]) - j]
+            new[j] += new[j - 1]
+        counts = new
+    frequencies = counts[n_b]
+    return np.cumsum(frequencies) / frequencies.sum()
+
+
+def mann_whitney_test(a, b):
+    """
+    Two-sided Mann-Whitney U test between two samples for many cells at once. P-values are exact for samples of up
+    to EXACT_MAX_SIZE values without ties, and use the normal approximation with tie correction otherwise.
+
+    :param a: array of shape (tests, replicates, metabolites), NaN-padded
+    :param b: array of shape (tests, replicates, metabolites), NaN-padded
+    :return: tuple (U statistics of b, p-values, rank-biserial effect sizes), arrays of shape (tests, metabolites)
+    """
+
+    n_a, n_b = np.sum(~np.isnan(a), axis=1), np.sum(~np.isnan(b), axis=1)
+    # Pairwise comparisons of all the values of a and b (NaN comparisons are False)
+    greater = (b[:, None, :, :] > a[:, :, None, :]).sum(axis=(1, 2))
+    equal = (b[:, None, :, :] == a[:, :, None, :]).sum(axis=(1, 2))
+    u = greater + 0.5 * equal
+    n_pairs = n_a * n_b
+    # Tie sizes of the pooled samples: sum over tied groups of t^3 - t
+    pooled = np.concatenate([a, b], axis=1)
+    same = (pooled[:, :, None, :] == pooled[:, None, :, :]).sum(axis=2)
+    ties = np.sum(np.where(np.isnan(pooled), 0, same ** 2 - 1), axis=1)
+    n = n_a + n_b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma = np.sqrt(n_pairs / 12 * ((n + 1) - ties / (n * (n - 1))))
+        z = (np.abs(u - n_pairs / 2) - 0.5) / sigma  # With continuity correction
+        pvalues = np.minimum(2 * stats.norm.sf(z.clip(min=0)), 1)
+        effect = 2 * u / n_pairs - 1
+    pvalues[(n_a == 0) | (n_b == 0) | (sigma == 0)] = np.nan
+    exact = (ties == 0) & (n_a > 0) & (n_b > 0) & (np.maximum(n_a, n_b) <= EXACT_MAX_SIZE)
+    for size_a, size_b in set(zip(n_a[exact], n_b[exact])):
+        cells = exact & (n_a == size_a) & (n_b == size_b)
+        cdf = _u_distribution(int(size_a), int(size_b))
+        low = cdf[np.floor(u[cells]).astype(int)]
+        # P(U >= u) = 1 - P(U <= u - 1), and the distribution is symmetric
+        high = 1 - np.where(u[cells] >= 1, cdf[np.clip(np.ceil(u[cells]).astype(int) - 1, 0, None)], 0)
+        pvalues[cells] = np.minimum(1, 2 * np.minimum(low, high))
+    return u, pvalues, effect
+
+
+def condition_pairs(conditions, control=None):
+    """
+    Pairs of conditions to compare: every condition against the control, or all pairs if no control is given
+
+    :param conditions: list of conditions
+    :param control: reference condition
+    :return: list of (reference, condition) tuples
+    """
+
+    conditions = natsorted(set(conditions))
+    if control is None:
+        return list(combinations(conditions, 2))
+    if control not in conditions:
+        raise KeyError(f"Control condition '{control}' not found in conditions: {conditions}")
+    return [(control, condition) for condition in conditions if condition != control]
+
+
+def compare_conditions(data, test="welch", control=None, pairs=None):
+    """
+    Compare the concentrations of every metabolite between conditions at each time point. All the tests are run in
+    a single vectorized computation and p-values are adjusted with the Benjamini-Hochberg procedure over the whole
+    table.
+
+    :param data: concentrations indexed by conditions, time points and replicates (Quantifier.conc_data)
+    :param test: 'welch' (Welch t-test) or 'mannwhitney' (Mann-Whitney U test)
+    :param control: reference condition for one-vs-control comparisons. All pairs are compared if None.
+    :param pairs: explicit list of (reference, condition) pairs, overrides control
+    :return: tidy DataFrame indexed by (Reference, Condition, Time_Points, Metabolite) with replicate counts, means,
+             difference and log2 fold change (condition vs reference), effect size, statistic and p-values
+    """
+
+    if test not in TESTS:
+        raise ValueError(f"Unknown test: {test}. Choose from {TESTS}")
+    if "# Spectrum#" in data.index.names:
+        data = data.droplevel("# Spectrum#")
+    cube, groups, metabolites = replicate_cube(data)
+    if pairs is None:
+        pairs = condition_pairs(groups.get_level_values("Conditions"), control)
+    # Positions of the reference and compared groups of every test (pairs present at the same time point)
+    position = {group: ind for ind, group in enumerate(groups)}
+    times = natsorted(set(groups.get_level_values("Time_Points")))
+    tests = [(ref, cond, time) for ref, cond in pairs for time in times
+             if (ref, time) in position and (cond, time) in position]
+    if not tests:
+        raise ValueError("No condition pairs to compare")
+    ref_idx = np.array([position[(ref, time)] for ref, _, time in tests])
+    cond_idx = np.array([position[(cond, time)] for _, cond, time in tests])
+    mod_logger.debug("Running %s %s tests on %s metabolites", len(tests), test, len(metabolites))
+    a, b = cube[ref_idx], cube[cond_idx]
+    if test == "welch":
+        statistic, pvalues, effect = welch_test(a, b)
+    else:
+        statistic, pvalues, effect = mann_whitney_test(a, b)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean_a, mean_b = np.nanmean(a, axis=1), np.nanmean(b, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log2_fc = np.log2(mean_b / mean_a)
+    index = pd.MultiIndex.from_tuples([test_id + (met,) for test_id in tests for met in metabolites],
+                                      names=["Reference", "Condition", "Time_Points", "Metabolite"])
+    table = pd.DataFrame({
+        "n_reference": np.sum(~np.isnan(a), axis=1).ravel(),
+        "n": np.sum(~np.isnan(b), axis=1).ravel(),
+        "mean_reference": mean_a.ravel(),
+        "mean": mean_b.ravel(),
+        "difference": (mean_b - mean_a).ravel(),
+        "log2_fc": log2_fc.ravel(),
+        "effect_size": effect.ravel(),
+        "statistic": statistic.ravel(),
+        "p_value": pvalues.ravel(),
+    }, index=index)
+    table["p_adjusted"] = benjamini_hochberg(table["p_value"].to_numpy())
+    table["test"] = test
+    return table
@@ -0,0 +1,163 @@
+"""Module containing the bootstrap and Monte Carlo uncertainty estimation of replicate means"""
+import logging
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from nmrquant.engine.utilities import replicate_cube
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.uncertainty")
+
+# Maximum number of elements gathered at once while resampling (~160 MB of float64)
+MAX_BATCH_ELEMENTS = 20_000_000
+
+
+def nan_quantiles(values, quantiles, axis=0):
+    """
+    Linear interpolation quantiles ignoring NaNs, computed with a single sort (much faster than np.nanquantile on
+    large arrays)
+
+    :param values: array of values
+    :param quantiles: sequence of quantiles between 0 and 1
+    :param axis: axis along which the quantiles are computed
+    :return: array with the quantiles stacked on the first axis
+    """
+
+    if not np.isnan(values).any():
+        return np.quantile(values, quantiles, axis=axis)
+    values = np.moveaxis(np.sort(values, axis=axis), axis, 0)  # NaNs are sorted at the end
+    valid = np.sum(~np.isnan(values), axis=0)
+    results = []
+    for q in quantiles:
+        position = q * (valid - 1).clip(min=0)
+        low = np.floor(position).astype(int)
+        high = np.minimum(low + 1, (valid - 1).clip(min=0))
+        weight = position - low
+        low_val = np.take_along_axis(values, low[None], axis=0)[0]
+        high_val = np.take_along_axis(values, high[None], axis=0)[0]
+        result = low_val + (high_val - low_val) * weight
+        results.append(np.where(valid > 0, result, np.nan))
+    return np.stack(results)
+
+
+def resample_means(cube, n_resamples=2000, resample=True, dilution_rsd=0.0, strd_rsd=0.0, seed=None):
+    """
+    Draw resampled replicate means for every (group, metabolite) cell of a replicate cube at once.
+
+    With resample=True, replicates are drawn with replacement inside each group (bootstrap). The relative
+    uncertainties of the dilution factor and of the standard concentration are propagated by Monte Carlo: the
+    dilution error is drawn for each replicate (pipetting is done sample by sample) and the standard error once per
+    resample (the same standard solution is used for the whole run).
+
+    :param cube: array of shape (groups, replicates, metabolites), NaN-padded (see utilities.replicate_cube)
+    :param n_resamples: number of resamples
+    :param resample: if False, replicates are kept as is and only the dilution/standard uncertainty is propagated
+    :param dilution_rsd: relative standard deviation of the dilution factor (ex: 0.02 for 2%)
+    :param strd_rsd: relative standard deviation of the standard concentration
+    :param seed: seed (or numpy Generator) for reproducible results
+    :return: array of shape (groups, n_resamples, metabolites)
+    """
+
+    rng = np.random.default_rng(seed)
+    n_groups, n_reps, n_mets = cube.shape
+    # Number of replicates actually present in each group (a replicate row is present if any value is not NaN)
+    present = ~np.all(np.isnan(cube), axis=2)
+    counts = present.sum(axis=1)
+    # Move present replicates first so that drawing an index below the count picks a present replicate
+    order = np.argsort(~present, axis=1, kind="stable")
+    cube = np.take_along_axis(cube, order[:, :, None], axis=1)
+    slots = np.arange(n_reps)[None, :] < counts[:, None]  # (groups, replicates)
+    # NaN values of present replicates are excluded by weighting them with 0
+    valid = (~np.isnan(cube)).astype(float)
+    values = np.nan_to_num(cube)
+    has_nan = bool(np.any(np.isnan(cube) & slots[:, :, None]))
+
+    # A resample is summarized by the weight of each replicate in the mean (number of times it is drawn, times its
+    # dilution error), so the means of all resamples are obtained with batched matrix products. Arrays are laid out
+    # groups first so that the products need no transposition.
+    batch = max(1, MAX_BATCH_ELEMENTS // max(1, n_groups * n_reps * max(n_reps, n_mets)))
+    means = np.empty((n_groups, n_resamples, n_mets))
+    weighted_values = values * valid
+    for start in range(0, n_resamples, batch):
+        size = min(batch, n_resamples - start)
+        if resample:
+            picks = (rng.random((n_groups, size, n_reps)) * counts[:, None, None]).astype(int)
+            picks = np.minimum(picks, n_reps - 1)
+        else:
+            picks = np.broadcast_to(np.arange(n_reps), (n_groups, size, n_reps))
+        # One-hot encoding of the picks (groups, size, draws, replicates); draws above the group count are unused
+        draws = (picks[..., None] == np.arange(n_reps)) & slots[:, None, :, None]
+        counts_weights = draws.sum(axis=2, dtype=float)  # (groups, size, replicates)
+        if dilution_rsd:
+            noise = rng.normal(1, dilution_rsd, size=(n_groups, size, n_reps))
+            weights = np.einsum("gsdr,gsd->gsr", draws, noise)
+        else:
+            weights = counts_weights
+        # (groups, size, replicates) @ (groups, replicates, metabolites) -> (groups, size, metabolites)
+        total = np.matmul(weights, weighted_values)
+        if has_nan:
+            number = np.matmul(counts_weights, valid)
+        else:
+            number = counts_weights.sum(axis=2, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            batch_means = total / number  # 0/0 gives NaN for cells without values
+        if strd_rsd:
+            batch_means *= rng.normal(1, strd_rsd, size=(1, size, 1))
+        means[:, start:start + size] = batch_means
+    return means
+
+
+def confidence_intervals(data, n_resamples=2000, confidence=0.95, method="bootstrap", dilution_rsd=0.0,
+                         strd_rsd=0.0, seed=None):
+    """
+    Confidence intervals of the replicate means for every (condition, time point, metabolite) cell
+
+    :param data: concentrations indexed by conditions, time points and replicates (Quantifier.conc_data)
+    :param n_resamples: number of resamples
+    :param confidence: confidence level of the intervals
+    :param method: 'bootstrap' (resample replicates and propagate dilution/standard uncertainty) or 'montecarlo'
+                   (only propagate dilution/standard uncertainty)
+    :param dilution_rsd: relative standard deviation of the dilution factor
+    :param strd_rsd: relative standard deviation of the standard concentration
+    :param seed: seed for reproducible results
+    :return: tidy DataFrame indexed by (Conditions, Time_Points, Metabolite) with the replicate count, mean,
+             standard deviation, standard error estimated from the resamples and the interval bounds
+    """
+
+    if method not in ("bootstrap", "montecarlo"):
+        raise ValueError(f"Unknown uncertainty method: {method}. Choose 'bootstrap' or 'montecarlo'")
+    if not 0 < confidence < 1:
+        raise ValueError("Confidence level must be between 0 and 1")
+    if "# Spectrum#" in data.index.names:
+        data = data.droplevel("# Spectrum#")
+    cube, groups, metabolites = replicate_cube(data)
+    mod_logger.debug("Resampling %s groups x %s replicates x %s metabolites %s times",
+                     *cube.shape, n_resamples)
+    means = resample_means(cube, n_resamples, resample=method == "bootstrap", dilution_rsd=dilution_rsd,
+                           strd_rsd=strd_rsd, seed=seed)
+    alpha = (1 - confidence) / 2
+    lower, upper = nan_quantiles(means, [alpha, 1 - alpha], axis=1)
+    with warnings.catch_warnings():
+        # Cells without values (all-NaN) are expected and return NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        observed_mean = np.nanmean(cube, axis=1)
+        observed_std = np.nanstd(cube, axis=1, ddof=1)
+        resampled_se = np.nanstd(means, axis=1, ddof=1) if np.isnan(means).any() else np.std(means, axis=1, ddof=1)
+    n = np.sum(~np.isnan(cube), axis=1)
+    return pd.DataFrame({
+        "n": n.ravel(),
+        "mean": observed_mean.ravel(),
+        "std": observed_std.ravel(),
+        "se": resampled_se.ravel(),
+        "ci_lower": lower.ravel(),
+        "ci_upper": upper.ravel(),
+    }, index=_with_metabolites(groups, metabolites))
+
+
+def _with_metabolites(groups, metabolites):
+    """Build the (group levels..., Metabolite) index of a tidy table with one row per group and metabolite"""
+
+    frame = groups.to_frame(index=False).loc[np.repeat(np.arange(len(groups)), len(metabolites))]
+    frame["Metabolite"] = np.tile(np.asarray(metabolites), len(groups))
+    return pd.MultiIndex.from_frame(frame)
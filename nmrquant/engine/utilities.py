@@ -2,7 +2,11 @@
 import pathlib
 import pathlib as pl
 
+import numpy as np
 import pandas as pd
+from natsort import natsorted
+
+from nmrquant.engine.workbook import read_workbook
 
 
 def read_data(path, excel_sheet=0):
@@ -11,12 +15,12 @@ def read_data(path, excel_sheet=0):
 
     :param path: path to data to read
     :type path: str or pathlib.PurePath
-    :param excel_sheet: excel sheet to read (if data is excel file with multiple sheets)
-    :type excel_sheet: int
+    :param excel_sheet: excel sheet to read (if data is excel file with multiple sheets). A list of sheets or None
+                        (all sheets) returns a dict of sheet name to data, all the sheets being read in one pass
+    :type excel_sheet: int, str, list or None
     """
 
-    if not isinstance(path, pathlib.PurePath):
-        datapath = pl.Path(path)
+    datapath = pl.Path(path)
     if datapath.suffix == ".csv" or datapath.suffix == ".tsv":
         try:
             data = pd.read_csv(datapath, sep=";", engine='python')
@@ -30,9 +34,11 @@ def read_data(path, excel_sheet=0):
             raise TypeError(f"Error Reading file. Error: {e}")
     elif datapath.suffix == ".xlsx":
         try:
-            data = pd.read_excel(datapath, engine="openpyxl", sheet_name=excel_sheet)
-            if len(data.columns) == 1:
-                raise TypeError("Error reading file. Please check that file formatting.")
+            sheets = read_workbook(datapath, excel_sheet)
+            for sheet in sheets.values():
+                if len(sheet.columns) == 1:
+                    raise TypeError("Error reading file. Please check that file formatting.")
+            data = next(iter(sheets.values())) if isinstance(excel_sheet, (str, int)) else sheets
         except Exception as e:
             raise TypeError(f"Error Reading file. Error: {e}")
     else:
@@ -89,5 +95,53 @@ def append_value(dict_obj, key, value):
         return dict_obj
 
 
+def natural_categorical(values):
+    """
+    Encode text labels as an ordered categorical in natural sort order (C2 before C10), so that sorting and grouping
+    run on integer codes. Numeric labels are already ordered and are returned unchanged.
+
+    :param values: Series of labels
+    :return: Series of ordered categorical labels (or the original numeric Series)
+    """
+
+    if pd.api.types.is_numeric_dtype(values) or isinstance(values.dtype, pd.CategoricalDtype):
+        return values
+    categories = natsorted(values.dropna().unique(), key=str)
+    return values.astype(pd.CategoricalDtype(categories, ordered=True))
+
+
+def is_naturally_ordered(index):
+    """Check that sorting an index gives the natural order (all its levels are numeric or ordered categoricals)"""
+
+    levels = index.levels if isinstance(index, pd.MultiIndex) else [index]
+    return all(pd.api.types.is_numeric_dtype(level) or (isinstance(level, pd.CategoricalIndex) and level.ordered)
+               for level in levels)
+
+
 def list_average(lst):
     return sum(lst) / len(lst)
+
+
+def replicate_cube(data, group_levels=("Conditions", "Time_Points"), return_positions=False):
+    """
+    Arrange data indexed by conditions, time points and replicates in a dense array of shape
+    (groups, replicates, metabolites). Groups are the unique combinations of the group levels and missing replicates
+    are filled with NaN, so that statistics can be computed on all the groups at once.
+
+    :param data: DataFrame with the group levels in its index and one column per metabolite
+    :param group_levels: index levels defining the groups
+    :param return_positions: also return the (group, replicate) coordinates of each row of data in the cube, to map
+                             results computed on the cube back to the rows
+    :return: tuple (cube, groups index, columns) or (cube, groups index, columns, (group codes, positions))
+    """
+
+    group_levels = [lvl for lvl in group_levels if lvl in data.index.names]
+    grouped = data.groupby(level=group_levels, sort=True, observed=True)
+    group_codes = grouped.ngroup().to_numpy()
+    positions = grouped.cumcount().to_numpy()
+    groups = grouped.size().index
+    cube = np.full((len(groups), positions.max() + 1 if len(positions) else 0, data.shape[1]), np.nan)
+    cube[group_codes, positions] = data.to_numpy(dtype=float)
+    if return_positions:
+        return cube, groups, data.columns, (group_codes, positions)
+    return cube, groups, data.columns
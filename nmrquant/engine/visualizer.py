@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from itertools import cycle
+import warnings
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -7,6 +8,11 @@ import pandas as pd
 import colorcet as cc
 from natsort import natsorted
 from ordered_set import OrderedSet
+from scipy.cluster import hierarchy
+
+from nmrquant.engine.kinetics import model_curve
+from nmrquant.engine.render import Scene
+from nmrquant.engine.utilities import is_naturally_ordered
 
 
 class Colors:
@@ -80,6 +86,10 @@ class HistPlot(ABC):
     method so that self() directly creates the plot.
     """
 
+    # Label of the y axis and error bars, if any (see the scenes method)
+    y_label = "Concentration in mM"
+    yerr = None
+
     def __init__(self, input_data, metabolite, display):
 
         self.data = input_data
@@ -119,6 +129,17 @@ class HistPlot(ABC):
         fig = self.build_plot()
         return fig
 
+    def scenes(self):
+        """
+        Drawing primitives of the plot for the direct renderer (same bars, colors and labels as build_plot)
+
+        :return: list of (file name, render.Scene)
+        """
+        scene = Scene(self.metabolite, ylabel=self.y_label)
+        scene.add_bars(self.x_ticks, self.y, self.colors, yerr=self.yerr)
+        scene.set_categories(self.x_ticks, self.x_labels)
+        return [(self.metabolite, scene)]
+
     @abstractmethod
     def build_plot(self):
         pass
@@ -165,8 +186,12 @@ class IndHistB(HistPlot):
         # Condition check done in base class so here we only check for replicates
         if "Replicates" not in self.data.index.names:
             raise KeyError("'Replicates' is missing from index")
-        # We natural sort the index here so that when bar plot is initialized the data is ordered logically
-        self.data = self.data.reindex(natsorted(self.data.index))
+        # We natural sort the index here so that when bar plot is initialized the data is ordered logically. Indexes
+        # encoded by the quantifier are sorted on their codes
+        if is_naturally_ordered(self.data.index):
+            self.data = self.data.sort_index()
+        else:
+            self.data = self.data.reindex(natsorted(self.data.index))
         # Labels should show condition and replicate number
         self.x_labels = [str(ind1) + "_" + str(ind2) for ind1, ind2
                          in zip(self.data.index.get_level_values("Conditions"),
@@ -188,6 +213,8 @@ class MultHistB(HistPlot):
     (meaned representation)
     """
 
+    y_label = None
+
     def __init__(self, input_data, std_data, metabolite, display):
 
         super().__init__(input_data, metabolite, display)
@@ -220,9 +247,10 @@ class LinePlot(ABC):
     in the constructor of this class.
     The class implements repr and call dunder methods. The call dunder requests plot creation from the build_plot
     method so that self() directly creates the plot.
+    Fitted kinetic models (see kinetics.fit_kinetics) can be overlaid on the time courses by giving the fits table.
     """
 
-    def __init__(self, input_data, metabolite, display=False):
+    def __init__(self, input_data, metabolite, display=False, fits=None, fit_model="slope"):
 
         self.data = input_data
         self.metabolite = metabolite
@@ -241,12 +269,71 @@ class LinePlot(ABC):
             self.data = self.data.droplevel("# Spectrum#")
         if "# Spectrum#" in input_data.columns:
             self.data = self.data.drop("# Spectrum#", axis=1)
+        self.fits = None
+        self.fit_model = fit_model
+        if fits is not None and metabolite in fits.index.get_level_values("Metabolite"):
+            self.fits = fits.xs(metabolite, level="Metabolite")
 
     def __call__(self):
 
         fig = self.build_plot()
         return fig
 
+    @staticmethod
+    def _top_limit(maxes):
+        """Top y limit from the maximum values, ignoring time courses without values (None if there are none)"""
+
+        finite = [value for value in maxes if np.isfinite(value)]
+        return max(finite) + (max(finite) / 5) if finite else None
+
+    def _set_top_limit(self, ax):
+        """Set the y limits of the plot from the maximum values, ignoring time courses without values"""
+
+        top = self._top_limit(self.maxes)
+        if top is not None:
+            ax.set_ylim(bottom=self.y_min, top=top)
+        else:
+            ax.set_ylim(bottom=self.y_min)
+
+    def _fit_curve(self, key):
+        """Coordinates of the fitted kinetic model of a time course (None if it was not fitted)"""
+
+        if self.fits is None or key not in self.fits.index:
+            return None
+        x, y = model_curve(self.fits.loc[key], self.fit_model)
+        return (x, y) if len(x) else None
+
+    def _overlay_fit(self, ax, key, color):
+        """
+        Draw the fitted kinetic model of a time course as a dashed line
+
+        :param ax: axis object to draw on
+        :param key: index of the time course in the fits table (condition, or (condition, replicate))
+        :param color: color of the time course
+        """
+        curve = self._fit_curve(key)
+        if curve is not None:
+            ax.plot(*curve, linestyle="--", linewidth=1, color=color)
+
+    def _scene(self, title, maxes):
+        """
+        Scene of a line plot for the direct renderer, with the axis labels and limits of build_plot
+
+        :param title: title of the plot
+        :param maxes: maximum value of each time course
+        :return: render.Scene
+        """
+        scene = Scene(title, xlabel="Time in hours", ylabel="Concentration in mM")
+        scene.set_ylim(bottom=self.y_min, top=self._top_limit(maxes))
+        return scene
+
+    def _scene_fit(self, scene, key, color):
+        """Add the fitted kinetic model of a time course to a scene (see _overlay_fit)"""
+
+        curve = self._fit_curve(key)
+        if curve is not None:
+            scene.add_line(*curve, color, dashed=True, width=1)
+
     @staticmethod
     def _place_legend(ax):
         """
@@ -282,12 +369,12 @@ class LinePlot(ABC):
 
 class NoRepIndLine(LinePlot):
     """
-    Class to generate line plots for kinetic data with only 1 replicate per condition
+    Class to generate line plots for kinetic data with only 1 replicate per condition. Fits are indexed by condition.
     """
 
-    def __init__(self, input_data, metabolite, display):
+    def __init__(self, input_data, metabolite, display, fits=None, fit_model="slope"):
 
-        super().__init__(input_data, metabolite, display)
+        super().__init__(input_data, metabolite, display, fits, fit_model)
         if "Replicates" in self.data.index.names:
             if len(self.data.index.get_level_values("Replicates").unique()) > 1:
                 raise IndexError("Too many replicates for this type of plot")
@@ -304,7 +391,8 @@ class NoRepIndLine(LinePlot):
             x = list(tmp_df.index.get_level_values("Time_Points"))
             y = list(tmp_df.values)
             self.maxes.append(np.nanmax(y))
-            ax.plot(x, y, label=condition)
+            line, = ax.plot(x, y, label=condition)
+            self._overlay_fit(ax, condition, line.get_color())
         # We make sure we have the right value for top y limit
         if len(self.maxes) == 1:
             ax.set_ylim(bottom=self.y_min, top=self.maxes + (self.maxes / 5))
@@ -321,18 +409,37 @@ class NoRepIndLine(LinePlot):
             plt.close(fig)
         return fig
 
+    def scenes(self):
+        """
+        Drawing primitives of the plot for the direct renderer (same lines, colors and labels as build_plot)
+
+        :return: list of (file name, render.Scene)
+        """
+        lines, maxes = [], []
+        # Conditions take the colors of the matplotlib color cycle, as in build_plot
+        colors = cycle(plt.rcParams["axes.prop_cycle"].by_key()["color"])
+        for condition, color in zip(self.data.index.get_level_values("Conditions").unique(), colors):
+            tmp_df = self.data[condition]
+            lines.append((condition, list(tmp_df.index.get_level_values("Time_Points")), tmp_df.values, color))
+            maxes.append(np.nanmax(tmp_df.values))
+        scene = self._scene(self.metabolite, maxes)
+        for condition, x, y, color in lines:
+            scene.add_line(x, y, color, label=condition)
+            self._scene_fit(scene, condition, color)
+        return [(self.metabolite, scene)]
+
 
 class IndLine(LinePlot):
     """
     Class to generate lineplots from kinetic data. Each plot is specific to one condition and displays each replicate
-    in a separate line.
+    in a separate line. Fits are indexed by condition and replicate.
     """
 
     # TODO: fix NaN handling
 
-    def __init__(self, input_data, metabolite, display):
+    def __init__(self, input_data, metabolite, display, fits=None, fit_model="slope"):
 
-        super().__init__(input_data, metabolite, display)
+        super().__init__(input_data, metabolite, display, fits, fit_model)
         if "Replicates" not in self.data.index.names:
             raise IndexError("Replicates column not found in index")
         self.conditions = self.data.index.get_level_values("Conditions").unique()
@@ -354,23 +461,27 @@ class IndLine(LinePlot):
     def __repr__(self):
         return f"Plotting data: {self.dicts}"
 
-    def build_plot(self):
+    def _color_lists(self):
+        """Shades of color of each condition, one per replicate"""
 
-        figures = []
         # We get the maximum number of replicates possible to generate the color maps for each condition
         max_number_reps = max([max(self.dicts[i].keys()) for i in self.dicts.keys()])
-        color_lists = Colors.color_seq_gen((len(self.conditions)+2), max_number_reps)
-        for condition, c_list in zip(self.conditions, color_lists):
+        return Colors.color_seq_gen((len(self.conditions)+2), max_number_reps)
+
+    def build_plot(self):
+
+        figures = []
+        for condition, c_list in zip(self.conditions, self._color_lists()):
             fig, ax = plt.subplots()
             # We build the line plots line by line aka replicate by replicate
             for rep, color in zip(self.dicts[condition].keys(), c_list[2:]):
                 x = self.dicts[condition][rep]["Times"]
                 y = pd.Series(self.dicts[condition][rep]["Values"])
-                self.maxes.append(np.nanmax(y))  # For y limit
+                self.maxes.append(y.max())  # For y limit (NaN if no values)
                 ax.plot(x, y, color=color, label=f"Replicate {rep}")
-            y_lim = max(self.maxes) + (max(self.maxes) / 5)
+                self._overlay_fit(ax, (condition, rep), color)
+            self._set_top_limit(ax)
             self.maxes = []  # Reset maxes else max of each condition will be kept at each iteration
-            ax.set_ylim(bottom=self.y_min, top=y_lim)
             ax.set_title(f"{self.metabolite}\n{condition}")
             ax = LinePlot._place_legend(ax=ax)
             ax.set_ylabel("Concentration in mM")
@@ -383,17 +494,36 @@ class IndLine(LinePlot):
             figures.append((fname, fig))
         return figures
 
+    def scenes(self):
+        """
+        Drawing primitives of the plots for the direct renderer (same lines, colors, labels and file names as
+        build_plot)
+
+        :return: list of (file name, render.Scene), one per condition
+        """
+        scenes = []
+        for condition, c_list in zip(self.conditions, self._color_lists()):
+            replicates = list(zip(self.dicts[condition].keys(), c_list[2:]))
+            maxes = [pd.Series(self.dicts[condition][rep]["Values"], dtype=float).max() for rep, _ in replicates]
+            scene = self._scene(f"{self.metabolite}\n{condition}", maxes)
+            for rep, color in replicates:
+                scene.add_line(self.dicts[condition][rep]["Times"], self.dicts[condition][rep]["Values"], color,
+                               label=f"Replicate {rep}")
+                self._scene_fit(scene, (condition, rep), color)
+            scenes.append((f"{self.metabolite}_{condition}", scene))
+        return scenes
+
 
 class MeanLine(IndLine):
     """
     Line plots with meaned replicates for each time point.
     We inherit from IndLine to initialize the dict containing all the data for all the replicates. We will then
-    calculate means and SDs from this data.
+    calculate means and SDs from this data. Fits are indexed by condition (replicates pooled).
     """
 
-    def __init__(self, input_data, metabolite, display):
+    def __init__(self, input_data, metabolite, display, fits=None, fit_model="slope"):
 
-        super().__init__(input_data, metabolite, display)
+        super().__init__(input_data, metabolite, display, fits, fit_model)
         self.mean_dict = {}  # For calculating means
         self.std_dict = {}  # For SDs (and error bars)
         # Sort the time points to get them in the right order
@@ -431,6 +561,29 @@ class MeanLine(IndLine):
 
         fig, ax = plt.subplots()
         plt.subplots_adjust(right=0.8)  # We make space for the legend
+        # We build the plot line by line aka condition per condition
+        for condition, c in zip(self.mean_dict.keys(), self._condition_colors()):
+            x = list(self.mean_dict[condition].keys())
+            y = list(self.mean_dict[condition].values())
+            self.maxes.append(np.nanmax(y) if not np.all(np.isnan(y)) else np.nan)
+            yerr = list(self.std_dict[condition].values())
+            ax.plot(x, y, label=condition, color=c)
+            ax.errorbar(x, y, yerr=yerr, capsize=5, fmt="none", color=c)
+            self._overlay_fit(ax, condition, c)
+        self._set_top_limit(ax)
+        ax = LinePlot._place_legend(ax=ax)
+        ax.set_title(f"{self.metabolite}")
+        ax.set_ylabel("Concentration in mM")
+        ax.set_xlabel("Time in hours")
+        if self.display:
+            fig.show()
+        else:
+            plt.close(fig)
+        return fig
+
+    def _condition_colors(self):
+        """Color of each condition, matching the shades of its replicates in the individual line plots"""
+
         # Get the maximum number of replicates for linking individual rep colors with meaned colors
         max_rep = 1
         for condition in self.dicts.keys():
@@ -440,19 +593,209 @@ class MeanLine(IndLine):
         # Check for number of conditions (only 8 color gradients so maximum of 8 conditions for now)
         if len(self.mean_dict.keys()) > 8:
             raise RuntimeError("Too many conditions to plot (maximum number of conditions is 8)")
-        # We build the plot line by line aka condition per condition
-        for condition, c in zip(self.mean_dict.keys(), colors):
-            x = list(self.mean_dict[condition].keys())
+        return colors
+
+    def scenes(self):
+        """
+        Drawing primitives of the plot for the direct renderer (same lines, error bars, colors and labels as
+        build_plot)
+
+        :return: list of (file name, render.Scene)
+        """
+        lines = []
+        for condition, color in zip(self.mean_dict.keys(), self._condition_colors()):
             y = list(self.mean_dict[condition].values())
-            self.maxes.append(max(y))
-            yerr = list(self.std_dict[condition].values())
-            ax.plot(x, y, label=condition, color=c)
-            ax.errorbar(x, y, yerr=yerr, capsize=5, fmt="none", color=c)
-        ax.set_ylim(bottom=self.y_min, top=max(self.maxes) + (max(self.maxes) / 5))
+            lines.append((condition, list(self.mean_dict[condition].keys()), y,
+                          list(self.std_dict[condition].values()), color))
+        maxes = [np.nanmax(y) if not np.all(np.isnan(y)) else np.nan for _, _, y, _, _ in lines]
+        scene = self._scene(self.metabolite, maxes)
+        for condition, x, y, yerr, color in lines:
+            scene.add_line(x, y, color, label=condition)
+            scene.add_errorbars(x, y, yerr, color)
+            self._scene_fit(scene, condition, color)
+        return [(self.metabolite, scene)]
+
+
+class StandardQCPlot:
+    """
+    Control chart of the standard areas of a run (see qc.standard_qc): area of each spectrum against spectrum order,
+    with the mean, the acceptance band (mean +/- CV limit), the linear drift and the outlying spectra
+    """
+
+    def __init__(self, qc_data, qc_summary, display=False):
+
+        self.data = qc_data
+        self.summary = qc_summary
+        self.display = display
+
+    def __call__(self):
+
+        fig = self.build_plot()
+        return fig
+
+    def build_plot(self):
+
+        fig, ax = plt.subplots()
+        x = np.asarray(self.data.index, dtype=float)
+        mean = self.summary["Mean"]
+        band = mean * self.summary["CV limit (%)"] / 100
+        ax.axhspan(mean - band, mean + band, color="lightgrey", alpha=0.5, label="Mean ± CV limit")
+        ax.axhline(mean, color="grey", linewidth=1)
+        ax.plot(x, self.data["Area"], marker="o", markersize=4, linewidth=0.5, color=cc.glasbey_bw[0],
+                label="Standard")
+        ax.plot(x, self.data["Trend"], linestyle="--", color="black",
+                label=f"Drift ({self.summary['Drift (%)']:.1f} %)")
+        outliers = self.data[self.data["Outlier"]]
+        if len(outliers):
+            ax.scatter(np.asarray(outliers.index, dtype=float), outliers["Area"], color="red", zorder=3,
+                       label="Outlying spectra")
+            for spectrum, area in outliers["Area"].items():
+                ax.annotate(str(spectrum), (float(spectrum), area), textcoords="offset points", xytext=(4, 4),
+                            fontsize=8)
+        ax.set_title(f"Standard QC: {self.summary['Status']} (CV = {self.summary['CV (%)']:.1f} %)")
+        ax.set_xlabel("Spectrum")
+        ax.set_ylabel("Standard area")
         ax = LinePlot._place_legend(ax=ax)
-        ax.set_title(f"{self.metabolite}")
-        ax.set_ylabel("Concentration in mM")
-        ax.set_xlabel("Time in hours")
+        if self.display:
+            fig.show()
+        else:
+            plt.close(fig)
+        return fig
+
+
+class Heatmap:
+    """
+    Overview of all the metabolites in one figure: heatmap of the scaled concentrations of every metabolite (rows)
+    across the samples or the condition-time means (columns). Rows and columns can be reordered by hierarchical
+    clustering, computed on the whole matrix at once, with the dendrograms drawn along the heatmap.
+    """
+
+    SCALINGS = ("zscore", "minmax", "log", "none")
+
+    def __init__(self, input_data, scaling="zscore", cluster=True, display=False, method="average",
+                 metric="euclidean"):
+        """
+        :param input_data: concentrations (conc_data) or means (mean_data), one column per metabolite
+        :param scaling: scaling of each metabolite: 'zscore' (centered and reduced), 'minmax' (0 to 1), 'log'
+                        (log10(1 + x)) or 'none'
+        :param cluster: reorder metabolites and samples by hierarchical clustering
+        :param display: show the figure
+        :param method: linkage method (see scipy.cluster.hierarchy.linkage)
+        :param metric: distance metric (see scipy.spatial.distance.pdist)
+        """
+
+        if scaling not in self.SCALINGS:
+            raise ValueError(f"Unknown scaling '{scaling}'. Scalings are {self.SCALINGS}")
+        self.data = input_data
+        if "# Spectrum#" in self.data.index.names:
+            self.data = self.data.droplevel("# Spectrum#")
+        if "# Spectrum#" in self.data.columns:
+            self.data = self.data.drop("# Spectrum#", axis=1)
+        self.scaling = scaling
+        self.display = display
+        self.metabolites = list(self.data.columns)
+        self.samples = [" / ".join(str(level) for level in np.atleast_1d(label)) for label in self.data.index]
+        self.values = self.scale(self.data.to_numpy(dtype=float).T, scaling)
+        self.row_linkage = self.col_linkage = None
+        self.row_order = np.arange(len(self.metabolites))
+        self.col_order = np.arange(len(self.samples))
+        if cluster:
+            self.row_linkage, self.row_order = self.cluster_order(self.values, method, metric)
+            self.col_linkage, self.col_order = self.cluster_order(self.values.T, method, metric)
+
+    def __repr__(self):
+        return f"Heatmap({len(self.metabolites)} metabolites x {len(self.samples)} samples, scaling={self.scaling})"
+
+    def __call__(self):
+
+        fig = self.build_plot()
+        return fig
+
+    @staticmethod
+    def scale(matrix, scaling="zscore"):
+        """
+        Scale each row (metabolite) of a matrix, ignoring missing values
+
+        :param matrix: array of shape (metabolites, samples)
+        :param scaling: 'zscore', 'minmax', 'log' or 'none'
+        :return: scaled array (constant rows are scaled to 0)
+        """
+
+        matrix = np.asarray(matrix, dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"), warnings.catch_warnings():
+            # Rows without values are expected and stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            if scaling == "zscore":
+                spread = np.nanstd(matrix, axis=1, keepdims=True)
+                scaled = (matrix - np.nanmean(matrix, axis=1, keepdims=True)) / spread
+            elif scaling == "minmax":
+                low = np.nanmin(matrix, axis=1, keepdims=True)
+                spread = np.nanmax(matrix, axis=1, keepdims=True) - low
+                scaled = (matrix - low) / spread
+            elif scaling == "log":
+                return np.log10(1 + np.clip(matrix, 0, None))
+            else:
+                return matrix
+        return np.where(np.isnan(matrix), np.nan, np.where(spread > 0, scaled, 0.0))
+
+    @staticmethod
+    def cluster_order(values, method="average", metric="euclidean"):
+        """
+        Hierarchical clustering of the rows of a matrix (missing values are replaced by the mean of their column)
+
+        :param values: array of shape (items, features)
+        :param method: linkage method
+        :param metric: distance metric
+        :return: tuple (linkage matrix or None if there are less than 3 items, order of the items)
+        """
+
+        if len(values) < 3:
+            return None, np.arange(len(values))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            fill = np.nan_to_num(np.nanmean(values, axis=0))
+        filled = np.where(np.isnan(values), fill, values)
+        link = hierarchy.linkage(filled, method=method, metric=metric)
+        return link, hierarchy.leaves_list(link)
+
+    def build_plot(self):
+
+        n_rows, n_cols = self.values.shape
+        fig = plt.figure(figsize=(max(6.0, 2.5 + 0.22 * n_cols), max(4.0, 2.0 + 0.2 * n_rows)))
+        grid = fig.add_gridspec(2, 2, width_ratios=[1.5, 8], height_ratios=[1.5, 8], wspace=0.02, hspace=0.02)
+        ax = fig.add_subplot(grid[1, 1])
+        values = self.values[np.ix_(self.row_order, self.col_order)]
+        if self.scaling == "zscore":
+            limit = np.nanmax(np.abs(values)) if np.isfinite(values).any() else 1
+            image = ax.imshow(values, aspect="auto", cmap="RdBu_r", vmin=-limit, vmax=limit, interpolation="none")
+        else:
+            image = ax.imshow(values, aspect="auto", cmap="viridis", interpolation="none")
+        ax.set_xticks(np.arange(n_cols))
+        ax.set_xticklabels([self.samples[ind] for ind in self.col_order], rotation=90, fontsize=7)
+        ax.set_yticks(np.arange(n_rows))
+        ax.set_yticklabels([self.metabolites[ind] for ind in self.row_order], fontsize=7)
+        ax.yaxis.tick_right()
+        # Dendrogram leaves are placed at 5, 15, 25... in their own axes
+        for link, position, orientation in [(self.row_linkage, grid[1, 0], "left"),
+                                            (self.col_linkage, grid[0, 1], "top")]:
+            if link is None:
+                continue
+            dendrogram_ax = fig.add_subplot(position)
+            hierarchy.dendrogram(link, ax=dendrogram_ax, orientation=orientation, no_labels=True,
+                                 color_threshold=0, above_threshold_color="black")
+            if orientation == "left":
+                dendrogram_ax.set_ylim(10 * n_rows, 0)
+            else:
+                dendrogram_ax.set_xlim(0, 10 * n_cols)
+            dendrogram_ax.axis("off")
+        # The color bar goes in the corner between the dendrograms, metabolite names being on the right
+        corner = fig.add_subplot(grid[0, 0])
+        corner.axis("off")
+        colorbar = fig.colorbar(image, cax=corner.inset_axes([0.1, 0.55, 0.8, 0.15]), orientation="horizontal")
+        colorbar.ax.tick_params(labelsize=7)
+        colorbar.set_label({"zscore": "z-score", "minmax": "Scaled concentration", "log": "log10(1 + concentration)",
+                            "none": "Concentration in mM"}[self.scaling], fontsize=7)
+        fig.suptitle("Concentrations of all the metabolites")
         if self.display:
             fig.show()
         else:
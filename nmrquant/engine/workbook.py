@@ -0,0 +1,128 @@
+"""Module containing the streaming reader of Excel workbooks"""
+import logging
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+mod_logger = logging.getLogger("RMNQ_logger.engine.workbook")
+
+# Number of rows converted to typed columns at once (bounds the number of rows held as Python objects)
+BLOCK_SIZE = 4096
+
+
+def _header(row):
+    """Column names of a header row, with the names pandas gives to empty headers"""
+
+    names = []
+    for ind, value in enumerate(row):
+        if value is None:
+            value = f"Unnamed: {ind}"
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        # Duplicated names are numbered (Name, Name.1, Name.2...)
+        name, count = value, 0
+        while name in names:
+            count += 1
+            name = f"{value}.{count}"
+        names.append(name)
+    return names
+
+
+def _to_column(values):
+    """Convert an object array of cell values to the narrowest column type (int, float or object)"""
+
+    present = values[values != None]  # noqa: E711 (element-wise comparison)
+    if present.size and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        if present.size == values.size and all(isinstance(v, int) or float(v).is_integer() for v in present):
+            return values.astype(np.int64)
+        values = values.copy()
+        values[values == None] = np.nan  # noqa: E711
+        return values.astype(float)
+    # Empty cells are missing values, as with pandas.read_excel
+    values[values == None] = np.nan  # noqa: E711
+    return values
+
+
+def _concatenate(parts):
+    """Concatenate the typed blocks of a column (blocks without any value take the type of the other blocks)"""
+
+    typed = [part for part in parts if part.dtype != object or pd.notna(part).any()]
+    if not typed:
+        return np.concatenate(parts)
+    if any(part.dtype == object for part in typed):
+        return np.concatenate([part.astype(object) for part in parts])
+    return np.concatenate([part.astype(float) if part.dtype == object else part for part in parts])
+
+
+def _read_sheet(worksheet):
+    """Stream the rows of a read-only worksheet into a DataFrame"""
+
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    # Trailing empty header cells are not columns
+    while header and header[-1] is None:
+        header = header[:-1]
+    width = len(header)
+    # Each block of rows is converted to typed columns as soon as it is read
+    columns, block = [[] for _ in range(width)], []
+
+    def convert(rows_block):
+        values = np.array(rows_block, dtype=object).reshape(-1, width)
+        for ind in range(width):
+            columns[ind].append(_to_column(values[:, ind]))
+
+    for row in rows:
+        row = tuple(row[:width]) + (None,) * (width - len(row))
+        if all(value is None for value in row):
+            continue
+        block.append(row)
+        if len(block) == BLOCK_SIZE:
+            convert(block)
+            block = []
+    if block or not columns or not columns[0]:
+        convert(block)
+    columns = {ind: _concatenate(parts) for ind, parts in enumerate(columns)}
+    data = pd.DataFrame(columns)
+    data.columns = _header(header)
+    return data
+
+
+def read_workbook(path, sheets=None):
+    """
+    Read sheets of an Excel workbook in one streaming pass. The workbook is opened read-only and cells are read as
+    values only, without building the openpyxl object model, and rows are converted to NumPy columns in blocks.
+    Each sheet can be fed to its own Quantifier as a separate experiment:
+
+        for name, data in read_workbook("experiments.xlsx").items():
+            quantifier = Quantifier()
+            quantifier.get_data(data)
+
+    :param path: path to the .xlsx workbook
+    :param sheets: sheet name or position, list of names or positions, or None for all the sheets
+    :return: dict of sheet name to DataFrame (first row as header)
+    """
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        names = workbook.sheetnames
+        wanted = names if sheets is None else [sheets] if isinstance(sheets, (str, int)) else list(sheets)
+        selected = []
+        for sheet in wanted:
+            if isinstance(sheet, int):
+                if not -len(names) <= sheet < len(names):
+                    raise IndexError(f"Worksheet index {sheet} is invalid, {len(names)} worksheets found")
+                sheet = names[sheet]
+            elif sheet not in names:
+                raise KeyError(f"Worksheet named '{sheet}' not found. Sheets are {names}")
+            selected.append(sheet)
+        result = {}
+        for sheet in selected:
+            result[sheet] = _read_sheet(workbook[sheet])
+            mod_logger.debug("Sheet '%s' read: %s rows, %s columns", sheet, *result[sheet].shape)
+    finally:
+        # Read-only workbooks keep the file open until closed
+        workbook.close()
+    return result
@@ -1,13 +1,155 @@
 """Logger module containing the RMNQ logger setup"""
 
+import itertools
+import json
 import logging
 
-#Setup base logger
+# Setup base logger. All the NMRQuant loggers are children of this one ("RMNQ_logger.xxx") and propagate their
+# records to the handlers attached here, so handlers are set up once for the whole package.
 
 logger = logging.getLogger("RMNQ_logger")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)
 
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
 
+_stream_handler = None
+_sinks = []
 
-#Initiate any extra loggers
-#Other configs
\ No newline at end of file
+
+class JsonFormatter(logging.Formatter):
+    """Formatter writing one json object per record (json lines)"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class Summary:
+    """
+    Bounded and lazy representation of a DataFrame, Series, array, dict or list for log messages. The object is
+    only rendered if the record is actually emitted, and the rendering never exceeds a few lines.
+    """
+
+    # Longest rendering of the other objects (in characters)
+    max_chars = 200
+
+    def __init__(self, obj, max_items=8):
+
+        self.obj = obj
+        self.max_items = max_items
+
+    def _clip(self, items, count=None):
+        # Only the items shown are read, the count comes from len() (given for iterators)
+        count = len(items) if count is None else count
+        shown = ", ".join(str(i) for i in itertools.islice(items, self.max_items))
+        if count > self.max_items:
+            shown += f", ... (+{count - self.max_items})"
+        return f"[{shown}]"
+
+    def __str__(self):
+        obj = self.obj
+        if hasattr(obj, "columns") and hasattr(obj, "shape"):
+            # DataFrame: shape, columns, index levels and a few global statistics
+            try:
+                values = obj.select_dtypes("number")
+                stats = f", nan={int(values.isna().sum().sum())}, min={values.min().min():.4g}, " \
+                        f"max={values.max().max():.4g}" if not values.empty else ""
+            except Exception:
+                stats = ""
+            return f"<DataFrame {obj.shape[0]}x{obj.shape[1]} columns={self._clip(obj.columns)} " \
+                   f"index={list(obj.index.names)}{stats}>"
+        if hasattr(obj, "shape") and hasattr(obj, "name"):
+            return f"<Series '{obj.name}' len={len(obj)} values={self._clip(obj.values)}>"
+        if hasattr(obj, "shape") and hasattr(obj, "dtype") and hasattr(obj, "ravel") and obj.ndim:
+            # NumPy array: shape, type and the first values
+            shape = "x".join(str(size) for size in obj.shape)
+            values = ", ".join(str(value) for value in obj.ravel()[:self.max_items])
+            if obj.size > self.max_items:
+                values += f", ... (+{obj.size - self.max_items})"
+            return f"<ndarray {shape} {obj.dtype} values=[{values}]>"
+        if isinstance(obj, dict):
+            return f"<dict len={len(obj)} {self._clip((f'{k}: {v}' for k, v in obj.items()), len(obj))}>"
+        if isinstance(obj, (list, tuple, set)):
+            return f"<{type(obj).__name__} len={len(obj)} {self._clip(obj)}>"
+        text = str(obj)
+        if len(text) > self.max_chars:
+            text = f"{text[:self.max_chars]}... (+{len(text) - self.max_chars} characters)"
+        return text
+
+
+def summarize(obj, max_items=8):
+    """
+    Wrap an object so that it is rendered as a bounded summary, and only when the log record is emitted. To be used
+    with %-style logging calls: logger.debug("Data: %s", summarize(df))
+    """
+
+    return Summary(obj, max_items)
+
+
+def _refresh_level():
+    """Set the base logger level to the lowest handler level so that filtered calls return immediately"""
+
+    levels = [h.level for h in logger.handlers if h.level != logging.NOTSET]
+    logger.setLevel(min(levels) if levels else logging.INFO)
+
+
+def setup_handler(verbose=False):
+    """
+    Attach the console handler to the base logger (only once per session) and set its level
+
+    :param verbose: if True the handler shows debug messages
+    :return: the console handler
+    """
+
+    global _stream_handler
+    if _stream_handler is None:
+        _stream_handler = logging.StreamHandler()
+        _stream_handler.setFormatter(FORMATTER)
+        logger.addHandler(_stream_handler)
+    _stream_handler.setLevel(logging.DEBUG if verbose else logging.INFO)
+    _refresh_level()
+    return _stream_handler
+
+
+def add_file_sink(path, json_format=False, level=logging.DEBUG):
+    """
+    Write the logs of the run to a file
+
+    :param path: path of the log file
+    :param json_format: if True, write one json object per line instead of plain text
+    :param level: minimum level of the records written to the file
+    :return: the file handler (to give to remove_sink at the end of the run)
+    """
+
+    handler = logging.FileHandler(path, mode="w", encoding="utf-8")
+    handler.setFormatter(JsonFormatter() if json_format else FORMATTER)
+    handler.setLevel(level)
+    logger.addHandler(handler)
+    _sinks.append(handler)
+    _refresh_level()
+    return handler
+
+
+def remove_sink(handler):
+    """Detach and close a sink created with add_file_sink"""
+
+    logger.removeHandler(handler)
+    handler.close()
+    if handler in _sinks:
+        _sinks.remove(handler)
+    _refresh_level()
+
+
+def close_sinks():
+    """Detach and close all the file sinks"""
+
+    for handler in list(_sinks):
+        remove_sink(handler)
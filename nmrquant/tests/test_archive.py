@@ -0,0 +1,113 @@
+"""Test module for the NMRQuant archive reprocessing"""
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import pytest
+
+from nmrquant.engine import archive
+from nmrquant.engine.archive import WorkQueue, find_experiments, reprocess, run_worker, shard_of
+
+TEST_DATA = Path(__file__).parent / "test_data"
+
+
+@pytest.fixture
+def archive_folder(tmp_path):
+    root = tmp_path / "archive"
+    for name in ["exp1", "exp2", "nested/exp3"]:
+        folder = root / name
+        folder.mkdir(parents=True)
+        shutil.copy(TEST_DATA / "data.xlsx", folder)
+        shutil.copy(TEST_DATA / "template.xlsx", folder)
+    return root
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = tmp_path / "proton_db.csv"
+    shutil.copy(TEST_DATA / "proton_db.csv", path)
+    return path
+
+
+class TestArchive:
+
+    def test_find_experiments(self, archive_folder, tmp_path):
+        experiments = find_experiments(archive_folder)
+        assert len(experiments) == 3
+        assert all(Path(path).name == "data.xlsx" for path in experiments["Data"])
+        # Ids do not depend on where the archive is mounted
+        moved = shutil.copytree(archive_folder, tmp_path / "elsewhere")
+        assert list(find_experiments(moved).index) == list(experiments.index)
+        table = tmp_path / "experiments.csv"
+        table.write_text("Data;Template\narchive/exp1/data.xlsx;archive/exp1/template.xlsx\n")
+        assert find_experiments(table)["Data"].iloc[0] == str(archive_folder / "exp1" / "data.xlsx")
+
+    def test_claim(self, tmp_path):
+        first = WorkQueue(tmp_path, "rev", run="a")
+        second = WorkQueue(tmp_path, "rev", run="a")
+        assert first.claim("0a")
+        assert not second.claim("0a")
+        first.complete("0a", {"status": "done"})
+        assert not second.claim("0a")
+        # A revised database makes the experiment pending again
+        assert WorkQueue(tmp_path, "other").claim("0a")
+
+    def test_failed_retried_by_next_run(self, tmp_path):
+        queue = WorkQueue(tmp_path, "rev", run="a")
+        assert queue.claim("0a")
+        queue.complete("0a", {"status": "failed"})
+        assert not WorkQueue(tmp_path, "rev", run="a").claim("0a")
+        assert WorkQueue(tmp_path, "rev", run="b").claim("0a")
+
+    def test_stale_lock(self, tmp_path):
+        assert WorkQueue(tmp_path, "rev").claim("0a")
+        lock = tmp_path / "locks" / "0a.lock"
+        old = time.time() - 100
+        os.utime(lock, (old, old))
+        assert not WorkQueue(tmp_path, "rev", stale_after=1000).claim("0a")
+        assert WorkQueue(tmp_path, "rev", stale_after=10).claim("0a")
+        assert [path.name for path in (tmp_path / "locks").iterdir()] == ["0a.lock"]
+
+    def test_stale_lock_taken_over_once(self, tmp_path, monkeypatch):
+        assert WorkQueue(tmp_path, "rev").claim("0a")
+        lock = tmp_path / "locks" / "0a.lock"
+        old = time.time() - 100
+        os.utime(lock, (old, old))
+        replace = os.replace
+
+        def other_worker_first(src, dst):
+            # Another worker takes over the stale lock between the check and the rename
+            monkeypatch.setattr(archive.os, "replace", replace)
+            assert WorkQueue(tmp_path, "rev", stale_after=10).claim("0a")
+            replace(src, dst)
+
+        monkeypatch.setattr(archive.os, "replace", other_worker_first)
+        assert not WorkQueue(tmp_path, "rev", stale_after=10).claim("0a")
+        # The lock of the other worker is still in place
+        assert [path.name for path in (tmp_path / "locks").iterdir()] == ["0a.lock"]
+        assert time.time() - lock.stat().st_mtime < 10
+
+    def test_workers_share_experiments(self, archive_folder, database, tmp_path, monkeypatch):
+        calls = []
+        monkeypatch.setattr(archive, "process_experiment",
+                            lambda data, *args, **kwargs: calls.append(data) or {"results": data})
+        experiments = find_experiments(archive_folder)
+        processed = [run_worker(tmp_path, experiments, database, worker, 2, run="a") for worker in range(2)]
+        assert sum(processed) == 3
+        assert sorted(calls) == sorted(experiments["Data"])
+        assert all(shard_of(ind, 2) in (0, 1) for ind in experiments.index)
+
+    def test_reprocess(self, archive_folder, database, tmp_path):
+        work_dir = tmp_path / "work"
+        manifest = reprocess(archive_folder, database, work_dir, workers=1, options={"mean": True})
+        assert (manifest["status"] == "done").all()
+        assert all(Path(path).is_file() for path in manifest["results"])
+        content = json.loads((work_dir / "manifest.json").read_text())
+        assert content["summary"] == {"done": 3}
+        # A new run does not process the finished experiments again
+        finished = manifest["finished"].copy()
+        manifest = reprocess(archive_folder, database, work_dir, workers=1, options={"mean": True})
+        assert manifest["finished"].equals(finished)
@@ -1,5 +1,7 @@
 """Test module for the NMRQuant calculator"""
 
+import numpy as np
+import pandas as pd
 import pytest
 from pathlib import Path
 
@@ -45,3 +47,29 @@ class TestCalculator:
         for col in quantifier.database.columns:
             assert col in database_cols
         assert quantifier.data["# Spectrum#"].values.all() == quantifier.metadata["# Spectrum"].values.all()
+
+
+class TestSpectrumFactors:
+
+    @staticmethod
+    def make_quantifier(**factors):
+        quantifier = Quantifier()
+        quantifier.dilution_factor = 2
+        quantifier.get_data(pd.DataFrame({"# Spectrum#": [1, 2, 3, 4], "Strd": [1] * 4, "Lactate": [3.0] * 4}))
+        quantifier.get_db(pd.DataFrame({"Metabolite": ["Lactate"], "Heq": [3]}))
+        quantifier.import_md(pd.DataFrame({"# Spectrum#": [1, 2, 3, 4], "Conditions": ["A", "A", "B", "B"],
+                                           "Time_Points": [0] * 4, "Replicates": [1, 2, 1, 2], **factors}))
+        quantifier.compute_data(strd_conc=5)
+        return quantifier
+
+    def test_run_values(self):
+        quantifier = self.make_quantifier()
+        assert quantifier.spectrum_factors is None
+        assert quantifier.conc_data["Lactate"].tolist() == [10.0] * 4
+
+    def test_template_columns(self):
+        quantifier = self.make_quantifier(Dilution=[1, np.nan, 4, 2], Strd_Concentration=[5, 5, 5, 10],
+                                          Normalization=[1, 2, 1, 0.5])
+        assert list(quantifier.spectrum_factors.columns) == ["Dilution", "Strd_Concentration", "Normalization"]
+        assert "Dilution" not in quantifier.mdata.columns
+        assert quantifier.conc_data["Lactate"].tolist() == [5.0, 5.0, 20.0, 40.0]
@@ -0,0 +1,64 @@
+"""Test module for the NMRQuant multi-point external calibration"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.calculator import Quantifier
+from nmrquant.engine.calibration import fit_calibration, apply_calibration
+
+
+@pytest.fixture
+def calibrated_quantifier():
+    levels = [1, 2, 5, 10, 20]
+    samples = [4.0, 8.0, 12.0]
+    # Areas proportional to concentrations with a metabolite specific response and a small offset
+    response = {"Ala": 3.0, "Lac": 1.5}
+    concentrations = levels + samples
+    data = pd.DataFrame({"# Spectrum#": range(1, 9)})
+    for met, factor in response.items():
+        data[met] = [c * factor + 0.1 for c in concentrations]
+    data["Strd"] = 1
+    template = pd.DataFrame({
+        "Conditions": ["Cal"] * 5 + ["A"] * 3,
+        "Time_Points": 0,
+        "Replicates": [1, 2, 3, 4, 5, 1, 2, 3],
+        "# Spectrum#": range(1, 9),
+        "Calibration": levels + [np.nan] * 3,
+    })
+    quantifier = Quantifier()
+    quantifier.dilution_factor = 1
+    quantifier.get_data(data)
+    quantifier.get_db(pd.DataFrame({"Metabolite": ["Ala", "Lac"], "Heq": [3, 3]}))
+    quantifier.import_md(template)
+    return quantifier
+
+
+class TestCalibration:
+
+    def test_fit(self):
+        areas = pd.DataFrame({"a": [2.0, 4.0, 6.0, np.nan], "b": [1.0, 1.0, 1.0, 1.0]})
+        levels = pd.Series([1.0, 2.0, 3.0, 4.0])
+        report = fit_calibration(areas, levels)
+        assert report.loc["a", "slope"] == pytest.approx(0.5)
+        assert report.loc["a", "intercept"] == pytest.approx(0)
+        assert report.loc["a", "n_points"] == 3 and report.loc["a", "r2"] == pytest.approx(1)
+        # Constant areas cannot be fitted
+        assert np.isnan(report.loc["b", "slope"])
+        proportional = fit_calibration(areas, levels, model="proportional", weighting="1/x2")
+        assert proportional.loc["a", "slope"] == pytest.approx(0.5)
+        assert apply_calibration(areas, report)["a"].tolist()[:3] == pytest.approx([1, 2, 3])
+
+    def test_quantifier_calibration(self, calibrated_quantifier):
+        calibrated_quantifier.compute_data(strd_conc=1)
+        conc = calibrated_quantifier.conc_data
+        assert "Cal" not in conc.index.get_level_values("Conditions")
+        assert np.allclose(conc.values, [[4, 4], [8, 8], [12, 12]])
+        assert (calibrated_quantifier.calibration_report["r2"] > 0.999).all()
+
+    def test_calibration_table(self, calibrated_quantifier):
+        table = pd.DataFrame({"# Spectrum#": [1, 2, 3, 4, 5], "Lac": [2, 4, 10, 20, 40]})
+        calibrated_quantifier.import_calibration(table)
+        calibrated_quantifier.compute_data(strd_conc=1)
+        conc = calibrated_quantifier.conc_data
+        assert np.allclose(conc["Ala"], [4, 8, 12]) and np.allclose(conc["Lac"], [8, 16, 24])
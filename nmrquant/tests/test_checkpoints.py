@@ -0,0 +1,75 @@
+"""Test module for the NMRQuant stage checkpoints"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.calculator import Quantifier
+from nmrquant.engine.checkpoints import CheckpointStore, fingerprint
+
+
+def make_quantifier(folder, **kwargs):
+    quantifier = Quantifier()
+    quantifier.get_data(pd.DataFrame({"# Spectrum#": range(1, 5), "Strd": [1] * 4, "Lactate": np.arange(1.0, 5.0)}))
+    quantifier.get_db(pd.DataFrame({"Metabolite": ["Lactate"], "Heq": [3]}))
+    quantifier.import_md(pd.DataFrame({"# Spectrum#": range(1, 5), "Conditions": ["A", "A", "B", "B"],
+                                       "Time_Points": [0] * 4, "Replicates": [1, 2, 1, 2]}))
+    quantifier.checkpoints = CheckpointStore(folder, **kwargs)
+    return quantifier
+
+
+def fail():
+    raise AssertionError("Stage should have been skipped")
+
+
+class TestCheckpoints:
+
+    def test_fingerprint(self, tmp_path):
+        data = pd.DataFrame({"a": [1.0, 2.0]})
+        assert fingerprint(data, {"x": 1}) == fingerprint(data.copy(), {"x": 1})
+        assert fingerprint(data) != fingerprint(data * 2)
+        path = tmp_path / "file.txt"
+        path.write_text("1")
+        before = fingerprint(path)
+        path.write_text("12")
+        assert fingerprint(path) != before
+
+    def test_resume(self, tmp_path):
+        first = make_quantifier(tmp_path)
+        first.compute_data(1, mean=True)
+        second = make_quantifier(tmp_path, resume=True)
+        second._merge_md_data = second._clean_cols = second._get_mean = fail
+        second.compute_data(1, mean=True)
+        pd.testing.assert_frame_equal(second.conc_data, first.conc_data)
+        pd.testing.assert_frame_equal(second.mean_data, first.mean_data)
+        # Changed parameters invalidate the stage and the following ones
+        third = make_quantifier(tmp_path, resume=True)
+        third._merge_md_data = third._clean_cols = fail
+        third.dilution_factor = 2
+        third.compute_data(1, mean=True)
+        assert third.mean_data.loc[("A", 0), "Lactate"] == pytest.approx(first.mean_data.loc[("A", 0), "Lactate"]
+                                                                         * 2 / first.dilution_factor)
+
+    def test_from_stage(self, tmp_path):
+        make_quantifier(tmp_path).compute_data(1, mean=True)
+        quantifier = make_quantifier(tmp_path, from_stage="concentrations")
+        quantifier._merge_md_data = fail
+        with pytest.raises(AssertionError):
+            quantifier._get_mean = fail
+            quantifier.compute_data(1, mean=True)
+
+    def test_stage_state(self, tmp_path):
+        quantifier = make_quantifier(tmp_path)
+        quantifier.compute_data(1, mean=True)
+        store = quantifier.checkpoints
+        mean_key = list(store.manifest["mean"])[0]
+        # The checkpoint of a stage only holds the attributes it set
+        state = store.load("mean", mean_key)
+        assert set(state) - {"_packed"} == {"mean_data", "std_data"}
+        assert "mdata" in store.load("merge", list(store.manifest["merge"])[0])
+        assert "data" not in store.load("merge", list(store.manifest["merge"])[0])
+        written = tmp_path / "plot.txt"
+        quantifier.run_stage("plot", lambda: written.write_text("plot"), files=lambda _: [written], chain=False)
+        [entry] = store.manifest["plot"].values()
+        assert entry["file"] is None and entry["files"] == [str(written)]
+        assert not list(tmp_path.glob("plot-*.pkl"))
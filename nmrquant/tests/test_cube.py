@@ -0,0 +1,50 @@
+"""Test module for the NMRQuant labeled concentration cube"""
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.cube import LabeledCube, read_zarr
+
+
+@pytest.fixture
+def conc_data():
+    index = pd.MultiIndex.from_product([["C1", "C2", "C10"], [0, 6, 12], [1, 2, 3]],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.random((len(index), 20)), index=index, columns=[f"M{i}" for i in range(20)])
+    return data.drop(("C2", 6, 3))
+
+
+class TestLabeledCube:
+
+    def test_from_frame(self, conc_data):
+        cube = LabeledCube.from_frame(conc_data)
+        assert cube.shape == (3, 3, 3, 20)
+        assert list(cube.coords["Conditions"]) == ["C1", "C2", "C10"]
+        assert np.isnan(cube.sel(Conditions="C2", Time_Points=6, Replicates=3).values).all()
+        assert cube.sel(Conditions="C10", Time_Points=12, Replicates=1, Metabolite="M4") == \
+            conc_data.loc[("C10", 12, 1), "M4"]
+        assert np.allclose(cube.to_frame().to_numpy(), conc_data.to_numpy())
+        with pytest.raises(ValueError):
+            LabeledCube.from_frame(pd.concat([conc_data, conc_data.iloc[:1]]))
+
+    def test_zarr(self, conc_data, tmp_path):
+        cube = LabeledCube.from_frame(conc_data)
+        store = cube.to_zarr(tmp_path / "cube.zarr", chunks=(1, 3, 3, 8))
+        meta = json.loads((store / "concentrations" / ".zarray").read_text())
+        assert meta["chunks"] == [1, 3, 3, 8] and meta["compressor"]["id"] == "zlib"
+        assert json.loads((store / "Conditions" / ".zattrs").read_text()) == {"_ARRAY_DIMENSIONS": ["Conditions"]}
+        full = read_zarr(store)
+        assert np.array_equal(full.values, cube.values, equal_nan=True)
+        assert list(full.coords["Conditions"]) == ["C1", "C2", "C10"]
+        part = read_zarr(store, Conditions="C10", Metabolite=["M18", "M3"])
+        assert part.dims == ("Time_Points", "Replicates", "Metabolite")
+        assert np.allclose(part.values, cube.sel(Conditions="C10", Metabolite=["M18", "M3"]).values)
+        # Only the chunks holding the selection are needed
+        for chunk in store.glob("concentrations/0.*"):
+            chunk.unlink()
+        assert np.allclose(read_zarr(store, Conditions="C2", Metabolite="M1").values,
+                           cube.sel(Conditions="C2", Metabolite="M1").values, equal_nan=True)
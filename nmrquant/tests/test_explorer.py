@@ -0,0 +1,64 @@
+"""Test module for the NMRQuant on-demand plot explorer"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.explorer import FigureCache, PlotExplorer
+
+
+@pytest.fixture
+def quantifier():
+    index = pd.MultiIndex.from_product([["A", "B", "C"], [0, 1, 2], [1, 2, 3]],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    conc_data = pd.DataFrame({"Lactate": np.linspace(1, 10, 27), "Acetate": np.linspace(5, 2, 27)}, index=index)
+    return SimpleNamespace(conc_data=conc_data, mean_data=None, std_data=None, time_points=[0, 1, 2],
+                           replicates=[1, 2, 3], metabolites=["Lactate", "Acetate"])
+
+
+class TestFigureCache:
+
+    def test_lru_eviction(self):
+        cache = FigureCache(max_bytes=10)
+        cache.put("a", [("a", b"1234")])
+        cache.put("b", [("b", b"1234")])
+        assert cache.get("a") == [("a", b"1234")]
+        # "b" is the least recently used view
+        cache.put("c", [("c", b"1234")])
+        assert "b" not in cache and "a" in cache and "c" in cache
+        assert cache.nbytes == 8
+        cache.put("d", [("d", b"x" * 11)])
+        assert "d" not in cache and len(cache) == 2
+        assert (cache.hits, cache.misses) == (1, 0)
+        with pytest.raises(ValueError):
+            FigureCache(0)
+
+
+class TestPlotExplorer:
+
+    def test_render_on_demand(self, quantifier):
+        explorer = PlotExplorer(quantifier)
+        assert explorer.kinds == ["individual_lineplot", "summary_lineplot"]
+        figures = explorer.render("individual_lineplot", "Lactate")
+        assert [fname for fname, _ in figures] == ["Lactate_A", "Lactate_B", "Lactate_C"]
+        assert explorer.render("individual_lineplot", "Lactate", ["C", "B", "A"]) is figures
+        assert explorer.cache.hits == 1 and len(explorer.viewed) == 1
+        [(fname, content)] = explorer.render("summary_lineplot", "Lactate", ["B", "A"])
+        assert fname == "Lactate_A_B" and content.startswith(b"<svg")
+        with pytest.raises(ValueError):
+            explorer.render("meaned_histogram", "Lactate")
+        with pytest.raises(ValueError):
+            explorer.render("summary_lineplot", "Lactate", ["D"])
+
+    def test_export_viewed(self, quantifier, tmp_path):
+        explorer = PlotExplorer(quantifier, fmt="png", max_bytes=1)
+        explorer.render("summary_lineplot", "Acetate")
+        explorer.render("individual_lineplot", "Lactate", ["A"])
+        # Nothing fits in the cache: viewed plots are rendered again when exported
+        assert len(explorer.cache) == 0
+        paths = explorer.export_viewed(tmp_path)
+        assert sorted(str(path.relative_to(tmp_path)).replace("\\", "/") for path in paths) == [
+            "Lineplots_Individual/Lactate_A.png", "Lineplots_Summary/Acetate.png"]
+        assert all(path.read_bytes()[:4] == b"\x89PNG" for path in paths)
@@ -0,0 +1,73 @@
+"""Test module for the NMRQuant column expression engine"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.calculator import Quantifier
+from nmrquant.engine.expressions import CompiledExpressions, parse_expression, read_definitions, tokenize
+
+NAMES = ["Isoleucine", "Leucine", "Isoleucine+Leucine", "Lactate", "Pyruvate"]
+
+
+class TestExpressions:
+
+    def test_tokenize(self):
+        assert tokenize("Isoleucine+Leucine - Isoleucine", NAMES) == [
+            ("name", "Isoleucine+Leucine"), ("op", "-"), ("name", "Isoleucine")]
+        assert tokenize("0,5*Lactate", NAMES) == [("number", 0.5), ("op", "*"), ("name", "Lactate")]
+        with pytest.raises(KeyError):
+            tokenize("Lactate + Glucose", NAMES)
+
+    def test_parse(self):
+        assert parse_expression("Isoleucine+Leucine - 2*(Isoleucine - Leucine/2)", NAMES) == (
+            {"Isoleucine+Leucine": 1.0, "Isoleucine": -2.0, "Leucine": 1.0}, {None: 1.0})
+        assert parse_expression("Lactate / (Pyruvate + 1)", NAMES) == ({"Lactate": 1.0}, {"Pyruvate": 1.0, None: 1.0})
+        with pytest.raises(ValueError):
+            parse_expression("Lactate * Pyruvate", NAMES)
+        with pytest.raises(ValueError):
+            parse_expression("(Lactate + Pyruvate", NAMES)
+
+    def test_definitions(self, tmp_path):
+        path = tmp_path / "expressions.txt"
+        path.write_text("# Comment\nLeucine = Isoleucine+Leucine - Isoleucine\n\nRatio = Lactate / Pyruvate\n")
+        assert read_definitions(str(path)) == {"Leucine": "Isoleucine+Leucine - Isoleucine",
+                                               "Ratio": "Lactate / Pyruvate"}
+        database = pd.DataFrame({"Metabolite": ["Lactate", "Leucine "], "Expression": [np.nan, "A - B"]})
+        assert read_definitions(database) == {"Leucine": "A - B"}
+        with pytest.raises(ValueError):
+            read_definitions(["Lactate/Pyruvate = Lactate / Pyruvate"])
+
+    def test_evaluate(self):
+        data = pd.DataFrame({"Isoleucine": [1.0, 2.0, np.nan], "Isoleucine+Leucine": [3.0, 5.0, 4.0],
+                             "Lactate": [4.0, 6.0, 8.0], "Pyruvate": [2.0, 0.0, 4.0]})
+        compiled = CompiledExpressions({"Leucine": "Isoleucine+Leucine - Isoleucine",
+                                        "Ratio": "Lactate / Pyruvate"}, data.columns)
+        results = compiled.evaluate(data)
+        assert np.allclose(results["Leucine"], [2, 3, np.nan], equal_nan=True)
+        # The missing isoleucine value does not affect the ratio, a null denominator gives NaN
+        assert np.allclose(results["Ratio"], [2, np.nan, 2], equal_nan=True)
+
+    def test_quantifier(self):
+        data = pd.DataFrame({"# Spectrum#": [1, 2, 3], "Isoleucine": [3.0, 6.0, 9.0],
+                             "Isoleucine+Leucine": [12.0, 18.0, 24.0], "Lactate": [3.0, 3.0, 3.0], "Strd": 1})
+        database = pd.DataFrame({"Metabolite": ["Isoleucine", "Isoleucine+Leucine", "Lactate", "Leucine"],
+                                 "Heq": [3, np.nan, 3, 3], "Expression": [np.nan, np.nan, np.nan,
+                                                                          "Isoleucine+Leucine - Isoleucine"]})
+        template = pd.DataFrame({"Conditions": "A", "Time_Points": 0, "Replicates": [1, 2, 3],
+                                 "# Spectrum#": [1, 2, 3]})
+        quantifier = Quantifier()
+        quantifier.dilution_factor = 1
+        quantifier.get_data(data)
+        quantifier.get_db(database)
+        quantifier.import_md(template)
+        quantifier.set_expressions(["Ile to Lac = Isoleucine / Lactate", "Bad = Isoleucine+Leucine / Lactate"])
+        quantifier.compute_data(strd_conc=1)
+        conc = quantifier.conc_data
+        assert "Isoleucine+Leucine" not in conc.columns
+        assert list(quantifier.sum_data.columns) == ["Isoleucine+Leucine"]
+        # Summed area = 3 x [Ile] + 3 x [Leu]
+        assert np.allclose(conc["Leucine"], [3, 4, 5])
+        assert np.allclose(conc["Ile to Lac"], [1, 2, 3])
+        # Summed columns have no concentration of their own
+        assert "Bad" not in conc.columns
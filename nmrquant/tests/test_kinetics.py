@@ -0,0 +1,55 @@
+"""Test module for the NMRQuant kinetic rate estimation"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.kinetics import fit_kinetics, model_curve
+
+
+@pytest.fixture
+def conc_data():
+    times = [0, 1, 2, 4, 8]
+    index = pd.MultiIndex.from_product([["A", "B"], times, [1, 2]],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    t = index.get_level_values("Time_Points").to_numpy(dtype=float)
+    condition_b = index.get_level_values("Conditions") == "B"
+    data = pd.DataFrame({
+        # Linear production at 2 mM/h for A, 3 mM/h for B
+        "Ethanol": np.where(condition_b, 3, 2) * t + 1,
+        # Exponential growth at 0.3 /h
+        "Biomass": 0.5 * np.exp(0.3 * t),
+    }, index=index)
+    # Missing value at the start of one time course
+    data.loc[("A", 0, 2), "Ethanol"] = np.nan
+    return data.sample(frac=1, random_state=0)
+
+
+class TestKinetics:
+
+    def test_replicate_fits(self, conc_data):
+        fits = fit_kinetics(conc_data)
+        assert fits.shape[0] == 8
+        assert fits.loc[("A", 1, "Ethanol"), "slope"] == pytest.approx(2)
+        assert fits.loc[("B", 2, "Ethanol"), "slope"] == pytest.approx(3)
+        assert fits.loc[("A", 2, "Ethanol"), "n_points"] == 4
+        # Initial rate on the first three available time points
+        assert fits.loc[("A", 2, "Ethanol"), "initial_end"] == 4
+        assert fits.loc[("A", 1, "Ethanol"), "initial_end"] == 2
+        assert fits.loc[("A", 1, "Biomass"), "exp_rate"] == pytest.approx(0.3)
+        assert fits.loc[("A", 1, "Biomass"), "exp_amplitude"] == pytest.approx(0.5)
+        assert fits.loc[("A", 1, "Biomass"), "exp_rate_se"] == pytest.approx(0, abs=1e-10)
+
+    def test_pooled_fits(self, conc_data):
+        noisy = conc_data + np.random.default_rng(0).normal(0, 0.1, conc_data.shape)
+        fits = fit_kinetics(noisy, by=("Conditions",))
+        assert list(fits.index.names) == ["Conditions", "Metabolite"]
+        assert fits.loc[("B", "Ethanol"), "slope"] == pytest.approx(3, abs=0.05)
+        assert fits.loc[("B", "Ethanol"), "slope_se"] > 0
+        assert fits.loc[("B", "Ethanol"), "initial_end"] == 2
+
+    def test_model_curve(self, conc_data):
+        fit = fit_kinetics(conc_data).loc[("A", 1, "Biomass")]
+        times, values = model_curve(fit, "exponential")
+        assert np.allclose(values, 0.5 * np.exp(0.3 * times))
+        assert times[0] == 0 and times[-1] == 8
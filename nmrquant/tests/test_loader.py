@@ -0,0 +1,74 @@
+"""Test module for the NMRQuant concurrent input loader"""
+
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from nmrquant.engine import loader
+from nmrquant.engine.calculator import Quantifier
+from nmrquant.engine.loader import load_quantifier
+
+TEST_DATA = Path(__file__).parent / "test_data"
+
+
+@pytest.fixture
+def template():
+    return pd.DataFrame({"# Spectrum#": [1, 2], "Conditions": ["A", "B"], "Time_Points": [0, 0],
+                         "Replicates": [1, 1]})
+
+
+@pytest.fixture
+def database():
+    return pd.DataFrame({"Metabolite": ["Lactate"], "Heq": [3]})
+
+
+@pytest.fixture
+def data():
+    return pd.DataFrame({"# Spectrum#": [1, 2], "Strd": [1, 1], "Lactate": [1.0, 2.0]})
+
+
+class TestLoader:
+
+    def test_paths(self):
+        quantifier = load_quantifier(TEST_DATA / "data.xlsx", str(TEST_DATA / "proton_db.csv"),
+                                     TEST_DATA / "template.xlsx")
+        reference = Quantifier()
+        reference.get_data(str(TEST_DATA / "data.xlsx"))
+        reference.get_db(str(TEST_DATA / "proton_db.csv"))
+        reference.import_md(str(TEST_DATA / "template.xlsx"))
+        pd.testing.assert_frame_equal(quantifier.data, reference.data)
+        pd.testing.assert_frame_equal(quantifier.database, reference.database)
+        pd.testing.assert_frame_equal(quantifier.metadata, reference.metadata)
+
+    def test_futures_are_copied(self, data, database, template):
+        future = Future()
+        future.set_result(data)
+        quantifier = load_quantifier(future, database, template)
+        assert "Strd" not in quantifier.data.columns
+        assert "Strd" in data.columns
+
+    def test_missing_columns(self, data, database, template):
+        with pytest.raises(ValueError, match="template"):
+            load_quantifier(data, database, template.drop(columns="Replicates"))
+        with pytest.raises(ValueError, match="No spectrum"):
+            load_quantifier(data, database, template.assign(**{"# Spectrum#": [5, 6]}))
+
+    def test_fail_fast(self, data, template, monkeypatch):
+        release = threading.Event()
+        read_input = loader.read_input
+
+        def slow_read(source, kind, excel_sheet=0):
+            if kind == "data":
+                release.wait(5)
+            return read_input(source, kind, excel_sheet)
+
+        monkeypatch.setattr(loader, "read_input", slow_read)
+        start = time.perf_counter()
+        with pytest.raises(ValueError, match="database"):
+            load_quantifier(data, pd.DataFrame({"Name": ["Lactate"]}), template)
+        assert time.perf_counter() - start < 2
+        release.set()
@@ -0,0 +1,58 @@
+"""Test module for the NMRQuant logging layer"""
+
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import nmrquant.logger
+from nmrquant.engine.calculator import Quantifier
+from nmrquant.logger import summarize
+
+
+class TestLogger:
+
+    def test_single_console_handler(self):
+        Quantifier()
+        Quantifier(verbose=True)
+        base = logging.getLogger("RMNQ_logger")
+        assert sum(type(h) is logging.StreamHandler for h in base.handlers) == 1
+        assert not logging.getLogger("RMNQ_logger.engine.calculator.Quantifier").handlers
+        nmrquant.logger.setup_handler(False)
+        assert not base.isEnabledFor(logging.DEBUG)
+
+    def test_summary_is_bounded(self):
+        df = pd.DataFrame({f"met{i}": range(1000) for i in range(50)})
+        text = str(summarize(df))
+        assert "1000x50" in text and "+42" in text
+        assert len(text) < 400
+        assert "+92" in str(summarize({i: i for i in range(100)}))
+        assert "+992" in str(summarize(set(range(1000))))
+        text = str(summarize(np.full((1000, 50), 1.5)))
+        assert text.startswith("<ndarray 1000x50 float64") and "+49992" in text and len(text) < 200
+        assert len(str(summarize("x" * 10000))) < 300
+
+    def test_json_sink(self, tmp_path):
+        sink = nmrquant.logger.add_file_sink(tmp_path / "run.jsonl", json_format=True)
+        logging.getLogger("RMNQ_logger.tests").debug("Value = %s", 3)
+        nmrquant.logger.remove_sink(sink)
+        with open(tmp_path / "run.jsonl") as log_file:
+            entry = json.loads(log_file.readline())
+        assert entry["message"] == "Value = 3" and entry["level"] == "DEBUG"
+        assert not logging.getLogger("RMNQ_logger").isEnabledFor(logging.DEBUG)
+
+    def test_sinks_closed_on_failure(self, tmp_path, monkeypatch):
+        from nmrquant.ui import cli
+
+        def failing_process(args):
+            nmrquant.logger.add_file_sink(tmp_path / "run.log")
+            raise ValueError("Failed run")
+
+        monkeypatch.setattr(cli, "process", failing_process)
+        monkeypatch.setattr("sys.argv", ["nmrquant", str(tmp_path / "data.xlsx")])
+        with pytest.raises(ValueError):
+            cli.start_cli()
+        assert not nmrquant.logger._sinks
+        assert not any(isinstance(h, logging.FileHandler) for h in logging.getLogger("RMNQ_logger").handlers)
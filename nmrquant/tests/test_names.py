@@ -0,0 +1,56 @@
+"""Test module for the NMRQuant metabolite name resolution"""
+
+import pandas as pd
+import pytest
+
+from nmrquant.engine.names import NameResolver, merge_databases, normalize, read_aliases
+
+
+@pytest.fixture
+def resolver():
+    return NameResolver(["Histidine", "Glucose ", "ILE+LEU", "Isoleucine", "Leucine"],
+                        aliases={"Isoleucine+Leucine": "ILE+LEU", "Unknown": "Nothing"})
+
+
+class TestNames:
+
+    def test_match(self, resolver):
+        assert normalize("  Glucose\t 6P ") == "glucose 6p"
+        assert resolver.match("Histidine") == ("Histidine", "exact")
+        assert resolver.match("glucose") == ("Glucose ", "normalized")
+        assert resolver.match("isoleucine+leucine") == ("ILE+LEU", "alias")
+        assert resolver.match("Histine") == (None, "unresolved")
+
+    def test_suggestions(self, resolver):
+        assert resolver.suggest("Histine")[0][0] == "Histidine"
+        assert resolver.suggest("Pyruvate") == []
+        report = resolver.report(["Histine", "Glucose"])
+        assert report.loc["Histine", "Suggestions"] == "Histidine"
+        assert report.loc["Glucose", "Match"] == "normalized"
+
+    def test_merge(self):
+        site = pd.DataFrame({"Metabolite": ["Lactate", "Alanine"], "Heq": [3, 3]})
+        user = pd.DataFrame({"Metabolite": ["lactate "], "Heq": [1]})
+        merged = merge_databases({"user": user, "site": site}).set_index("Metabolite")
+        assert merged.loc["lactate ", "Heq"] == 1 and merged.loc["lactate ", "Source"] == "user"
+        assert merged.loc["Alanine", "Source"] == "site" and len(merged) == 2
+        # A metabolite entered once or as numbered signals is replaced as a whole
+        site = pd.DataFrame({"Metabolite": ["Glucose_1", "Glucose_2", "Citrate"], "Heq": [1, 1, 2]})
+        project = pd.DataFrame({"Metabolite": ["Citrate_1", "Citrate_2"], "Heq": [2, 2]})
+        user = pd.DataFrame({"Metabolite": ["glucose"], "Heq": [5]})
+        merged = merge_databases([site, project, user])
+        assert sorted(merged["Metabolite"]) == ["Citrate_1", "Citrate_2", "glucose"]
+        assert set(merged["Source"]) == {"project", "user"}
+        database = pd.DataFrame({"Metabolite": ["ILE+LEU"], "Aliases": ["Isoleucine+Leucine; LEU+ILE"]})
+        assert read_aliases(database) == {"Isoleucine+Leucine": "ILE+LEU", "LEU+ILE": "ILE+LEU"}
+
+    def test_quantifier(self):
+        from nmrquant.engine.calculator import Quantifier
+        quantifier = Quantifier()
+        quantifier.get_db([pd.DataFrame({"Metabolite": ["Lactate ", "Alanine"], "Heq": ["1,5", "3"]}),
+                           pd.DataFrame({"Metabolite": ["Alanine"], "Heq": [1]})])
+        assert quantifier.proton_dict == {"Alanine": 1, "Lactate ": 1.5}
+        quantifier.cor_data = pd.DataFrame({"Lactate": [3.0], "Alanin": [1.0]})
+        quantifier._resolve_names()
+        assert quantifier.proton_dict["Lactate"] == 1.5
+        assert quantifier.name_report.loc["Alanin", "Suggestions"] == "Alanine"
@@ -0,0 +1,62 @@
+"""Test module for the NMRQuant replicate outlier screening"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.outliers import MAD_MIN_VALUES, detect_outliers, grubbs_critical, robust_z
+
+
+@pytest.fixture
+def conc_data():
+    index = pd.MultiIndex.from_product([["A", "B"], [0, 6], range(1, 7)],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.normal(10, 0.2, size=(len(index), 3)), index=index, columns=["Ala", "Gly", "Lac"])
+    data.loc[("A", 0, 2), "Gly"] = 20
+    data.loc[("B", 6, 5), "Lac"] = 3
+    # Groups with less than three replicates are never screened
+    data.loc[("B", 0, 1), "Ala"] = 50
+    return data.drop([("B", 0, rep) for rep in range(2, 6)])
+
+
+class TestOutliers:
+
+    def test_robust_z(self):
+        cube = np.array([[[1.0], [2.0], [3.0], [np.nan]]])
+        assert np.allclose(robust_z(cube)[0, :3, 0], [-0.6745, 0, 0.6745])
+        # Null MAD: the mean absolute deviation is used
+        assert robust_z(np.array([[[1.0], [1.0], [5.0]]]))[0, 2, 0] == pytest.approx(4 / (1.253314 * 4 / 3))
+        assert not robust_z(np.ones((1, 3, 1))).any()
+
+    def test_grubbs_critical(self):
+        # Tabulated two-sided critical values at alpha = 0.05
+        assert np.allclose(grubbs_critical([3, 6, 10]), [1.155, 1.887, 2.290], atol=1e-3)
+        assert np.isnan(grubbs_critical([2]))[0]
+
+    @pytest.mark.parametrize("method", ["mad", "grubbs", "dixon"])
+    def test_detection(self, conc_data, method):
+        mask, report = detect_outliers(conc_data, method)
+        assert mask.shape == conc_data.shape and mask.to_numpy().sum() == 2
+        assert mask.loc[("A", 0, 2), "Gly"] and mask.loc[("B", 6, 5), "Lac"]
+        assert list(report["Metabolite"]) == ["Gly", "Lac"]
+        assert (report["ratio"] > 1).all() and report["ratio"].is_monotonic_decreasing
+
+    def test_quantifier_masking(self, conc_data):
+        from nmrquant.engine.calculator import Quantifier
+        quantifier = Quantifier()
+        quantifier.conc_data = conc_data
+        quantifier.screen_outliers("grubbs", mask=True)
+        assert quantifier.conc_data.isna().to_numpy().sum() == 2
+        assert np.isnan(quantifier.conc_data.loc[("A", 0, 2), "Gly"])
+
+    @pytest.mark.parametrize("replicates", [3, 4, MAD_MIN_VALUES, 8])
+    def test_false_positives(self, replicates):
+        # Clean normal replicates: robust z-scores of 3 replicates flagged about 10 % of the values
+        index = pd.MultiIndex.from_product([["A"], range(400), range(replicates)],
+                                           names=["Conditions", "Time_Points", "Replicates"])
+        rng = np.random.default_rng(1)
+        data = pd.DataFrame(rng.normal(10, 1, size=(len(index), 5)), index=index)
+        mask, report = detect_outliers(data, "mad")
+        assert mask.to_numpy().mean() < 0.03
+        assert set(report["method"]) <= {"grubbs" if replicates < MAD_MIN_VALUES else "mad"}
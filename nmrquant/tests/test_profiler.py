@@ -0,0 +1,33 @@
+"""Test module for the NMRQuant stage profiler"""
+
+import json
+
+import pandas as pd
+
+from nmrquant.engine.profiler import StageProfiler
+
+
+class TestProfiler:
+
+    def test_disabled_profiler_records_nothing(self):
+        profiler = StageProfiler()
+        with profiler.stage("merge") as record:
+            record.set_shape(pd.DataFrame({"a": [1, 2]}))
+        assert profiler.report == []
+
+    def test_stage_records(self, tmp_path):
+        profiler = StageProfiler(enabled=True)
+        with profiler.stage("outer"):
+            with profiler.stage("inner") as record:
+                data = pd.DataFrame({"a": range(1000), "b": range(1000)})
+                record.set_shape(data)
+        inner, outer = profiler.report
+        assert inner["stage"] == "inner" and outer["stage"] == "outer"
+        assert (inner["rows"], inner["columns"]) == (1000, 2)
+        assert outer["wall_time_s"] >= inner["wall_time_s"]
+        assert outer["peak_memory_mb"] >= inner["peak_memory_mb"] > 0
+        profiler.dump(tmp_path / "profile.json")
+        with open(tmp_path / "profile.json") as json_file:
+            assert [r["stage"] for r in json.load(json_file)["stages"]] == ["inner", "outer"]
+        profiler.reset()
+        assert profiler.report == []
@@ -0,0 +1,79 @@
+"""Test module for the NMRQuant quality control on the internal standard"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.calculator import Quantifier
+from nmrquant.engine.qc import find_standard, normalize_to_standard, standard_qc
+from nmrquant.engine.visualizer import StandardQCPlot
+
+
+def make_quantifier(strd, column="TSP"):
+    quantifier = Quantifier()
+    spectra = np.arange(1, len(strd) + 1)
+    # The Strd column only flags the calibration, in the first row
+    data = pd.DataFrame({"# Spectrum#": spectra, "Strd": [1] + [np.nan] * (len(strd) - 1),
+                         "Lactate": np.full(len(strd), 6.0)})
+    if column is not None:
+        data[column] = strd
+    quantifier.get_data(data)
+    quantifier.get_db(pd.DataFrame({"Metabolite": ["Lactate"], "Heq": [3]}))
+    quantifier.import_md(pd.DataFrame({"# Spectrum#": spectra, "Conditions": ["A", "B"] * (len(strd) // 2),
+                                       "Time_Points": [0] * len(strd), "Replicates": np.repeat(
+                                           np.arange(1, len(strd) // 2 + 1), 2)}))
+    return quantifier
+
+
+class TestQC:
+
+    def test_stable_run(self):
+        strd = pd.Series([1.0, 1.02, 0.98, 1.01, 0.99, 1.0], index=range(1, 7))
+        spectra, summary = standard_qc(strd)
+        assert summary["Status"] == "pass"
+        assert summary["CV (%)"] == pytest.approx(100 * strd.std() / strd.mean())
+        assert not spectra["Outlier"].any()
+
+    def test_drift_and_outlier(self):
+        strd = pd.Series(np.linspace(1, 1.3, 10), index=range(1, 11))
+        _, summary = standard_qc(strd)
+        assert summary["Drift (%)"] == pytest.approx(100 * 0.3 / strd.mean())
+        assert "drift" in summary["Status"]
+        strd = pd.Series([1.0, 1.01, 0.99, 1.0, 0.5, 1.02], index=range(1, 7))
+        spectra, summary = standard_qc(strd)
+        assert list(spectra.index[spectra["Outlier"]]) == [5]
+        assert summary["Outlying spectra"] == "5"
+
+    def test_normalize(self):
+        areas = pd.DataFrame({"Lactate": [2.0, 4.0]}, index=pd.Index([1, 2], name="# Spectrum#"))
+        normalized = normalize_to_standard(areas, pd.Series([2.0, 4.0], index=[1, 2]))
+        assert list(normalized["Lactate"]) == [1.0, 1.0]
+        with pytest.raises(ValueError):
+            normalize_to_standard(areas, pd.Series([2.0, 0.0], index=[1, 2]))
+
+    def test_find_standard(self):
+        assert find_standard(["Lactate", "tsp "]) == "tsp "
+        assert find_standard(["Lactate", "Strd"]) is None
+        assert find_standard(["Lactate", "Formate"], "formate") == "Formate"
+
+    def test_quantifier(self):
+        quantifier = make_quantifier([1.0, 2.0, 1.0, 2.0])
+        quantifier.compute_data(1)
+        assert quantifier.strd_data.tolist() == [1.0, 2.0, 1.0, 2.0]
+        assert "Strd" not in quantifier.data.columns
+        assert quantifier.qc_summary["Status"].startswith("fail")
+        assert quantifier.conc_data["Lactate"].tolist() == pytest.approx([6 * 1.11 / 3] * 4)
+        StandardQCPlot(quantifier.qc_data, quantifier.qc_summary)()
+        normalized = make_quantifier([1.0, 2.0, 1.0, 2.0], column="Formate")
+        normalized.standard_column = "Formate"
+        normalized.normalize_strd = True
+        normalized.compute_data(1)
+        assert sorted(normalized.conc_data["Lactate"]) == pytest.approx(sorted([6 * 1.11 / 3, 3 * 1.11 / 3] * 2))
+
+    def test_no_standard(self):
+        quantifier = make_quantifier([1.0] * 4, column=None)
+        quantifier.normalize_strd = True
+        quantifier.compute_data(1)
+        # Quality control and normalization are skipped
+        assert quantifier.qc_summary is None and quantifier.strd_data is None
+        assert quantifier.conc_data["Lactate"].tolist() == pytest.approx([6 * 1.11 / 3] * 4)
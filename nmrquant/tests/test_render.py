@@ -0,0 +1,102 @@
+"""Test module for the NMRQuant direct renderer of the bar and line plots"""
+
+import struct
+import xml.etree.ElementTree as ElementTree
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+from matplotlib.colors import to_hex, to_rgb
+
+from nmrquant.engine.render import Scene, encode_png, nice_ticks, save_plot
+from nmrquant.engine.visualizer import IndHistB, IndLine, MeanLine, MultHistB
+
+SVG = "{http://www.w3.org/2000/svg}"
+
+
+@pytest.fixture
+def kinetics():
+    index = pd.MultiIndex.from_product([["A", "B"], [0, 1, 2], [1, 2, 3]],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    return pd.DataFrame({"Lactate": np.linspace(1, 10, 18)}, index=index)
+
+
+@pytest.fixture
+def one_time(kinetics):
+    return kinetics.xs(0, level="Time_Points", drop_level=False)
+
+
+def read_png(content):
+    """Decode the RGB pixels of a PNG written by encode_png"""
+
+    assert content[:8] == b"\x89PNG\r\n\x1a\n"
+    width, height = struct.unpack(">II", content[16:24])
+    length = struct.unpack(">I", content[33:37])[0]
+    raw = np.frombuffer(zlib.decompress(content[41:41 + length]), dtype=np.uint8)
+    return raw.reshape(height, -1)[:, 1:].reshape(height, width, 3)
+
+
+class TestRender:
+
+    def test_nice_ticks(self):
+        ticks, labels = nice_ticks(0, 13.7, 7)
+        assert list(ticks) == [0, 2, 4, 6, 8, 10, 12]
+        assert labels[1] == "2"
+        assert nice_ticks(0, 1, 4)[1] == ["0.00", "0.25", "0.50", "0.75", "1.00"]
+        assert len(nice_ticks(1, 1)[0]) == 0
+
+    def test_encode_png(self):
+        image = np.zeros((3, 2, 3), dtype=np.uint8)
+        image[1, 0] = [255, 0, 10]
+        assert (read_png(encode_png(image)) == image).all()
+
+    def test_histogram_scene(self, one_time):
+        plot = IndHistB(one_time, "Lactate", False)
+        [(fname, scene)] = plot.scenes()
+        assert fname == "Lactate"
+        assert [bar[3] for bar in scene.bars] == [to_hex(color) for color in plot.colors]
+        assert scene.categories[1] == plot.x_labels
+        svg = ElementTree.fromstring(scene.to_svg())
+        texts = [text.text for text in svg.iter(f"{SVG}text")]
+        assert "Lactate" in texts and "A_1" in texts and "Concentration in mM" in texts
+        image = read_png(scene.to_png())
+        assert image.shape == (480, 640, 3)
+        # Bars of the first condition are drawn with its color
+        assert (image == np.round(np.array(to_rgb(plot.colors[0])) * 255)).all(axis=2).sum() > 1000
+
+    def test_meaned_scenes(self, kinetics, one_time):
+        means = one_time.groupby(["Conditions", "Time_Points"]).mean()
+        stds = one_time.groupby(["Conditions", "Time_Points"]).std()
+        [(_, scene)] = MultHistB(means, stds, "Lactate", False).scenes()
+        assert len(scene.errorbars) == 1 and scene.ylabel is None
+        [(_, scene)] = MeanLine(kinetics, "Lactate", False).scenes()
+        assert [label for label, _ in scene.legend] == ["A", "B"]
+        assert len(scene.errorbars) == 2
+        top = kinetics.groupby(["Conditions", "Time_Points"])["Lactate"].mean().max() * 1.2
+        assert scene.y_limits == (0, pytest.approx(top))
+
+    def test_missing_values(self):
+        scene = Scene("Title\nSubtitle", xlabel="Time in hours")
+        scene.add_line([0, 1, 2, 3], [1, np.nan, 2, 3], "#ff0000", label="A")
+        svg = ElementTree.fromstring(scene.to_svg())
+        # The line is broken at the missing value (the third red line is the legend)
+        assert len([line for line in svg.iter(f"{SVG}polyline") if line.get("stroke") == "#ff0000"]) == 3
+        assert read_png(scene.to_png()).shape == (480, 640, 3)
+
+    @pytest.mark.parametrize("fmt", ["svg", "png"])
+    def test_save_plot(self, kinetics, tmp_path, fmt):
+        plot = IndLine(kinetics, "Lactate", False)
+        (tmp_path / "matplotlib").mkdir()
+        (tmp_path / "direct").mkdir()
+        expected = save_plot(plot, fmt, tmp_path / "matplotlib")
+        paths = save_plot(plot, fmt, tmp_path / "direct", renderer="direct")
+        assert [path.name for path in paths] == [path.name for path in expected] == [f"Lactate_A.{fmt}",
+                                                                                    f"Lactate_B.{fmt}"]
+        assert all(path.stat().st_size for path in paths)
+
+    def test_fallback(self, one_time, tmp_path):
+        paths = save_plot(IndHistB(one_time, "Lactate", False), "jpeg", tmp_path, renderer="direct")
+        assert paths[0].read_bytes()[:2] == b"\xff\xd8"
+        with pytest.raises(ValueError):
+            save_plot(IndHistB(one_time, "Lactate", False), "svg", tmp_path, renderer="cairo")
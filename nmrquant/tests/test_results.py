@@ -0,0 +1,72 @@
+"""Test module for the NMRQuant compact results cube"""
+
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.results import ResultsCube
+
+
+@pytest.fixture
+def conc_data():
+    index = pd.MultiIndex.from_product([["A", "B"], [0, 6, 12], range(1, 5)],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.normal(10, 1, size=(len(index), 4)), index=index, columns=["Ala", "Gly", "Lac", "Val"])
+    data.iloc[3, 1] = np.nan
+    return data
+
+
+class TestResultsCube:
+
+    def test_round_trip(self, conc_data):
+        cube = ResultsCube.from_frame(conc_data)
+        assert cube.shape == conc_data.shape and cube.codes.dtype == np.int8
+        pd.testing.assert_frame_equal(cube.to_frame(), conc_data)
+        assert list(cube.level_values("Time_Points")) == list(conc_data.index.get_level_values("Time_Points"))
+        simple = conc_data.reset_index(drop=True)
+        pd.testing.assert_frame_equal(ResultsCube.from_frame(simple).to_frame(), simple)
+
+    def test_zero_copy(self, conc_data):
+        cube = ResultsCube.from_frame(conc_data)
+        frame = cube.to_frame()
+        assert np.shares_memory(frame.to_numpy(), cube.values)
+        assert cube.to_frame() is frame
+
+    def test_pickle(self, conc_data):
+        cube = pickle.loads(pickle.dumps(ResultsCube.from_frame(conc_data)))
+        pd.testing.assert_frame_equal(cube.to_frame(), conc_data)
+
+    def test_quantifier(self, conc_data):
+        from nmrquant.engine.calculator import Quantifier
+        quantifier = Quantifier()
+        quantifier.conc_data = conc_data
+        assert isinstance(quantifier.results, ResultsCube)
+        quantifier.mean_data = conc_data.groupby(["Conditions", "Time_Points"]).mean()
+        restored = pickle.loads(pickle.dumps(quantifier))
+        pd.testing.assert_frame_equal(restored.conc_data, conc_data)
+        pd.testing.assert_frame_equal(restored.mean_data, quantifier.mean_data)
+        # Columns added or replaced on the DataFrame are kept
+        quantifier.conc_data["Ratio"] = quantifier.conc_data["Ala"] / quantifier.conc_data["Gly"]
+        quantifier.conc_data["Ala"] = 0.0
+        quantifier.conc_data.iloc[0, 1] = -1
+        expected = quantifier.conc_data.copy()
+        pd.testing.assert_frame_equal(pickle.loads(pickle.dumps(quantifier)).conc_data, expected)
+        assert list(quantifier.to_cube().coords["Metabolite"]) == list(expected.columns)
+
+    def test_dtypes(self, conc_data):
+        from nmrquant.engine.calculator import Quantifier
+        data = conc_data.reset_index(drop=True)
+        data.insert(0, "# Spectrum#", np.arange(1, len(data) + 1))
+        data["Flag"] = data["Ala"] > 10
+        data["Val"] = data["Val"].astype(np.float32)
+        cube = ResultsCube.from_frame(data)
+        pd.testing.assert_frame_equal(pickle.loads(pickle.dumps(cube)).to_frame(), data)
+        assert ResultsCube.from_frame(conc_data).dtypes is None
+        quantifier = Quantifier()
+        quantifier.data = data
+        restored = pickle.loads(pickle.dumps(quantifier))
+        pd.testing.assert_frame_equal(restored.data, data)
+        assert restored.data["# Spectrum#"].dtype == np.int64
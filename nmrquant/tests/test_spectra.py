@@ -0,0 +1,97 @@
+"""Test module for the NMRQuant spectrum integration"""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine import spectra
+from nmrquant.engine.spectra import Axis, integrate_spectra, read_procs, regions_from_db
+
+SIZE = 4096
+OFFSET, SW_P, SF = 10.0, 6000.0, 600.0  # 10 ppm sweep width
+
+
+def lorentzian(ppm, center, height, width=0.002):
+    return height / (1 + ((ppm - center) / width) ** 2)
+
+
+@pytest.fixture
+def database():
+    return pd.DataFrame({"Metabolite": ["Lactate", "Alanine", "Acetate"], "ppm": ["1,33", "1.48", np.nan],
+                         "Heq": [3, 3, 3], "width": [0.1, np.nan, np.nan]})
+
+
+@pytest.fixture
+def bruker_dataset(tmp_path):
+    ppm = OFFSET - np.arange(SIZE) * SW_P / SF / SIZE
+    for expno, height in [(10, 1e6), (11, 2e6)]:
+        pdata = tmp_path / str(expno) / "pdata" / "1"
+        pdata.mkdir(parents=True)
+        (pdata / "procs").write_text(f"##TITLE= Parameter file\n##$BYTORDP= 0\n##$DTYPP= 0\n##$NC_proc= 2\n"
+                                     f"##$OFFSET= {OFFSET}\n##$SF= {SF}\n##$SI= {SIZE}\n##$SW_p= {SW_P}\n"
+                                     f"##$AXNAME= <F1>\n##END=\n")
+        spectrum = lorentzian(ppm, 1.33, height) + lorentzian(ppm, 1.48, height / 2)
+        (spectrum / 4).astype("<i4").tofile(pdata / "1r")
+    return tmp_path, ppm
+
+
+class TestSpectra:
+
+    def test_axis(self):
+        axis = Axis.from_ppm(np.linspace(10, 0, 11))
+        assert axis == Axis(10, 1, 11)
+        start, stop = axis.bounds(np.array([2.5, -1]), np.array([4, 0.5]))
+        assert list(start) == [6, 10] and list(stop) == [8, 11]
+        increasing = Axis.from_ppm(np.linspace(0, 10, 11))
+        start, stop = increasing.bounds(np.array([2.5]), np.array([4]))
+        assert list(start) == [3] and list(stop) == [5]
+
+    def test_regions(self, database):
+        regions = regions_from_db(database)
+        assert list(regions.index) == ["Lactate", "Alanine"]
+        assert regions.loc["Lactate", "ppm_min"] == pytest.approx(1.28)
+        assert regions.loc["Alanine", "ppm_max"] == pytest.approx(1.49)
+
+    def test_bruker(self, bruker_dataset, database):
+        folder, ppm = bruker_dataset
+        assert read_procs(folder / "10" / "pdata" / "1" / "procs")["SI"] == SIZE
+        data = integrate_spectra(folder, regions_from_db(database, width=0.05), chunk_size=1)
+        assert list(data.columns) == ["# Spectrum#", "Lactate", "Alanine"]
+        assert list(data["# Spectrum#"]) == [10, 11]
+        # Areas double with the peak heights, and the ratio of the two peaks is close to 2
+        assert data.loc[1, "Lactate"] / data.loc[0, "Lactate"] == pytest.approx(2, rel=1e-3)
+        assert data.loc[0, "Lactate"] / data.loc[0, "Alanine"] == pytest.approx(2, rel=0.05)
+        # Areas are in intensity x ppm (Lorentzian area: pi * height * width)
+        assert data.loc[0, "Lactate"] == pytest.approx(np.pi * 1e6 * 0.002, rel=0.05)
+
+    @pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="open files are listed in /proc")
+    def test_open_files(self, bruker_dataset, database, monkeypatch):
+        folder, _ = bruker_dataset
+        for expno in range(12, 20):
+            shutil.copytree(folder / "10", folder / str(expno))
+        before = len(os.listdir("/proc/self/fd"))
+        opened, original = [], spectra.integrate
+
+        def integrate(*args):
+            opened.append(len(os.listdir("/proc/self/fd")) - before)
+            return original(*args)
+
+        monkeypatch.setattr(spectra, "integrate", integrate)
+        data = integrate_spectra(folder, regions_from_db(database), chunk_size=2)
+        assert len(data) == 10 and len(opened) == 5
+        # Only the spectra of the current chunk are mapped
+        assert max(opened) <= 2
+
+    def test_numpy(self, tmp_path, database):
+        ppm = np.linspace(10, 0, SIZE)
+        stack = np.stack([lorentzian(ppm, 1.33, h) for h in (1, 2, 3)])
+        np.save(tmp_path / "spectra.npy", stack)
+        data = integrate_spectra(tmp_path / "spectra.npy", regions_from_db(database), ppm=ppm, chunk_size=2,
+                                 spectrum_numbers=[5, 6, 7])
+        assert list(data["# Spectrum#"]) == [5, 6, 7]
+        assert np.allclose(data["Lactate"] / data.loc[0, "Lactate"], [1, 2, 3])
+        with pytest.raises(ValueError):
+            integrate_spectra(tmp_path / "spectra.npy", regions_from_db(database))
@@ -0,0 +1,49 @@
+"""Test module for the NMRQuant differential testing between conditions"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from nmrquant.engine.statistics import benjamini_hochberg, compare_conditions, condition_pairs
+
+
+@pytest.fixture
+def conc_data():
+    index = pd.MultiIndex.from_product([["Ctrl", "T1", "T2"], [0, 6], [1, 2, 3, 4]],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    rng = np.random.default_rng(3)
+    data = pd.DataFrame(rng.normal(10, 1, size=(len(index), 2)), index=index, columns=["Ala", "Lac"])
+    data.loc["T2", "Lac"] = data.loc["T2", "Lac"].to_numpy() + 5
+    # T1 has no values at time point 6
+    return data.drop([("T1", 6, rep) for rep in range(1, 5)])
+
+
+class TestStatistics:
+
+    def test_benjamini_hochberg(self):
+        pvalues = np.array([0.01, 0.04, np.nan, 0.03, 0.5])
+        adjusted = benjamini_hochberg(pvalues)
+        assert np.allclose(adjusted[[0, 1, 3, 4]], [0.04, 0.0533333, 0.0533333, 0.5])
+        assert np.isnan(adjusted[2])
+
+    def test_pairs(self):
+        assert condition_pairs(["T2", "Ctrl", "T1", "T1"]) == [("Ctrl", "T1"), ("Ctrl", "T2"), ("T1", "T2")]
+        assert condition_pairs(["T2", "Ctrl", "T1"], control="Ctrl") == [("Ctrl", "T1"), ("Ctrl", "T2")]
+        with pytest.raises(KeyError):
+            condition_pairs(["T1"], control="Ctrl")
+
+    @pytest.mark.parametrize("test", ["welch", "mannwhitney"])
+    def test_against_scipy(self, conc_data, test):
+        table = compare_conditions(conc_data, test, control="Ctrl")
+        # Ctrl vs T1 at time 6 is skipped
+        assert len(table) == 6
+        ref, cond = conc_data.loc[("Ctrl", 6), "Lac"], conc_data.loc[("T2", 6), "Lac"]
+        if test == "welch":
+            expected = stats.ttest_ind(cond, ref, equal_var=False).pvalue
+        else:
+            expected = stats.mannwhitneyu(cond, ref, alternative="two-sided").pvalue
+        row = table.loc[("Ctrl", "T2", 6, "Lac")]
+        assert row["p_value"] == pytest.approx(expected)
+        assert row["difference"] > 4 and row["effect_size"] > 0
+        assert (table["p_adjusted"] >= table["p_value"] - 1e-12).all()
@@ -0,0 +1,51 @@
+"""Test module for the NMRQuant uncertainty estimation"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.uncertainty import confidence_intervals, nan_quantiles
+from nmrquant.engine.utilities import replicate_cube
+
+
+@pytest.fixture
+def conc_data():
+    index = pd.MultiIndex.from_product([["A", "B"], [0, 6], [1, 2, 3]],
+                                       names=["Conditions", "Time_Points", "Replicates"])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.normal(10, 1, size=(len(index), 3)), index=index, columns=["Ala", "Gly", "Lac"])
+    # Missing replicate and missing value
+    return data.drop(("B", 6, 3)).mask(lambda df: (df.index == ("A", 0, 2))[:, None] & (df.columns == "Gly"))
+
+
+class TestUncertainty:
+
+    def test_replicate_cube(self, conc_data):
+        cube, groups, columns = replicate_cube(conc_data)
+        assert cube.shape == (4, 3, 3)
+        assert list(groups) == [("A", 0), ("A", 6), ("B", 0), ("B", 6)]
+        assert np.isnan(cube[3, 2]).all()
+
+    def test_intervals(self, conc_data):
+        ci = confidence_intervals(conc_data, n_resamples=500, seed=42)
+        assert ci.shape == (12, 6)
+        expected = conc_data.groupby(["Conditions", "Time_Points"]).mean().stack()
+        assert np.allclose(ci["mean"].values, expected.values)
+        assert ci.loc[("A", 0, "Gly"), "n"] == 2 and ci.loc[("B", 6, "Ala"), "n"] == 2
+        assert (ci["ci_lower"] <= ci["mean"]).all() and (ci["mean"] <= ci["ci_upper"]).all()
+        pd.testing.assert_frame_equal(ci, confidence_intervals(conc_data, n_resamples=500, seed=42))
+
+    def test_montecarlo_propagation(self, conc_data):
+        fixed = confidence_intervals(conc_data, n_resamples=200, method="montecarlo", seed=1)
+        assert np.allclose(fixed["ci_lower"], fixed["mean"]) and np.allclose(fixed["ci_upper"], fixed["mean"])
+        propagated = confidence_intervals(conc_data, n_resamples=2000, method="montecarlo", strd_rsd=0.05, seed=1)
+        relative_se = (propagated["se"] / propagated["mean"]).values
+        assert np.allclose(relative_se, 0.05, atol=0.01)
+
+    def test_nan_quantiles(self):
+        values = np.random.default_rng(0).random((100, 4))
+        values[:30, 1] = np.nan
+        values[:, 3] = np.nan
+        expected = np.nanquantile(values[:, :3], [0.1, 0.9], axis=0)
+        result = nan_quantiles(values, [0.1, 0.9])
+        assert np.allclose(result[:, :3], expected) and np.isnan(result[:, 3]).all()
@@ -0,0 +1,30 @@
+"""Test module for the NMRQuant metadata encoding"""
+
+import numpy as np
+import pandas as pd
+
+from nmrquant.engine.utilities import natural_categorical, is_naturally_ordered
+
+
+class TestMetadataEncoding:
+
+    def test_natural_categorical(self):
+        encoded = natural_categorical(pd.Series(["C10", "C2", "C1", "C2"]))
+        assert list(encoded.cat.categories) == ["C1", "C2", "C10"] and encoded.cat.ordered
+        numbers = pd.Series([10, 2])
+        assert natural_categorical(numbers) is numbers
+
+    def test_quantifier_levels(self):
+        from nmrquant.engine.calculator import Quantifier
+        from nmrquant.engine.visualizer import IndHistB
+        quantifier = Quantifier()
+        quantifier.metadata = pd.DataFrame({"# Spectrum#": range(1, 7), "Conditions": ["C10", "C2", "C1"] * 2,
+                                            "Time_Points": [0] * 6, "Replicates": [1, 1, 1, 2, 2, 2]})
+        quantifier.data = pd.DataFrame({"# Spectrum#": range(1, 7), "Ala": np.arange(6.0)})
+        quantifier._merge_md_data()
+        assert quantifier.conditions == ["C1", "C2", "C10"] and quantifier.replicates == [1, 2]
+        assert is_naturally_ordered(quantifier.mdata.index)
+        means = quantifier.mdata.groupby(["Conditions", "Time_Points"], observed=True).mean()
+        assert list(means.index.get_level_values("Conditions")) == ["C1", "C2", "C10"]
+        plot = IndHistB(quantifier.mdata, "Ala", False)
+        assert plot.x_labels == ["C1_1", "C1_2", "C2_1", "C2_2", "C10_1", "C10_2"]
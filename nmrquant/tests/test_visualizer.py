@@ -0,0 +1,41 @@
+"""Test module for the NMRQuant overview plots"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine.visualizer import Heatmap
+
+
+@pytest.fixture
+def data():
+    index = pd.MultiIndex.from_product([["A", "B"], [0], [1, 2]], names=["Conditions", "Time_Points", "Replicates"])
+    return pd.DataFrame({"Lactate": [1.0, 1.1, 5.0, 5.2], "Acetate": [2.0, 2.1, 8.0, 8.1],
+                         "Ethanol": [3.0, 3.0, 3.0, 3.0], "Alanine": [np.nan, 0.5, 0.1, np.nan]}, index=index)
+
+
+class TestHeatmap:
+
+    def test_scale(self):
+        matrix = np.array([[1.0, 2.0, 3.0], [4.0, 4.0, 4.0], [np.nan, 0.0, 2.0]])
+        zscore = Heatmap.scale(matrix, "zscore")
+        assert zscore[0] == pytest.approx([-1.2247449, 0, 1.2247449])
+        assert (zscore[1] == 0).all()
+        assert np.isnan(zscore[2, 0])
+        assert Heatmap.scale(matrix, "minmax")[0] == pytest.approx([0, 0.5, 1])
+
+    def test_clustering(self, data):
+        heatmap = Heatmap(data)
+        assert heatmap.values.shape == (4, 4)
+        # Replicates of the same condition are neighbours
+        assert {tuple(sorted(heatmap.col_order[:2])), tuple(sorted(heatmap.col_order[2:]))} == {(0, 1), (2, 3)}
+        assert heatmap.samples[0] == "A / 0 / 1"
+        heatmap()
+        unclustered = Heatmap(data, cluster=False, scaling="log")
+        assert list(unclustered.row_order) == [0, 1, 2, 3]
+        assert unclustered.row_linkage is None
+        unclustered()
+
+    def test_unknown_scaling(self, data):
+        with pytest.raises(ValueError):
+            Heatmap(data, scaling="rank")
@@ -0,0 +1,46 @@
+"""Test module for the NMRQuant streaming workbook reader"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nmrquant.engine import workbook as workbook_module
+from nmrquant.engine.utilities import read_data
+from nmrquant.engine.workbook import read_workbook
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    path = tmp_path / "experiments.xlsx"
+    first = pd.DataFrame({"# Spectrum#": [1, 2, 3], "Strd": [1, 1, 1], "Lactate": [0.5, np.nan, 2.0],
+                          "Sample": ["a", None, "c"]})
+    second = pd.DataFrame({"# Spectrum#": [1, 2], "Strd": [9, 9], "Glucose": [1.5, 3.0]})
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        first.to_excel(writer, sheet_name="Exp1", index=False)
+        second.to_excel(writer, sheet_name="Exp2", index=False)
+    return path
+
+
+class TestWorkbook:
+
+    def test_same_as_pandas(self, workbook):
+        sheets = read_workbook(workbook)
+        assert list(sheets) == ["Exp1", "Exp2"]
+        for name, data in pd.read_excel(workbook, sheet_name=None, engine="openpyxl").items():
+            pd.testing.assert_frame_equal(sheets[name], data)
+
+    def test_blocks(self, tmp_path, monkeypatch):
+        # Column types of the blocks differ: ints, then a missing value, then text
+        path = tmp_path / "blocks.xlsx"
+        pd.DataFrame({"# Spectrum#": range(1, 8), "Lactate": [1, 2, 3, np.nan, 5, 6, 7],
+                      "Sample": [1, 2, None, None, "e", "f", 7], "Empty": [None] * 3 + [1.5] + [None] * 3}).to_excel(
+            path, index=False)
+        monkeypatch.setattr(workbook_module, "BLOCK_SIZE", 3)
+        pd.testing.assert_frame_equal(read_workbook(path)["Sheet1"], pd.read_excel(path, engine="openpyxl"))
+
+    def test_sheet_selection(self, workbook):
+        assert list(read_workbook(workbook, [1, "Exp1"])) == ["Exp2", "Exp1"]
+        assert read_data(workbook, "Exp2")["Glucose"].tolist() == [1.5, 3.0]
+        assert set(read_data(workbook, None)) == {"Exp1", "Exp2"}
+        with pytest.raises(KeyError):
+            read_workbook(workbook, "Exp3")
@@ -3,7 +3,12 @@ import os
 from pathlib import Path
 import sys
 
+import nmrquant.logger
+from nmrquant.engine.archive import reprocess
 from nmrquant.engine.calculator import Quantifier
+from nmrquant.engine.checkpoints import CheckpointStore, STAGES
+from nmrquant.engine.loader import load_quantifier
+from nmrquant.engine.render import save_plot
 from nmrquant.engine.visualizer import *
 
 
@@ -17,10 +22,26 @@ def parse_args():
         description="Software for 1D proton NMR quantification")
 
     parser.add_argument("datafile", type=str,
-                        help="Path to data file to process")
+                        help="Path to data file to process, or to processed spectra to integrate (Bruker dataset "
+                             "folder or .npy array)")
 
+    parser.add_argument("--sheet", type=str, default="0",
+                        help="Name or position (from 0) of the sheet to read when the datafile is an Excel workbook")
+    parser.add_argument("--ppm", type=str,
+                        help="Path to the .npy chemical shift axis, when the datafile is a .npy array of spectra")
+    parser.add_argument("--region_width", type=float, default=0.02,
+                        help="Width (in ppm) of the integration regions given by a single ppm position in the "
+                             "database, when integrating spectra")
+    parser.add_argument("--procno", type=int, default=1,
+                        help="Processing number of the Bruker spectra to integrate")
     parser.add_argument("-d", "--database", type=str,
                         help="Path to proton database")
+    parser.add_argument("--project_db", type=str,
+                        help="Path to a project proton database, whose entries replace those of the main database")
+    parser.add_argument("--user_db", type=str,
+                        help="Path to a user proton database, whose entries replace those of the other databases")
+    parser.add_argument("--aliases", type=str,
+                        help='Path to a table of aliases of database names ("Alias" and "Metabolite" columns)')
     parser.add_argument("-F", "--dilution_factor", type=float, default=1.11,
                         help="Dilution factor used to calculate concentrations")
     parser.add_argument("-t", "--template", type=str,
@@ -29,24 +50,127 @@ def parse_args():
                         help="Input path to export template to")
     parser.add_argument("-f", "--format", type=str, default="svg",
                         help="Choose a format for the plots. Choices: svg, png, jpeg")
+    parser.add_argument("--renderer", choices=["matplotlib", "direct"], default="matplotlib",
+                        help="Backend of the bar and line plots. 'direct' writes svg and png files directly, much "
+                             "faster on large studies (other formats are still drawn with matplotlib)")
 
     parser.add_argument('-b', '--barplot', choices=["individual", "meaned"], action="append",
                         type=str, help='Choose histogram to build. Enter "individual" or "meaned" ')
     parser.add_argument('-l', '--lineplot', choices=["individual", "meaned"], action="append",
                         type=str, help='Choose lineplot to build. Enter "individual" or "meaned" ')
 
+    parser.add_argument('--heatmap', choices=["samples", "means"], action="append", type=str,
+                        help='Build a heatmap of all the metabolites across the samples ("samples") or the means of '
+                             'each condition and time point ("means", needs -m)')
+    parser.add_argument('--heatmap_scaling', choices=["zscore", "minmax", "log", "none"], default="zscore",
+                        help='Scaling of the concentrations of each metabolite in the heatmaps')
+    parser.add_argument('--no_clustering', action='store_true', default=False,
+                        help='Keep the order of the data in the heatmaps instead of clustering metabolites and samples')
+
     parser.add_argument('-m', '--mean', action='store_true', default=False,
                         help='Add if means and stds should be calculated on replicates')
     parser.add_argument('-c', '--tsp_concentration', type=float,
                         help='Add tsp concentration if calibration is external')
 
+    parser.add_argument('-x', '--expressions', type=str,
+                        help='Path to a text file defining derived columns, one "target = expression" per line '
+                             '(ex: "Leucine = Isoleucine+Leucine - Isoleucine")')
+    parser.add_argument('--calibration_table', type=str,
+                        help='Path to a table giving the known concentration of each metabolite in the calibration '
+                             'spectra (overrides the "Calibration" column of the template)')
+    parser.add_argument('--calibration_model', choices=["linear", "proportional"], default="linear",
+                        help='Calibration curve model: linear (with intercept) or proportional (through the origin)')
+    parser.add_argument('--calibration_weighting', choices=["1/x", "1/x2"],
+                        help='Weighting of the calibration points (x being the known concentration)')
+
+    parser.add_argument('--outliers', choices=["mad", "grubbs", "dixon"],
+                        help='Screen replicates for outliers before means: robust z-scores (mad), Grubbs or Dixon '
+                             'test. The ranked outliers and the outlier mask are exported with the results')
+    parser.add_argument('--outlier_threshold', type=float, default=3.5,
+                        help='Robust z-score above which a replicate is an outlier (mad method). Groups of less '
+                             'than 6 replicates are screened with the Grubbs test instead')
+    parser.add_argument('--outlier_alpha', type=float, default=0.05,
+                        help='Significance level of the Grubbs and Dixon tests (and of the mad method for groups of '
+                             'less than 6 replicates)')
+    parser.add_argument('--mask_outliers', action='store_true', default=False,
+                        help='Leave outliers out of the means, plots and statistics')
+
+    parser.add_argument('--standard_column',
+                        help='Area column of the standard in the data, used for the QC of the run and by '
+                             '--normalize_strd (default: a TSP, TMSP, DSS or Standard column). The Strd column only '
+                             'flags the calibration')
+    parser.add_argument('--normalize_strd', action='store_true', default=False,
+                        help='Divide the areas of each spectrum by the area of its standard (see --standard_column) '
+                             'before calculating concentrations')
+    parser.add_argument('--qc_cv_limit', type=float, default=10.0,
+                        help='Maximum coefficient of variation (%%) of the standard areas for the run to pass the QC')
+    parser.add_argument('--qc_drift_limit', type=float, default=10.0,
+                        help='Maximum drift (%% of the mean) of the standard areas over the run for the run to pass '
+                             'the QC')
+    parser.add_argument('-u', '--uncertainty', type=int, metavar="N_RESAMPLES",
+                        help='Add to compute bootstrap confidence intervals of the replicate means with the given '
+                             'number of resamples')
+    parser.add_argument('--dilution_rsd', type=float, default=0.0,
+                        help='Relative standard deviation of the dilution factor, propagated to the confidence '
+                             'intervals (ex: 0.02 for 2%%)')
+    parser.add_argument('--strd_rsd', type=float, default=0.0,
+                        help='Relative standard deviation of the standard concentration, propagated to the '
+                             'confidence intervals')
+    parser.add_argument('--seed', type=int, help='Seed for reproducible confidence intervals')
+
+    parser.add_argument('-s', '--statistics', choices=["welch", "mannwhitney"],
+                        help='Compare conditions at each time point with a Welch t-test or a Mann-Whitney U test '
+                             '(Benjamini-Hochberg adjusted p-values are exported with the results)')
+    parser.add_argument('--control', type=str,
+                        help='Reference condition for the statistics. If not given, all pairs of conditions are '
+                             'compared')
+
+    parser.add_argument('-r', '--kinetics', action='store_true', default=False,
+                        help='Fit slopes, initial rates and exponential models on the time courses and export the '
+                             'rates')
+    parser.add_argument('--initial_points', type=int, default=3,
+                        help='Number of time points used to estimate initial rates')
+    parser.add_argument('--overlay', choices=["slope", "initial_rate", "exponential"],
+                        help='Overlay the fitted kinetic model on the lineplots (implies --kinetics)')
+
     parser.add_argument("-e", "--export", type=str, help="Name for exported file")
+    parser.add_argument("--cube", action="store_true", default=False,
+                        help="Also export the concentrations as a chunked condition x time x replicate x metabolite "
+                             "array (Zarr store)")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Add option for debug mode")
+    parser.add_argument("--log", action="store_true", default=False,
+                        help="Write the run log to a text file in the results folder")
+    parser.add_argument("--json_log", action="store_true", default=False,
+                        help="Write the run log to a json lines file in the results folder")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Reuse the checkpoints of a previous run in the same Results folder: only the stages "
+                             "whose inputs or parameters changed are executed")
+    parser.add_argument("--from-stage", dest="from_stage", choices=STAGES,
+                        help="Resume from the checkpoints and execute this stage and the following ones again")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="Record time and memory used by each stage and export the report as json")
 
     return parser
 
 
+def get_databases(args):
+    """
+    Paths of the proton databases given in the arguments
+
+    :param args: Arguments passed by the parser
+    :return: path of the database, or dict of precedence level to path if several databases are given
+    """
+
+    databases = {level: path for level, path in [("site", args.database), ("project", args.project_db),
+                                                   ("user", args.user_db)] if path}
+    for path in databases.values():
+        if not Path(path).exists():
+            raise TypeError(f"The path {Path(path).absolute()} does not exist")
+    databases = {level: fr"{Path(path).absolute()}" for level, path in databases.items()}
+    return databases["site"] if list(databases) == ["site"] else databases
+
+
 def process(args):
     """
     Command Line Interface process of nmrquant
@@ -55,33 +179,89 @@ def process(args):
     :return: Excel file export message
     """
 
-    cli_quant = Quantifier(verbose=args.verbose)
+    cli_quant = Quantifier(verbose=args.verbose, profile=args.profile)
     for i, arg in enumerate(sys.argv):
-        cli_quant.logger.debug(f"Argument {i} = {arg}")
+        cli_quant.logger.debug("Argument %s = %s", i, arg)
     home = Path(args.datafile).absolute()
     home = home.parent
     if not home.exists():
         raise TypeError("The input datafile path does not exist")
     destination = home / "Results"
-    destination.mkdir()
-    # Get data
-    try:
-        cli_quant.get_data(fr"{args.datafile}")
-    except Exception:
-        cli_quant.logger.exception("Error reading input data")
-    if hasattr(args, "k"):
-        cli_quant.generate_metadata(destination)
-    else:
+    destination.mkdir(exist_ok=True)
+    if args.log:
+        nmrquant.logger.add_file_sink(destination / "nmrquant.log")
+    if args.json_log:
+        nmrquant.logger.add_file_sink(destination / "nmrquant_log.jsonl", json_format=True)
+    if args.resume or args.from_stage:
+        cli_quant.logger.info("Resuming from the checkpoints of %s", destination / ".checkpoints")
+    cli_quant.checkpoints = CheckpointStore(destination / ".checkpoints", resume=args.resume,
+                                            from_stage=args.from_stage)
+
+    def ingest():
+        """Read the data, database, template and the optional input files"""
+
+        spectra = Path(args.datafile).is_dir() or Path(args.datafile).suffix == ".npy"
+        sheet = int(args.sheet) if args.sheet.isdigit() else args.sheet
+        if hasattr(args, "k"):
+            try:
+                if spectra:
+                    cli_quant.get_db(get_databases(args))
+                    cli_quant.integrate_spectra(fr"{args.datafile}", ppm=args.ppm, width=args.region_width,
+                                                procno=args.procno, strd=9 if args.tsp_concentration else 1)
+                else:
+                    cli_quant.get_data(fr"{args.datafile}", sheet)
+            except Exception:
+                cli_quant.logger.exception("Error reading input data")
+            return
         db_path, tp_path = Path(args.database).absolute(), Path(args.template).absolute()
         for path in [db_path, tp_path]:
             if not path.exists():
                 raise TypeError(f"The path {path} does not exist")
-        # Get database and template
+        # Data, database and template are read concurrently. Spectra are integrated afterwards, on the database
         try:
-            cli_quant.get_db(fr"{db_path}")
-            cli_quant.import_md(fr'{tp_path}')
+            load_quantifier(None if spectra else fr"{args.datafile}", get_databases(args), fr'{tp_path}',
+                            quantifier=cli_quant, excel_sheet=sheet)
+            if spectra:
+                cli_quant.integrate_spectra(fr"{args.datafile}", ppm=args.ppm, width=args.region_width,
+                                            procno=args.procno, strd=9 if args.tsp_concentration else 1)
         except Exception:
-            cli_quant.logger.exception("Error reading database or template file")
+            cli_quant.logger.exception("Error reading input files")
+        if args.aliases:
+            try:
+                cli_quant.set_aliases(fr"{Path(args.aliases).absolute()}")
+            except Exception:
+                cli_quant.logger.exception("Error reading aliases file")
+        if args.expressions:
+            try:
+                cli_quant.set_expressions(fr"{Path(args.expressions).absolute()}")
+            except Exception:
+                cli_quant.logger.exception("Error reading expressions file")
+        if args.calibration_table:
+            try:
+                cli_quant.import_calibration(fr"{Path(args.calibration_table).absolute()}")
+            except Exception:
+                cli_quant.logger.exception("Error reading calibration table")
+
+    # Input files are part of the checkpoint keys, so that modifying one of them invalidates the following stages
+    inputs = [Path(path) for path in [args.datafile, args.database, args.project_db, args.user_db, args.template,
+                                      args.aliases, args.expressions, args.calibration_table, args.ppm] if path]
+    cli_quant.run_stage("ingest", ingest, inputs, args.sheet, args.region_width, args.procno,
+                        bool(args.tsp_concentration))
+    # Attributes set below must not be overwritten by a restored state
+    cli_quant.restore_checkpoint()
+    if hasattr(args, "k"):
+        cli_quant.generate_metadata(destination)
+    else:
+        cli_quant.outlier_method = args.outliers
+        cli_quant.outlier_threshold = args.outlier_threshold
+        cli_quant.outlier_alpha = args.outlier_alpha
+        cli_quant.mask_outliers = args.mask_outliers
+        cli_quant.calibration_model = args.calibration_model
+        cli_quant.calibration_weighting = args.calibration_weighting
+        cli_quant.normalize_strd = args.normalize_strd
+        cli_quant.standard_column = args.standard_column
+        cli_quant.qc_cv_limit = args.qc_cv_limit
+        cli_quant.qc_drift_limit = args.qc_drift_limit
         # Process data
         if cli_quant.use_strd:
             try:
@@ -96,6 +276,30 @@ def process(args):
                 cli_quant.compute_data(1, mean=args.mean)
             except Exception:
                 cli_quant.logger.exception("Unknown error while calculating concentrations")
+        if args.uncertainty:
+            try:
+                cli_quant.run_stage("uncertainty", lambda: cli_quant.compute_uncertainty(
+                    args.uncertainty, dilution_rsd=args.dilution_rsd, strd_rsd=args.strd_rsd, seed=args.seed),
+                                    args.uncertainty, args.dilution_rsd, args.strd_rsd, args.seed)
+            except Exception:
+                cli_quant.logger.exception("Unknown error while estimating uncertainty")
+        if args.statistics:
+            try:
+                cli_quant.run_stage("statistics", lambda: cli_quant.compare_conditions(
+                    args.statistics, control=args.control), args.statistics, args.control)
+            except Exception:
+                cli_quant.logger.exception("Unknown error while comparing conditions")
+        if args.kinetics or args.overlay:
+            try:
+                cli_quant.run_stage("kinetics", lambda: cli_quant.compute_kinetics(args.initial_points),
+                                    args.initial_points)
+            except Exception:
+                cli_quant.logger.exception("Unknown error while estimating kinetic rates")
+        cli_quant.restore_checkpoint()
+        if args.overlay and cli_quant.kinetics_data is not None:
+            fits = {"replicates": cli_quant.kinetics_data, "conditions": cli_quant.condition_kinetics}
+        else:
+            fits = {"replicates": None, "conditions": None}
         # Get name for exported excel file
         if args.export:
             if not isinstance(args.export, str):
@@ -104,13 +308,39 @@ def process(args):
         else:
             file_name = "Results"
         os.chdir(destination)
-        cli_quant.export_data(file_name=file_name,
-                              destination=destination,
-                              export_mean=args.mean)
-        cli_quant.logger.debug(f"Barplot args are: {args.barplot}")
-        times = cli_quant.conc_data.index.get_level_values("Time_Points").unique()
-        replicates = cli_quant.conc_data.index.get_level_values("Replicates").unique()
+        cli_quant.run_stage("export", lambda: cli_quant.export_data(file_name=file_name, destination=destination,
+                                                                    export_mean=args.mean),
+                            file_name, args.mean, files=lambda path: [path])
+        if args.cube:
+            cli_quant.run_stage("export_cube", lambda: cli_quant.export_cube(destination=destination,
+                                                                             file_name=file_name),
+                                file_name, files=lambda path: [path])
+        if cli_quant.qc_data is not None:
+            qc_plot = destination / f"Standard_QC.{args.format}"
+            cli_quant.run_stage("plot_qc", lambda: StandardQCPlot(cli_quant.qc_data, cli_quant.qc_summary)().savefig(
+                qc_plot, format=args.format, bbox_inches="tight"), args.format, files=lambda _: [qc_plot], chain=False)
+        cli_quant.logger.debug("Barplot args are: %s", args.barplot)
+        times = cli_quant.time_points
+        replicates = cli_quant.replicates
         display = False
+
+        def plot_stage(name, folder, plot_metabolites):
+            """Plot all the metabolites in a folder, as a stage that is skipped if the plots already exist"""
+
+            def stage():
+                folder.mkdir(exist_ok=True)
+                os.chdir(folder)
+                with cli_quant.profiler.stage(name) as record:
+                    for metabolite in cli_quant.metabolites:
+                        cli_quant.logger.info("Plotting %s", metabolite)
+                        plot_metabolites(metabolite)
+                    record.set_shape(cli_quant.conc_data)
+
+            # Plots do not modify the data, so each plot kind only depends on the stages before the export
+            cli_quant.run_stage(name, stage, args.format, args.overlay, args.renderer,
+                                files=lambda _: sorted(folder.iterdir()), chain=False)
+            os.chdir(destination)
+
         if args.barplot:
             if "individual" in args.barplot:
                 if len(times) > 1:
@@ -118,17 +348,16 @@ def process(args):
                         "Too many time points for individual histograms. Please generate line plots instead")
                 else:
                     cli_quant.logger.info("Trying to build individual histograms...")
-                    ind_bp = destination / 'Histograms_Individual'
-                    ind_bp.mkdir()
-                    os.chdir(ind_bp)
-                    for metabolite in cli_quant.metabolites:
-                        cli_quant.logger.info(f"Plotting {metabolite}")
+
+                    def individual_histogram(metabolite):
                         if len(replicates) > 1:
                             plot = IndHistB(cli_quant.conc_data, metabolite, display)
                         else:
                             plot = IndHistA(cli_quant.conc_data, metabolite, display)
-                        fig = plot()
-                        fig.savefig(f"{metabolite}.{args.format}", format=args.format)
+                        save_plot(plot, args.format, renderer=args.renderer)
+
+                    plot_stage("plot_individual_histograms", destination / 'Histograms_Individual',
+                               individual_histogram)
                     cli_quant.logger.info("Individual histograms have been generated")
                 os.chdir(destination)
             if "meaned" in args.barplot:
@@ -140,14 +369,12 @@ def process(args):
                     cli_quant.logger.error("Means and SD data missing. Please add 'export mean' argument to generate "
                                            "required data")
                 else:
-                    meaned_bp = destination / 'Histograms_Meaned'
-                    meaned_bp.mkdir()
-                    os.chdir(meaned_bp)
-                    for metabolite in cli_quant.metabolites:
-                        cli_quant.logger.info(f"Plotting {metabolite}")
+
+                    def meaned_histogram(metabolite):
                         plot = MultHistB(cli_quant.mean_data, cli_quant.std_data, metabolite, display)
-                        fig = plot()
-                        fig.savefig(f"{metabolite}.{args.format}", format=args.format)
+                        save_plot(plot, args.format, renderer=args.renderer)
+
+                    plot_stage("plot_meaned_histograms", destination / 'Histograms_Meaned', meaned_histogram)
                     cli_quant.logger.info("Meaned histograms have been generated")
                 os.chdir(destination)
         if args.lineplot:
@@ -157,21 +384,19 @@ def process(args):
                     cli_quant.logger.error("Not enough time points to generate kinetic plots. Please select a "
                                            "histogram representation instead")
                 else:
-                    ind_lp = destination / "Lineplots_Individual"
-                    ind_lp.mkdir()
-                    os.chdir(ind_lp)
-                for metabolite in cli_quant.metabolites:
-                    cli_quant.logger.info(f"Plotting {metabolite}")
-                    if (len(replicates) == 1) or "Replicates" not in cli_quant.conc_data.index.names:
-                        plot = NoRepIndLine(cli_quant.conc_data, metabolite, display)
-                        fig = plot()
-                        fig.savefig(f"{metabolite}.{args.format}", format=args.format)
-                    else:
-                        plot = IndLine(cli_quant.conc_data, metabolite, display)
-                        figures = plot()
-                        for (fname, fig) in figures:
-                            fig.savefig(f"{fname}.{args.format}", format=args.format)
-                cli_quant.logger.info("Individual lineplots have been generated")
+
+                    def individual_lineplot(metabolite):
+                        if (len(replicates) == 1) or "Replicates" not in cli_quant.conc_data.index.names:
+                            plot = NoRepIndLine(cli_quant.conc_data, metabolite, display, fits["conditions"],
+                                                args.overlay)
+                        else:
+                            plot = IndLine(cli_quant.conc_data, metabolite, display, fits["replicates"],
+                                           args.overlay)
+                        save_plot(plot, args.format, renderer=args.renderer)
+
+                    plot_stage("plot_individual_lineplots", destination / "Lineplots_Individual",
+                               individual_lineplot)
+                    cli_quant.logger.info("Individual lineplots have been generated")
             os.chdir(destination)
             if "meaned" in args.lineplot:
                 cli_quant.logger.info("Trying to build summary lineplots...")
@@ -179,24 +404,96 @@ def process(args):
                     cli_quant.logger.error("Not enough time points to generate kinetic plots. Please select a "
                                            "histogram representation instead")
                 else:
-                    meaned_lp = destination / "Lineplots_Meaned"
-                    meaned_lp.mkdir()
-                    os.chdir(meaned_lp)
                     if len(replicates) == 1 or "Replicates" not in cli_quant.conc_data.index.names:
                         cli_quant.logger.warning(
                             "No replicates detected. Plots will still be generated but to remove the pointless"
                             "error bars, select individual lineplots instead")
-                    for metabolite in cli_quant.metabolites:
-                        cli_quant.logger.info(f"Plotting {metabolite}")
-                        plot = MeanLine(cli_quant.conc_data, metabolite, display)
-                        fig = plot()
-                        fig.savefig(f"{metabolite}.{args.format}", format=args.format)
+
+                    def meaned_lineplot(metabolite):
+                        plot = MeanLine(cli_quant.conc_data, metabolite, display, fits["conditions"],
+                                        args.overlay)
+                        save_plot(plot, args.format, renderer=args.renderer)
+
+                    plot_stage("plot_meaned_lineplots", destination / "Lineplots_Meaned", meaned_lineplot)
                     cli_quant.logger.info("Meaned lineplots have been generated")
             os.chdir(destination)
+        if args.heatmap:
+
+            def heatmaps():
+                for kind in args.heatmap:
+                    data = cli_quant.conc_data if kind == "samples" else cli_quant.mean_data
+                    if data is None:
+                        cli_quant.logger.error("Means missing for the heatmap. Please add 'export mean' argument to "
+                                               "generate required data")
+                        continue
+                    cli_quant.logger.info("Building the heatmap of the %s...", kind)
+                    fig = Heatmap(data, args.heatmap_scaling, not args.no_clustering)()
+                    fig.savefig(destination / f"Heatmap_{kind}.{args.format}", format=args.format,
+                                bbox_inches="tight")
+
+            cli_quant.run_stage("plot_heatmaps", heatmaps, args.heatmap, args.heatmap_scaling, args.no_clustering,
+                                args.format, files=lambda _: sorted(destination.glob("Heatmap_*")), chain=False)
+        if args.profile:
+            cli_quant.export_profile(destination, file_name)
         cli_quant.logger.info(f"Finished. Check {destination} for results")
 
 
 def start_cli():
     parser = parse_args()
     args = parser.parse_args()
-    process(args)
+    try:
+        process(args)
+    finally:
+        # The log files are closed even if the run fails
+        nmrquant.logger.close_sinks()
+
+
+def parse_reprocess_args():
+    """
+    Get user arguments for the reprocessing of an archive of experiments
+
+    :return: class: 'Argument Parser'
+    """
+    parser = argparse.ArgumentParser(
+        description="Quantify again all the experiments of an archive, in parallel and resumably")
+
+    parser.add_argument("archive", type=str,
+                        help="Root folder of the archive (one folder per experiment with a template and a data file), "
+                             "or table of experiments with 'Data' and 'Template' columns")
+    parser.add_argument("-d", "--database", type=str, required=True,
+                        help="Path to proton database")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="Work folder of the reprocessing (queue, results and manifest). Machines sharing this "
+                             "folder share the work")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="Number of worker processes (number of CPUs by default)")
+    parser.add_argument("--shard", type=str,
+                        help="Only process one shard of the experiments, given as index/count (ex: 0/4)")
+    parser.add_argument("-F", "--dilution_factor", type=float, default=1.11,
+                        help="Dilution factor used to calculate concentrations")
+    parser.add_argument("-c", "--tsp_concentration", type=float, default=1,
+                        help="Tsp concentration, for the experiments with external calibration")
+    parser.add_argument("-m", "--mean", action="store_true", default=False,
+                        help="Add if means and stds should be calculated on replicates")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Add option for debug mode")
+
+    return parser
+
+
+def start_reprocess():
+    parser = parse_reprocess_args()
+    args = parser.parse_args()
+    shard = None
+    if args.shard:
+        try:
+            shard = tuple(int(value) for value in args.shard.split("/"))
+            if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+                raise ValueError
+        except ValueError:
+            parser.error(f"Invalid shard '{args.shard}', expected index/count with 0 <= index < count")
+    nmrquant.logger.setup_handler(args.verbose)
+    manifest = reprocess(args.archive, str(Path(args.database).absolute()), args.output, workers=args.workers,
+                         shard=shard, options={"strd_conc": args.tsp_concentration, "mean": args.mean,
+                                               "dilution_factor": args.dilution_factor})
+    print(manifest["status"].value_counts().to_string())
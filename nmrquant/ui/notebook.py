@@ -1,41 +1,51 @@
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import ipywidgets as widgets
-from IPython.display import display
+import matplotlib.pyplot as plt
+from IPython.display import display, Image, SVG
 from ipyfilechooser import FileChooser
 
+import nmrquant.logger
 from nmrquant.engine.calculator import Quantifier
+from nmrquant.engine.explorer import PlotExplorer
+from nmrquant.engine.loader import load_quantifier, read_input
+from nmrquant.engine.render import PYPLOT_LOCK, save_plot
 from nmrquant.engine.visualizer import *
 
 mod_logger = logging.getLogger("RMNQ_logger.ui.notebook")
 
 
+def _file_key(path):
+    """Identity of a file version (a prefetched file modified afterwards is read again)"""
+
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return str(path), stat.st_size, stat.st_mtime_ns
+
+
+class JobCancelled(Exception):
+    """Raised inside a background job when the user clicks the cancel button"""
+
+
 class Rnb:
     """Class to control RMNQ notebook interface"""
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, profile=False):
 
-        self.quantifier = Quantifier(verbose)
+        self.quantifier = Quantifier(verbose, profile)
 
         self.home = None
         self.run_dir = None
 
-        # Initialize child logger for class instances
+        # Initialize child logger for class instances (the console handler is set up once on the base logger)
         self.logger = logging.getLogger("RMNQ_logger.ui.notebook.Rnb")
-        self.logger.setLevel(logging.DEBUG)
-        # fh = logging.FileHandler(f"{self.run_name}.log")
-        handler = logging.StreamHandler()
-        if verbose:
-            handler.setLevel(logging.DEBUG)
-        else:
-            handler.setLevel(logging.INFO)
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
-        handler.setFormatter(formatter)
-        if not self.logger.hasHandlers():
-            self.logger.addHandler(handler)
+        nmrquant.logger.setup_handler(verbose)
 
         widgetstyle = {'description_width': 'initial'}
 
@@ -49,6 +59,15 @@ class Rnb:
         self.upload_template_btn = FileChooser(os.getcwd())
         self.upload_template_btn.title = "Select Template"
 
+        # Selected files are parsed in the background as soon as they are chosen, with a ready indicator per file
+        self._choosers = [self.upload_datafile_btn, self.upload_database_btn, self.upload_template_btn]
+        self.file_status = {chooser: widgets.Label(value='') for chooser in self._choosers}
+        self._prefetched = {}
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=len(self._choosers),
+                                                 thread_name_prefix="nmrquant_prefetch")
+        for chooser in self._choosers:
+            chooser.register_callback(self._prefetch)
+
         self.strd_btn = widgets.Text(value='', description='Strd concentration:', disabled=True,
                                      style=widgetstyle)
 
@@ -77,6 +96,13 @@ class Rnb:
         self.export_mean_checkbox = widgets.Checkbox(value=False, description="Mean export",
                                                      disabled=True, style=widgetstyle)
 
+        self.normalize_strd_checkbox = widgets.Checkbox(value=False, description="Normalize areas to standard",
+                                                        disabled=True, style=widgetstyle)
+
+        # Area column of the standard (empty: TSP, TMSP, DSS or Standard column of the data)
+        self.standard_column_text = widgets.Text(value='', description='Standard column:', disabled=True,
+                                                 style=widgetstyle)
+
         self.format_chooser = widgets.Dropdown(
             options=['png', 'svg', 'jpeg'],
             value='svg',
@@ -85,86 +111,186 @@ class Rnb:
             style=widgetstyle
         )
 
+        self.direct_render_checkbox = widgets.Checkbox(value=False, description="Fast rendering (svg and png)",
+                                                       disabled=True, style=widgetstyle)
+
         self.plot_choice_dropdown = widgets.SelectMultiple(options=["individual_histogram",
                                                                     "meaned_histogram",
                                                                     "individual_lineplot",
-                                                                    "summary_lineplot"],
+                                                                    "summary_lineplot",
+                                                                    "heatmap",
+                                                                    "meaned_heatmap"],
                                                            value=("individual_histogram", "individual_histogram"),
                                                            description="Choose plot(s) to create",
                                                            disabled=True, style=widgetstyle)
 
-    def reset(self, verbose):
+        # Background jobs: progress bars, cancel button and output widget where figures appear as they are saved
+        self.stage_progress = widgets.IntProgress(value=0, min=0, max=1, description='Stages',
+                                                  style=widgetstyle)
+        self.metabolite_progress = widgets.IntProgress(value=0, min=0, max=1, description='Metabolites',
+                                                       style=widgetstyle)
+        self.status_label = widgets.Label(value='')
+        self.cancel_btn = widgets.Button(description='Cancel', disabled=True, button_style='warning',
+                                         tooltip='Click to cancel the running job', icon='', style=widgetstyle)
+        self.figure_output = widgets.Output()
+
+        # Plot explorer: the plot of the picked metabolite, plot kind and conditions is rendered when it is picked
+        # (and cached), and the viewed plots can be exported afterwards
+        self.explorer = None
+        self._explorer_ready = False
+        self.explore_metabolite = widgets.Dropdown(options=[], description='Metabolite', disabled=True,
+                                                   style=widgetstyle)
+        self.explore_kind = widgets.Dropdown(options=[], description='Plot', disabled=True, style=widgetstyle)
+        self.explore_conditions = widgets.SelectMultiple(options=[], description='Conditions', disabled=True,
+                                                         style=widgetstyle)
+        self.explore_status = widgets.Label(value='')
+        self.export_viewed_btn = widgets.Button(description='Export viewed plots', disabled=True, button_style='',
+                                                tooltip='Click to save the plots viewed in the explorer',
+                                                icon='', style=widgetstyle)
+        self.explore_output = widgets.Output()
+
+        self._action_buttons = [self.submit_btn, self.calculate_btn, self.plots_btn, self.generate_metadata_btn]
+        self._button_states = {}
+        self._cancel_event = threading.Event()
+        self._job = None
+
+    def reset(self, verbose, profile=False):
         """Function to reset the object in notebook
         (only for notebook use because otherwise cell refresh
         doesn't reinitialize the object)"""
         if self.home is not None:
             os.chdir(self.home)
-        self.__init__(verbose)
+        self._prefetch_pool.shutdown(wait=False)
+        self.__init__(verbose, profile)
 
     # noinspection PyTypeChecker
     def make_gui(self):
         """Display the widgets and build the GUI"""
-        display(self.upload_datafile_btn,
-                self.upload_database_btn,
-                self.upload_template_btn,
+        display(*[widgets.HBox([chooser, self.file_status[chooser]]) for chooser in self._choosers],
                 self.submit_btn,
                 self.export_mean_checkbox,
+                self.normalize_strd_checkbox,
+                self.standard_column_text,
                 self.dilution_text,
                 self.strd_btn,
                 self.format_chooser,
+                self.direct_render_checkbox,
                 self.generate_metadata_btn,
                 self.calculate_btn,
                 self.plot_choice_dropdown,
-                self.plots_btn)
+                self.plots_btn,
+                self.stage_progress,
+                self.metabolite_progress,
+                self.status_label,
+                self.cancel_btn,
+                self.figure_output,
+                widgets.HBox([self.explore_metabolite, self.explore_kind]),
+                self.explore_conditions,
+                widgets.HBox([self.export_viewed_btn, self.explore_status]),
+                self.explore_output)
 
     def generate_template(self, event):
         """Generate template from input data spectrum count"""
 
-        datafile = self.upload_datafile_btn.selected
         if self.quantifier.data is None:
-            self.quantifier.get_data(datafile)
+            self.quantifier.get_data(read_input(self._selected_input(self.upload_datafile_btn), "data"))
         directory = self.upload_datafile_btn.selected_path
         self.quantifier.generate_metadata(directory)
         self.logger.info(
             "Template has been created. Check parent folder for template.xlsx")
 
+    def _prefetch(self, chooser):
+        """
+        FileChooser callback: parse the selected file in a background thread. The file status label shows when the
+        file is ready (or why it cannot be read), and the submit button picks up the parsed data.
+
+        :param chooser: FileChooser whose selection changed
+        """
+
+        key = _file_key(chooser.selected)
+        if key is None:
+            self._prefetched.pop(chooser, None)
+            self.file_status[chooser].value = ''
+            return
+        previous = self._prefetched.get(chooser)
+        if previous is not None and previous[0] == key:
+            return
+        self.file_status[chooser].value = "Reading..."
+        kind = {self.upload_datafile_btn: "data", self.upload_database_btn: "database",
+                self.upload_template_btn: "template"}[chooser]
+        future = self._prefetch_pool.submit(read_input, key[0], kind)
+        self._prefetched[chooser] = (key, future)
+        future.add_done_callback(lambda done: self._show_file_status(chooser, key, done))
+
+    def _show_file_status(self, chooser, key, future):
+        """Update the ready indicator of a file when its prefetch ends"""
+
+        current = self._prefetched.get(chooser)
+        # The selection changed while the file was read
+        if current is None or current[0] != key or future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self.file_status[chooser].value = f"Error: {error}"
+            mod_logger.debug("Prefetch of %s failed: %s", key[0], error)
+        else:
+            rows, columns = future.result().shape
+            self.file_status[chooser].value = f"Ready ({rows} rows, {columns} columns)"
+
+    def _selected_input(self, chooser):
+        """
+        Input of a file chooser for the loader: the Future of the prefetched DataFrame if the file did not change
+        since its selection, else the path (read again)
+        """
+
+        path = chooser.selected
+        entry = self._prefetched.get(chooser)
+        if entry is None or entry[0] != _file_key(path):
+            return path
+        return entry[1]
+
     def _submit_button_click(self, event):
-        """Submit button function that enables the rest of the widgets and finishes preparation of the different
-        input files."""
+        """Submit button function that finishes preparation of the different input files and enables the rest of
+        the widgets."""
+
+        self.home = Path(self.upload_datafile_btn.selected_path)
+
+        # Inputs are read concurrently (or picked up from the prefetch). The data may already have been loaded to
+        # generate the template
+        self.logger.debug("Initializing datafile, database and template")
+        data = self._selected_input(self.upload_datafile_btn) if self.quantifier.data is None else None
+        try:
+            load_quantifier(data, self._selected_input(self.upload_database_btn),
+                            self._selected_input(self.upload_template_btn), quantifier=self.quantifier)
+        except (ValueError, TypeError) as err:
+            return self.logger.error(str(err))
 
         # Enable all the other widgets
         self.export_mean_checkbox.disabled = False
+        self.normalize_strd_checkbox.disabled = False
+        self.standard_column_text.disabled = False
         self.dilution_text.disabled = False
         self.calculate_btn.disabled = False
         self.plot_choice_dropdown.disabled = False
         self.plots_btn.disabled = False
         self.format_chooser.disabled = False
+        self.direct_render_checkbox.disabled = False
         self.generate_metadata_btn.disabled = False
 
-        self.home = Path(self.upload_datafile_btn.selected_path)
-
-        self.logger.debug("Initializing datafile")
-
-        # Check if quantifier contains the data. If not, load it in from upload datafile button
-        if self.quantifier.data is None:
-            self.quantifier.get_data(self.upload_datafile_btn.selected)
-
         # Check if standard should be used to calculate concentrations (internal or external calibration)
         if self.quantifier.use_strd:
             self.logger.info("External calibration detected. Please enter the concentration of standard")
             self.strd_btn.disabled = False
 
-        # Finish initalizing data variables and data files
-        self.logger.debug("Initializing database")
-        self.quantifier.get_db(self.upload_database_btn.selected)
-
-        self.logger.debug("Initializing template")
-        self.quantifier.import_md(self.upload_template_btn.selected)
-
         return self.logger.info('Data variables initialized')
 
     def process_data(self, event):
-        """Make destination folder, clean data and calculate results"""
+        """Make destination folder, clean data and calculate results (in the background)"""
+
+        self._run_in_background(self._process_data, "Calculation")
+
+    def _process_data(self):
+        """Computation job run by process_data"""
 
         # Make target directory
         self.run_dir = self.home / "Results"
@@ -174,128 +300,284 @@ class Rnb:
         # Get dilution factor and prepare data for calculations
         self.logger.info("Computing data")
         self.quantifier.dilution_factor = float(self.dilution_text.value)
+        self.quantifier.normalize_strd = self.normalize_strd_checkbox.value
+        self.quantifier.standard_column = self.standard_column_text.value.strip() or None
+
+        def progress(stage, index, count):
+            # The export is counted as the last stage
+            self._check_cancel()
+            self._update_progress(self.stage_progress, index, count + 1, f"Computing: {stage}")
 
         # Check type of calibration and if Strd concentration should be used
         if self.quantifier.use_strd:
             try:
-                self.quantifier.compute_data(float(self.strd_btn.value), self.export_mean_checkbox.value)
+                strd_conc = float(self.strd_btn.value)
             except ValueError:
-                self.logger.error("Standard concentration must be a number")
+                return self.logger.error("Standard concentration must be a number")
         else:
-            self.quantifier.compute_data(1, self.export_mean_checkbox.value)
+            strd_conc = 1
+        self.quantifier.compute_data(strd_conc, self.export_mean_checkbox.value, progress=progress)
+        self._check_cancel()
+        self._update_progress(self.stage_progress, self.stage_progress.max - 1, self.stage_progress.max,
+                              "Exporting")
         self.quantifier.export_data(self.run_dir, "Results",
                                     export_mean=self.export_mean_checkbox.value)
+        self._update_progress(self.stage_progress, self.stage_progress.max, self.stage_progress.max, "Exported")
+        # The control chart of the standard shows at once if the run must be checked
+        if self.quantifier.qc_data is not None:
+            self.fmt = self.format_chooser.value
+            path = self.run_dir / f"Standard_QC.{self.fmt}"
+            with PYPLOT_LOCK:
+                fig = StandardQCPlot(self.quantifier.qc_data, self.quantifier.qc_summary, self.display)()
+                fig.savefig(path, format=self.fmt, bbox_inches='tight')
+                plt.close(fig)
+            self.figure_output.clear_output()
+            self._stream_figure(path)
+        if self.quantifier.profiler.enabled:
+            self.quantifier.export_profile(self.run_dir, "Results")
+        self._setup_explorer()
 
     def build_plots(self, event):
-        """Control plot creation. Make destination folders and generate plots."""
+        """Control plot creation. Make destination folders and generate plots (in the background)."""
+
+        self._run_in_background(self._build_plots, "Plotting")
+
+    def _build_plots(self):
+        """Plotting job run by build_plots"""
 
         self.fmt = self.format_chooser.value
-        times = self.quantifier.conc_data.index.get_level_values("Time_Points").unique()
-        replicates = self.quantifier.conc_data.index.get_level_values("Replicates").unique()
-        # conditions = self.quantifier.conc_data.index.get_level_values("Conditions").unique()
+        conc_data = self.quantifier.conc_data
+        times = self.quantifier.time_points
+        replicates = self.quantifier.replicates
+        no_replicates = len(replicates) == 1 or "Replicates" not in conc_data.index.names
+        # Each selected plot kind is registered with its folder, profiling stage name and a factory returning the
+        # plot object of one metabolite
+        plot_kinds = []
 
         if "individual_histogram" in self.plot_choice_dropdown.value:
             if len(times) > 1:
                 self.logger.error("Too many time points for individual histograms. Please generate line plots instead")
             else:
-                self.logger.info("Building Individual Histograms...")
-                indhist = self.run_dir / 'Histograms_Individual'
-                if not indhist.is_dir():
-                    indhist.mkdir()
-
-                for metabolite in self.quantifier.metabolites:
-                    try:
-                        if len(replicates) > 1:
-                            plot = IndHistB(self.quantifier.conc_data, metabolite, self.display)
-                        else:
-                            plot = IndHistA(self.quantifier.conc_data, metabolite, self.display)
-                        fig = plot()
-                        fig.savefig(fr"{str(indhist)}/{metabolite}.{self.fmt}", format=self.fmt, bbox_inches='tight')
-                    except Exception:
-                        self.logger.exception(
-                            f"Error while plotting {metabolite}"
-                        )
-                        continue
-                self.logger.info("Individual histograms have been generated")
+                hist_class = IndHistB if len(replicates) > 1 else IndHistA
+                plot_kinds.append(("Individual histograms", "Histograms_Individual", "plot_individual_histograms",
+                                   lambda met: hist_class(conc_data, met, self.display)))
 
         if "meaned_histogram" in self.plot_choice_dropdown.value:
-            self.logger.info("Building Meaned Histograms...")
             if len(times) > 1:
                 self.logger.error("Too many time points for individual histograms. Please generate line plots instead")
-            elif not hasattr(self.quantifier, "mean_data") or not hasattr(self.quantifier, "std_data"):
+            elif self.quantifier.mean_data is None or self.quantifier.std_data is None:
                 self.logger.error("Means and SD data missing. Please select 'export mean' option to generate required"
                                   "data")
             else:
-                meanhist = self.run_dir / 'Histograms_Meaned'
-                if not meanhist.is_dir():
-                    meanhist.mkdir()
-
-                for metabolite in self.quantifier.metabolites:
-                    try:
-                        plot = MultHistB(self.quantifier.mean_data, self.quantifier.std_data, metabolite, self.display)
-                        fig = plot()
-                        fig.savefig(rf"{str(meanhist)}/{metabolite}.{self.fmt}", format=self.fmt, bbox_inches='tight')
-                    except Exception:
-                        self.logger.exception(
-                            f"Error while plotting {metabolite}"
-                        )
-                        continue
-                self.logger.info("Meaned histograms have been generated")
+                plot_kinds.append(("Meaned histograms", "Histograms_Meaned", "plot_meaned_histograms",
+                                   lambda met: MultHistB(self.quantifier.mean_data, self.quantifier.std_data, met,
+                                                         self.display)))
 
         if "individual_lineplot" in self.plot_choice_dropdown.value:
-            self.logger.info("Building Individual Lineplots...")
             if len(times) == 1:
                 self.logger.error("Not enough time points to generate kinetic plots. Please select a histogram "
                                   "representation instead")
+            elif no_replicates:
+                plot_kinds.append(("Individual lineplots", "Lineplots_Individual", "plot_individual_lineplots",
+                                   lambda met: NoRepIndLine(conc_data, met, self.display)))
             else:
-                indline = self.run_dir / "Lineplots_Individual"
-                if not indline.is_dir():
-                    indline.mkdir()
-
-                for metabolite in self.quantifier.metabolites:
-                    try:
-                        if (len(replicates) == 1) or "Replicates" not in self.quantifier.conc_data.index.names:
-                            plot = NoRepIndLine(self.quantifier.conc_data, metabolite, self.display)
-                            fig = plot()
-                            fig.savefig(fr"{str(indline)}/{metabolite}.{self.fmt}", format=self.fmt, bbox_inches='tight')
-                        else:
-                            plot = IndLine(self.quantifier.conc_data, metabolite, self.display)
-                            figures = plot()
-                            for (fname, fig) in figures:
-                                fig.savefig(fr"{str(indline)}/{fname}.{self.fmt}", format=self.fmt, bbox_inches='tight')
-                    except Exception:
-                        self.logger.exception(
-                            f"Error while plotting {metabolite}"
-                        )
-                        continue
-                self.logger.info("Individual lineplots have been generated")
+                plot_kinds.append(("Individual lineplots", "Lineplots_Individual", "plot_individual_lineplots",
+                                   lambda met: IndLine(conc_data, met, self.display)))
 
         if "summary_lineplot" in self.plot_choice_dropdown.value:
-            self.logger.info("Building Summary Lineplots...")
             if len(times) == 1:
                 self.logger.error("Not enough time points to generate kinetic plots. Please select a histogram "
                                   "representation instead")
             else:
-
-                sumline = self.run_dir / "Lineplots_Summary"
-                if not sumline.is_dir():
-                    sumline.mkdir()
-
-                if len(replicates) == 1 or "Replicates" not in self.quantifier.conc_data.index.names:
+                if no_replicates:
                     self.logger.warning(
                         "No replicates detected. Plots will still be generated but to remove the useless"
                         "error bars, please select 'individual_lineplot' instead")
-                for metabolite in self.quantifier.metabolites:
-                    try:
-                        plot = MeanLine(self.quantifier.conc_data, metabolite, self.display)
-                        fig = plot()
-                        fig.savefig(fr"{str(sumline)}/{metabolite}.{self.fmt}", format=self.fmt, bbox_inches='tight')
-                    except Exception:
-                        self.logger.exception(
-                            f"Error while plotting {metabolite}"
-                        )
-                        continue
-                self.logger.info("Summary lineplots have been generated")
+                plot_kinds.append(("Summary lineplots", "Lineplots_Summary", "plot_summary_lineplots",
+                                   lambda met: MeanLine(conc_data, met, self.display)))
+
+        self.figure_output.clear_output()
+        # Heatmaps show all the metabolites in a single figure
+        heatmaps = [(kind, data) for kind, data in [("heatmap", conc_data),
+                                                    ("meaned_heatmap", self.quantifier.mean_data)]
+                    if kind in self.plot_choice_dropdown.value]
+        for kind, data in heatmaps:
+            self._check_cancel()
+            if data is None:
+                self.logger.error("Means data missing. Please select 'export mean' option to generate required data")
+                continue
+            with self.quantifier.profiler.stage(f"plot_{kind}") as record:
+                path = self.run_dir / f"{kind.capitalize()}.{self.fmt}"
+                with PYPLOT_LOCK:
+                    fig = Heatmap(data, display=self.display)()
+                    fig.savefig(path, format=self.fmt, bbox_inches='tight')
+                    plt.close(fig)
+                self._stream_figure(path)
+                record.set_shape(data)
+            self.logger.info("%s has been generated", kind.capitalize().replace("_", " "))
+        for index, (label, folder, stage, factory) in enumerate(plot_kinds):
+            self._check_cancel()
+            self._update_progress(self.stage_progress, index, len(plot_kinds), f"Building {label.lower()}")
+            self.logger.info("Building %s...", label)
+            directory = self.run_dir / folder
+            if not directory.is_dir():
+                directory.mkdir()
+            with self.quantifier.profiler.stage(stage) as record:
+                self._plot_metabolites(directory, factory)
+                record.set_shape(conc_data)
+            self.logger.info("%s have been generated", label)
+        self._update_progress(self.stage_progress, len(plot_kinds), len(plot_kinds), "Plots generated")
+
+        if self.quantifier.profiler.enabled:
+            self.quantifier.export_profile(self.run_dir, "Results")
+
+    def _plot_metabolites(self, directory, factory):
+        """
+        Save the figures of every metabolite for one plot kind, updating the metabolite progress bar and streaming
+        the saved figures to the output widget
+
+        :param directory: folder in which the figures are saved
+        :param factory: callable returning the plot object of a metabolite
+        """
+
+        metabolites = self.quantifier.metabolites
+        renderer = self._renderer()
+        for index, metabolite in enumerate(metabolites):
+            self._check_cancel()
+            self._update_progress(self.metabolite_progress, index, len(metabolites))
+            try:
+                for path in save_plot(factory(metabolite), self.fmt, directory, renderer, bbox_inches='tight'):
+                    self._stream_figure(path)
+            except Exception:
+                self.logger.exception(
+                    f"Error while plotting {metabolite}"
+                )
+                continue
+        self._update_progress(self.metabolite_progress, len(metabolites), len(metabolites))
+
+    def _stream_figure(self, path):
+        """Append a saved figure to the output widget"""
+
+        figure = SVG(filename=path) if self.fmt == "svg" else Image(filename=path)
+        self.figure_output.append_display_data(figure)
+
+    def _renderer(self):
+        """Backend of the bar and line plots chosen by the user"""
+
+        return "direct" if self.direct_render_checkbox.value else "matplotlib"
+
+    def _setup_explorer(self):
+        """Point the plot explorer to the new results and show the plot of the first metabolite"""
+
+        self.explorer = PlotExplorer(self.quantifier, self.format_chooser.value, self._renderer())
+        # Filling the widgets changes their values: no plot is rendered until they are all filled
+        self._explorer_ready = False
+        self.explore_kind.options = self.explorer.kinds
+        self.explore_kind.value = self.explorer.kinds[0]
+        self.explore_conditions.options = self.explorer.conditions
+        self.explore_conditions.value = tuple(self.explorer.conditions)
+        self.explore_metabolite.options = self.quantifier.metabolites
+        self.explore_metabolite.value = self.quantifier.metabolites[0] if self.quantifier.metabolites else None
+        for widget in [self.explore_metabolite, self.explore_kind, self.explore_conditions, self.export_viewed_btn]:
+            widget.disabled = False
+        self._explorer_ready = True
+        self.show_explored_plot(None)
+
+    def show_explored_plot(self, change):
+        """Show the plot of the metabolite, plot kind and conditions picked in the explorer (rendered if needed)"""
+
+        if not self._explorer_ready or self.explore_metabolite.value is None or self.explore_kind.value is None:
+            return
+        if not self.explore_conditions.value:
+            return self.logger.warning("Please select at least one condition")
+        self.explorer.fmt = self.format_chooser.value
+        self.explorer.renderer = self._renderer()
+        try:
+            figures = self.explorer.render(self.explore_kind.value, self.explore_metabolite.value,
+                                           self.explore_conditions.value)
+        except Exception:
+            return self.logger.exception(f"Error while plotting {self.explore_metabolite.value}")
+        self.explore_output.outputs = ()
+        for _, content in figures:
+            self.explore_output.append_display_data(SVG(data=content) if self.explorer.fmt == "svg"
+                                                    else Image(data=content, format=self.explorer.fmt))
+        cache = self.explorer.cache
+        self.explore_status.value = f"{len(self.explorer.viewed)} plots viewed, {len(cache)} cached " \
+                                    f"({cache.nbytes / 2 ** 20:.1f} of {cache.max_bytes / 2 ** 20:.0f} MB)"
+
+    def export_viewed(self, event):
+        """Save the plots viewed in the explorer in the results folder"""
+
+        if self.explorer is None or not self.explorer.viewed:
+            return self.logger.error("No plot has been viewed in the explorer yet")
+        paths = self.explorer.export_viewed(self.run_dir)
+        self.explore_status.value = f"{len(paths)} figures exported to {self.run_dir}"
+
+    @staticmethod
+    def _update_progress(bar, value, maximum, status=None):
+        """Update a progress bar (and its description if a status is given)"""
+
+        bar.max = max(maximum, 1)
+        bar.value = value
+        if status is not None:
+            bar.description = status
+
+    @property
+    def busy(self):
+        """True while a background job is running"""
+
+        return self._job is not None and self._job.is_alive()
+
+    def _run_in_background(self, target, name):
+        """
+        Run a job in a background thread so that the kernel stays responsive. Action buttons are disabled while the
+        job runs, so a second click cannot queue the job again.
+
+        :param target: callable to run
+        :param name: name of the job for the log and status messages
+        """
+
+        if self.busy:
+            return self.logger.warning("A job is already running. Please wait for it to finish or cancel it")
+        self._cancel_event.clear()
+        self._button_states = {btn: btn.disabled for btn in self._action_buttons}
+        for btn in self._action_buttons:
+            btn.disabled = True
+        self.cancel_btn.disabled = False
+        self.status_label.value = f"{name} running..."
+        self._job = threading.Thread(target=self._run_job, args=(target, name), daemon=True)
+        self._job.start()
+
+    def _run_job(self, target, name):
+        """Wrapper handling the end of a background job (success, cancellation or error)"""
+
+        try:
+            target()
+        except JobCancelled:
+            self.logger.warning("%s has been cancelled", name)
+            self.status_label.value = f"{name} cancelled"
+        except Exception:
+            self.logger.exception("Error during %s", name.lower())
+            self.status_label.value = f"{name} failed, check the log for details"
+        else:
+            self.status_label.value = f"{name} done"
+        finally:
+            for btn, disabled in self._button_states.items():
+                btn.disabled = disabled
+            self.cancel_btn.disabled = True
+
+    def _check_cancel(self):
+        """Called between units of work of a background job to stop it if the user asked for it"""
+
+        if self._cancel_event.is_set():
+            raise JobCancelled
+
+    def cancel_job(self, event):
+        """Ask the running job to stop at the next stage or metabolite"""
+
+        if self.busy:
+            self.logger.info("Cancelling...")
+            self._cancel_event.set()
 
     def load_events(self):
         """Load events for all the different buttons"""
@@ -304,3 +586,7 @@ class Rnb:
         self.submit_btn.on_click(self._submit_button_click)
         self.calculate_btn.on_click(self.process_data)
         self.plots_btn.on_click(self.build_plots)
+        self.cancel_btn.on_click(self.cancel_job)
+        self.export_viewed_btn.on_click(self.export_viewed)
+        for widget in [self.explore_metabolite, self.explore_kind, self.explore_conditions]:
+            widget.observe(self.show_explored_plot, names='value')